@@ -0,0 +1,287 @@
+import io
+import json
+import os
+import re
+import tarfile
+import zipfile
+
+import requests
+import zstandard
+
+from .metrics import METRICS
+
+RANGE_BLOCK_SIZE = 64 * 1024
+
+
+def _get_paths_from_paths_json(data):
+    return [p["_path"] for p in json.loads(data)["paths"]]
+
+
+def _get_paths_from_files(data):
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    return [ln.strip() for ln in data.splitlines() if ln.strip()]
+
+
+def _normalize_paths(paths):
+    return sorted(set(os.path.normpath(p) for p in paths if p))
+
+
+def _iter_tar_stream(fileobj, mode):
+    with tarfile.open(fileobj=fileobj, mode=mode) as tf:
+        for member in tf:
+            yield tf, member
+
+
+def _read_member(tf, member):
+    fp = tf.extractfile(member)
+    if fp is None:
+        return None
+    return fp.read()
+
+
+def get_paths_from_info_tarball(fileobj, mode="r|"):
+    """Get the paths in a package from its `info/` tarball without extracting it.
+
+    The list of paths is taken from `info/paths.json` if it is present, falling
+    back to `info/files`. The names of the members of the tarball itself are
+    always included.
+
+    Parameters
+    ----------
+    fileobj : file-like
+        A file-like object with the uncompressed tarball data.
+    mode : str, optional
+        The mode passed to `tarfile.open`. Defaults to an uncompressed stream.
+
+    Returns
+    -------
+    paths : list of str or None
+        The paths in the package or None if neither `info/paths.json` nor
+        `info/files` was found.
+    """
+    names = []
+    paths_json = None
+    files = None
+    for tf, member in _iter_tar_stream(fileobj, mode):
+        names.append(member.name)
+        if member.name == "info/paths.json":
+            paths_json = _read_member(tf, member)
+        elif member.name == "info/files":
+            files = _read_member(tf, member)
+
+    if paths_json is not None:
+        return names + _get_paths_from_paths_json(paths_json)
+    elif files is not None:
+        return names + _get_paths_from_files(files)
+    else:
+        return None
+
+
+def _get_paths_from_tar_bz2(path):
+    names = []
+    any_payload = False
+    paths = None
+    with open(path, "rb") as fp:
+        for tf, member in _iter_tar_stream(fp, "r|bz2"):
+            names.append(member.name)
+            if member.name == "info/paths.json":
+                paths = _get_paths_from_paths_json(_read_member(tf, member))
+                # conda-build writes the info/ files first so we can usually
+                # stop here and skip decompressing the payload entirely
+                if not any_payload:
+                    break
+            if not member.name.startswith("info/"):
+                any_payload = True
+
+    return names + (paths or [])
+
+
+def _get_paths_from_conda(path, info_only=False):
+    with zipfile.ZipFile(path) as zf:
+        components = {
+            os.path.basename(nm).split("-", 1)[0]: nm
+            for nm in zf.namelist()
+            if nm.endswith(".tar.zst")
+        }
+
+        with zf.open(components["info"]) as fp:
+            with zstandard.ZstdDecompressor().stream_reader(fp) as zfp:
+                paths = get_paths_from_info_tarball(zfp)
+
+        # very old packages may lack info/paths.json and info/files so we
+        # have to walk the payload names instead
+        if paths is None and not info_only:
+            paths = []
+            with zf.open(components["pkg"]) as fp:
+                with zstandard.ZstdDecompressor().stream_reader(fp) as zfp:
+                    for _, member in _iter_tar_stream(zfp, "r|"):
+                        paths.append(member.name)
+
+    return paths
+
+
+def get_artifact_paths(path):
+    """Get the paths in a conda artifact without extracting it to disk.
+
+    For `.conda` artifacts only the `info-*.tar.zst` component is read. For
+    `.tar.bz2` artifacts the tarball is streamed and only the member names are
+    kept, stopping early at `info/paths.json` when possible.
+
+    Parameters
+    ----------
+    path : str
+        The path to the artifact.
+
+    Returns
+    -------
+    paths : list of str
+        The sorted, unique list of paths in the artifact.
+    """
+    if path.endswith(".tar.bz2"):
+        paths = _get_paths_from_tar_bz2(path)
+    elif path.endswith(".conda"):
+        paths = _get_paths_from_conda(path)
+    else:
+        raise RuntimeError(
+            "Can only process packages that end in .tar.bz2 or .conda!"
+        )
+
+    return _normalize_paths(paths)
+
+
+def add_parent_dirs(paths):
+    """Add all of the parent directories of a list of paths to it.
+
+    Validation on an extracted artifact tests for the existence of both files and
+    directories. This function produces the same set of paths from a file list.
+
+    Parameters
+    ----------
+    paths : iterable of str
+        The paths.
+
+    Returns
+    -------
+    paths_and_dirs : list of str
+        The sorted list of paths and their parent directories.
+    """
+    all_paths = set()
+    for pth in paths:
+        while pth and pth not in all_paths:
+            all_paths.add(pth)
+            pth = os.path.dirname(pth)
+    return sorted(all_paths)
+
+
+class _HTTPRangeFile(io.RawIOBase):
+    """A read-only, seekable file backed by HTTP range requests.
+
+    The last block that was fetched is kept so that the many small reads done by
+    `zipfile` only need a handful of requests.
+    """
+    def __init__(self, url, session, size, block_start, block):
+        super().__init__()
+        self.url = url
+        self.session = session
+        self.size = size
+        self.pos = 0
+        self.block_start = block_start
+        self.block = block
+        self.n_requests = 1
+        self.n_bytes = len(block)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.size + offset
+        else:
+            raise ValueError("invalid whence %s" % whence)
+        self.pos = max(self.pos, 0)
+        return self.pos
+
+    def _fetch(self, start, n):
+        end = min(start + max(n, RANGE_BLOCK_SIZE), self.size) - 1
+        r = self.session.get(
+            self.url, headers={"Range": "bytes=%d-%d" % (start, end)},
+        )
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise RuntimeError("server did not honor range request for %s" % self.url)
+        self.block_start = start
+        self.block = r.content
+        self.n_requests += 1
+        self.n_bytes += len(self.block)
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self.pos)
+        if n <= 0:
+            return 0
+
+        offset = self.pos - self.block_start
+        if offset < 0 or offset + n > len(self.block):
+            self._fetch(self.pos, n)
+            offset = 0
+
+        b[:n] = self.block[offset:offset + n]
+        self.pos += n
+        return n
+
+
+def get_remote_conda_paths(url, session=None):
+    """Get the paths in a remote `.conda` artifact using HTTP range requests.
+
+    Only the zip central directory and the `info-*.tar.zst` component are
+    fetched, which is usually a tiny fraction of the artifact.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the `.conda` artifact.
+    session : requests.Session, optional
+        The session to use for the requests.
+
+    Returns
+    -------
+    paths : list of str or None
+        The sorted, unique list of paths in the artifact. None is returned if the
+        server does not support range requests or the artifact has neither
+        `info/paths.json` nor `info/files`, in which case the full artifact needs
+        to be downloaded.
+    """
+    session = session or requests
+
+    # the end of central directory record is at the end of the file, so we
+    # start with a suffix range which also tells us the size of the file
+    with session.get(
+        url, headers={"Range": "bytes=-%d" % RANGE_BLOCK_SIZE}, stream=True,
+    ) as r:
+        r.raise_for_status()
+        mtch = re.match(
+            r"bytes (\d+)-\d+/(\d+)", r.headers.get("Content-Range", "")
+        )
+        if r.status_code != 206 or mtch is None:
+            return None
+        block = r.content
+
+    fp = _HTTPRangeFile(
+        url, session, int(mtch.group(2)), int(mtch.group(1)), block,
+    )
+    paths = _get_paths_from_conda(fp, info_only=True)
+    METRICS.count("bytes_downloaded", fp.n_bytes)
+    if paths is None:
+        return None
+
+    return _normalize_paths(paths)
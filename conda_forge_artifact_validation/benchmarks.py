@@ -0,0 +1,363 @@
+"""Benchmarks of validation, matching, generation and scanning.
+
+The benchmarks use synthetic artifacts and validate YAMLs shaped like the real
+ones, so they run offline. The scan benchmark serves its artifacts and
+libcfgraph blobs from a local HTTP server.
+"""
+import concurrent.futures
+import functools
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+
+from . import scan
+from . import generate_validate_yamls
+from .cached_repodata import PackageRecord
+from .generate_validate_yamls import (
+    DEFAULT_PYTHON_GLOBS,
+    generate_validate_yaml_for_python,
+)
+from .glob_to_re import glob_to_re
+from .libcfgraph_listing import LibcfgraphListing, write_listing
+from .pipeline import ScanPipeline
+from .rules import RuleSet
+from .synthetic import local_channel, make_artifact, make_file_list
+from .validate import validate_file
+
+# bump this if the format of the results changes
+RESULTS_VERSION = 1
+
+# the default size of the benchmarks
+DEFAULT_PARAMS = {
+    # the number of files in each synthetic artifact
+    "n_files": 2000,
+    # the bytes of random data in each file of an artifact
+    "payload_size": 64,
+    # the number of literal paths in the openssl-like validate YAML
+    "n_literals": 1800,
+    # the number of python-package validate YAMLs
+    "n_python_yamls": 20,
+    # the number of artifacts in the scan benchmark
+    "n_artifacts": 64,
+    # the number of paths in the synthetic libcfgraph listing
+    "n_listing_paths": 200_000,
+    # how many times to run each benchmark, keeping the fastest
+    "repeat": 3,
+}
+
+
+def make_validate_yamls(n_literals, n_python_yamls, seed=0):
+    """Make synthetic validate YAMLs of a realistic size.
+
+    There is one YAML of literal paths like `openssl.generated.yaml` and
+    `n_python_yamls` YAMLs with the default python globs plus a few scripts
+    like the `*.python.generated.yaml` files.
+    """
+    rng = random.Random(seed)
+    literals = set()
+    while len(literals) < n_literals:
+        i = rng.randrange(10 * n_literals)
+        literals.add(
+            rng.choice([
+                "include/openssl/h%d.h" % i,
+                "lib/libcrypto.so.%d" % i,
+                "Library/bin/libssl-%d-x64.dll" % i,
+                "ssl/misc/tool%d.pl" % i,
+            ])
+        )
+    validate_yamls = {
+        "openssl.generated": {"files": sorted(literals), "allowed": ["openssl"]},
+    }
+
+    for k in range(n_python_yamls):
+        name = "pypkg%d" % k
+        files = [glb.format(import_name=name) for glb in DEFAULT_PYTHON_GLOBS]
+        files += ["bin/%s-script%d" % (name, j) for j in range(5)]
+        validate_yamls["%s.python.generated" % name] = {
+            "files": sorted(files), "allowed": [name],
+        }
+    return validate_yamls
+
+
+def _best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def bench_glob_to_re(params, tmpdir):
+    globs = [
+        patt
+        for validate_yaml in make_validate_yamls(
+            params["n_literals"], params["n_python_yamls"],
+        ).values()
+        for patt in validate_yaml["files"]
+    ]
+
+    def _run():
+        for patt in globs:
+            re.compile(glob_to_re(patt))
+            # the compiled regexes are cached by re
+            re.purge()
+
+    return _run, len(globs)
+
+
+def bench_compile_rules(params, tmpdir):
+    validate_yamls = make_validate_yamls(params["n_literals"], params["n_python_yamls"])
+    return functools.partial(RuleSet, validate_yamls), len(validate_yamls)
+
+
+def bench_match(params, tmpdir):
+    rule_set = RuleSet(
+        make_validate_yamls(params["n_literals"], params["n_python_yamls"])
+    )
+    file_lists = [
+        make_file_list("pypkg%d" % i, params["n_files"], seed=i) for i in range(10)
+    ]
+
+    def _run():
+        for files in file_lists:
+            rule_set.match("foo", files)
+
+    return _run, sum(len(files) for files in file_lists)
+
+
+def _bench_validate_file(ext, stream, params, tmpdir):
+    rule_set = RuleSet(
+        make_validate_yamls(params["n_literals"], params["n_python_yamls"])
+    )
+    path = make_artifact(
+        tmpdir,
+        "pypkg0-1.0-0" + ext,
+        make_file_list("pypkg0", params["n_files"]),
+        payload_size=params["payload_size"],
+    )
+
+    def _run():
+        with tempfile.TemporaryDirectory(dir=tmpdir) as extract_dir:
+            validate_file(path, rule_set, tmpdir=extract_dir, stream=stream)
+
+    return _run, params["n_files"]
+
+
+def _make_python_blobs(name, n_blobs, n_files):
+    return [
+        {"files": make_file_list(name, n_files, seed=i) + ["bin/%s-%d" % (name, i)]}
+        for i in range(n_blobs)
+    ]
+
+
+def bench_generate(params, tmpdir):
+    blobs = _make_python_blobs("pypkg0", 20, params["n_files"])
+
+    def _run():
+        # the libcfgraph blobs are swapped for synthetic ones
+        orig = generate_validate_yamls._get_all_json_blobs_for_artifact
+        generate_validate_yamls._get_all_json_blobs_for_artifact = (
+            lambda artifact_name, **kwargs: blobs
+        )
+        try:
+            generate_validate_yaml_for_python("pypkg0", ["pypkg0"])
+        finally:
+            generate_validate_yamls._get_all_json_blobs_for_artifact = orig
+
+    return _run, sum(len(blob["files"]) for blob in blobs)
+
+
+def bench_listing_lookup(params, tmpdir):
+    n_names = max(params["n_listing_paths"] // 50, 1)
+    pth = os.path.join(tmpdir, "listing.bin")
+    write_listing(
+        (
+            "artifacts/pkg%d/conda-forge/linux-64/pkg%d-1.%d-0.json" % (
+                i % n_names, i % n_names, i,
+            )
+            for i in range(params["n_listing_paths"])
+        ),
+        pth,
+    )
+    names = ["pkg%d" % i for i in range(0, n_names, max(n_names // 1000, 1))]
+
+    def _run():
+        with LibcfgraphListing(pth) as listing:
+            for name in names:
+                listing.get_artifact_paths(name)
+
+    return _run, len(names)
+
+
+def bench_scan(params, tmpdir):
+    rule_set = RuleSet(
+        make_validate_yamls(params["n_literals"], params["n_python_yamls"])
+    )
+    chan_dir = os.path.join(tmpdir, "scan_channel")
+    subdir_dir = os.path.join(chan_dir, "linux-64")
+    os.makedirs(subdir_dir, exist_ok=True)
+
+    artifacts = []
+    n_files = max(params["n_files"] // 10, 1)
+    for i in range(params["n_artifacts"]):
+        name = "pypkg%d" % (i % max(params["n_python_yamls"], 1))
+        pkg = "%s-1.%d-0.tar.bz2" % (name, i)
+        files = make_file_list(name, n_files, seed=i)
+        md5 = None
+        if i % 2 == 0:
+            # half of the artifacts are in libcfgraph
+            pth = os.path.join(
+                chan_dir, scan.get_libcfgraph_artifact_path(name, "linux-64", pkg),
+            )
+            os.makedirs(os.path.dirname(pth), exist_ok=True)
+            with open(pth, "w") as fp:
+                json.dump({"files": files}, fp)
+        else:
+            pth = make_artifact(
+                subdir_dir, pkg, files, payload_size=params["payload_size"],
+            )
+            with open(pth, "rb") as fp:
+                md5 = hashlib.md5(fp.read()).hexdigest()
+        artifacts.append(
+            ("linux-64", pkg, PackageRecord(pkg, name, "1.%d" % i, "0", md5))
+        )
+
+    def _run():
+        with local_channel(chan_dir) as server:
+            orig = scan.CHANNEL_URL, scan.LIBCFGRAPH_URL
+            scan.CHANNEL_URL, scan.LIBCFGRAPH_URL = server.url, server.url
+            try:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+                    pl = ScanPipeline(executor, rule_set, None, n_lookup=4)
+                    for _ in pl.run(iter(artifacts)):
+                        pass
+            finally:
+                scan.CHANNEL_URL, scan.LIBCFGRAPH_URL = orig
+
+    return _run, len(artifacts)
+
+
+# each benchmark takes the params and a scratch directory and returns the
+# function to time and the number of items it handles
+BENCHMARKS = {
+    "glob_to_re": bench_glob_to_re,
+    "compile_rules": bench_compile_rules,
+    "match": bench_match,
+    "validate_file_tar_bz2": functools.partial(_bench_validate_file, ".tar.bz2", False),
+    "validate_file_conda": functools.partial(_bench_validate_file, ".conda", False),
+    "validate_file_stream_tar_bz2": functools.partial(
+        _bench_validate_file, ".tar.bz2", True,
+    ),
+    "validate_file_stream_conda": functools.partial(
+        _bench_validate_file, ".conda", True,
+    ),
+    "generate_python": bench_generate,
+    "libcfgraph_listing_lookup": bench_listing_lookup,
+    "scan": bench_scan,
+}
+
+
+def run_benchmarks(names=None, params=None, label=None, verbose=0):
+    """Run the benchmarks.
+
+    Parameters
+    ----------
+    names : list of str, optional
+        The names of the benchmarks in `BENCHMARKS` to run. Defaults to all
+        of them.
+    params : dict, optional
+        Overrides of `DEFAULT_PARAMS`.
+    label : str, optional
+        A label for the results, like the version of the code.
+    verbose : int, optional
+        If greater than zero, print each result as it is done.
+
+    Returns
+    -------
+    results : dict
+        The label, the parameters, information on the machine and a
+        dictionary mapping the name of each benchmark to its fastest time in
+        `seconds`, the number of `items` it handled and the time in
+        `ms_per_item`.
+    """
+    _params = dict(DEFAULT_PARAMS)
+    _params.update(params or {})
+    names = names or list(BENCHMARKS)
+
+    results = {
+        "version": RESULTS_VERSION,
+        "label": label,
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "params": _params,
+        "benchmarks": {},
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in names:
+            func, n_items = BENCHMARKS[name](_params, tmpdir)
+            seconds = _best_time(func, _params["repeat"])
+            results["benchmarks"][name] = {
+                "seconds": seconds,
+                "items": n_items,
+                "ms_per_item": seconds * 1000 / max(n_items, 1),
+            }
+            if verbose > 0:
+                print("%-32s %10.4f s" % (name, seconds), flush=True)
+    return results
+
+
+def compare_results(old, new, threshold=0.1):
+    """Compare two sets of benchmark results.
+
+    Parameters
+    ----------
+    old : dict
+        The baseline results from `run_benchmarks`.
+    new : dict
+        The new results.
+    threshold : float, optional
+        The fraction by which a benchmark has to be slower to be a
+        regression.
+
+    Returns
+    -------
+    report : str
+        A table of the times and their ratios.
+    regressions : list of str
+        The names of the benchmarks that are slower than the baseline by more
+        than `threshold`.
+    """
+    lines = [
+        "%-32s %12s %12s %8s" % (
+            "benchmark",
+            old.get("label", None) or "old",
+            new.get("label", None) or "new",
+            "ratio",
+        )
+    ]
+    if old.get("params", None) != new.get("params", None):
+        lines.append("warning: the benchmarks were run with different params")
+
+    regressions = []
+    for name, res in new["benchmarks"].items():
+        if name not in old["benchmarks"]:
+            continue
+        ratio = res["seconds"] / max(old["benchmarks"][name]["seconds"], 1e-12)
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = " <- slower"
+        lines.append(
+            "%-32s %12.4f %12.4f %8.2f%s" % (
+                name, old["benchmarks"][name]["seconds"], res["seconds"], ratio, flag,
+            )
+        )
+    return "\n".join(lines), regressions
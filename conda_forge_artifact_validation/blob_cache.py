@@ -0,0 +1,267 @@
+import os
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+import concurrent.futures
+
+import rapidjson as json
+
+from .download import get_session, TIMEOUT
+from .libcfgraph_listing import LIBCFGRAPH_URL, LISTING_CACHE_DIR
+
+LOGGER = logging.getLogger(__name__)
+
+# the default location of the cache, next to the cached libcfgraph listing
+DEFAULT_BLOB_CACHE_PATH = (
+    os.path.join(LISTING_CACHE_DIR, "blobs.sqlite") if LISTING_CACHE_DIR else ""
+)
+
+# the default size of the cache - the file lists compress well, so this holds
+# a large part of libcfgraph
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+
+class BlobCache:
+    """An on-disk cache of the file lists in libcfgraph JSON blobs.
+
+    The blob of an artifact never changes once it is in libcfgraph, so the
+    file lists are keyed on the path of the blob and never expire. Instead,
+    the least recently used lists are evicted once the cache is larger than
+    `max_bytes`. The lists are stored compressed.
+
+    The cache is safe to use from multiple threads.
+
+    Parameters
+    ----------
+    path : str
+        The path to the SQLite database. It is created if it does not exist.
+    max_bytes : int, optional
+        The most bytes of compressed file lists to keep.
+    commit_every : int, optional
+        Commit to disk after this many changes.
+    """
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, commit_every=64):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self._n_uncommitted = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            "path TEXT PRIMARY KEY, "
+            "files BLOB NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS blobs_used ON blobs (used)")
+        self._conn.commit()
+        self.total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM blobs"
+        ).fetchone()[0]
+
+    def _maybe_commit(self):
+        self._n_uncommitted += 1
+        if self._n_uncommitted >= self.commit_every:
+            self._conn.commit()
+            self._n_uncommitted = 0
+
+    def get(self, path):
+        """Get the file list of a blob or None if it is not in the cache."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT files FROM blobs WHERE path = ?", (path,),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE blobs SET used = ? WHERE path = ?", (time.time(), path),
+            )
+            self._maybe_commit()
+        return json.loads(zlib.decompress(row[0]).decode("utf-8"))
+
+    def put(self, path, files):
+        """Put the file list of a blob in the cache, evicting old ones if needed."""
+        data = zlib.compress(json.dumps(files).encode("utf-8"))
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size FROM blobs WHERE path = ?", (path,),
+            ).fetchone()
+            if row is not None:
+                self.total_bytes -= row[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)",
+                (path, data, len(data), time.time()),
+            )
+            self.total_bytes += len(data)
+            self._maybe_commit()
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # evict down to 90% of the limit so that this is not done on every put
+        target = int(self.max_bytes * 0.9)
+        paths = []
+        for path, size in self._conn.execute(
+            "SELECT path, size FROM blobs ORDER BY used"
+        ).fetchall():
+            if self.total_bytes <= target:
+                break
+            paths.append((path,))
+            self.total_bytes -= size
+        self._conn.executemany("DELETE FROM blobs WHERE path = ?", paths)
+        self._conn.commit()
+        self._n_uncommitted = 0
+        LOGGER.debug("evicted %d blobs from %s", len(paths), self.path)
+
+    def __contains__(self, path):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM blobs WHERE path = ?", (path,),
+            ).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BlobFetcher:
+    """Gets the file lists of libcfgraph json blobs for many callers at once.
+
+    All of the downloads go through one bounded pool shared by the callers. A
+    blob that is being downloaded for one caller is not downloaded again for
+    another. Instead, they both wait for the same download. Finished downloads
+    are put in the cache, if any, so later callers find them there.
+
+    Parameters
+    ----------
+    cache : BlobCache, optional
+        The cache to use, if any.
+    offline : bool, optional
+        If True, only the blobs in the cache are returned.
+    url : str, optional
+        The URL of libcfgraph.
+    n_jobs : int, optional
+        The number of blobs to download at once.
+    """
+    def __init__(self, cache=None, offline=False, url=LIBCFGRAPH_URL, n_jobs=8):
+        self.cache = cache
+        self.offline = offline
+        self.url = url
+        self.n_downloads = 0
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_jobs)
+
+    def _download(self, pth):
+        try:
+            r = get_session().get("%s/%s" % (self.url, pth), timeout=TIMEOUT)
+            r.raise_for_status()
+            files = json.loads(r.content).get("files", [])
+        except Exception as e:
+            LOGGER.debug("could not download libcfgraph blob %s: %r", pth, e)
+            files = None
+        if files is not None and self.cache is not None:
+            self.cache.put(pth, files)
+
+        # the blob is in the cache before it stops being in flight so that it
+        # is never downloaded twice
+        with self._lock:
+            self.n_downloads += 1
+            del self._in_flight[pth]
+        return files
+
+    def fetch(self, blob_paths):
+        """Get the file lists of libcfgraph json blobs.
+
+        Parameters
+        ----------
+        blob_paths : list of str
+            The paths of the blobs in libcfgraph.
+
+        Returns
+        -------
+        file_lists : dict
+            A dictionary mapping each blob path to its file list, or None if it
+            could not be downloaded.
+        """
+        file_lists = {}
+        futures = {}
+        with self._lock:
+            for pth in blob_paths:
+                if pth in self._in_flight:
+                    futures[pth] = self._in_flight[pth]
+                    continue
+
+                files = self.cache.get(pth) if self.cache is not None else None
+                if files is not None or self.offline:
+                    file_lists[pth] = files
+                else:
+                    futures[pth] = self._executor.submit(self._download, pth)
+                    self._in_flight[pth] = futures[pth]
+
+        for pth, fut in futures.items():
+            file_lists[pth] = fut.result()
+        return file_lists
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def fetch_blob_file_lists(
+    blob_paths, cache=None, offline=False, url=LIBCFGRAPH_URL, n_jobs=8,
+):
+    """Get the file lists of libcfgraph json blobs.
+
+    Blobs in the cache are not downloaded. The rest are downloaded
+    concurrently with the shared connection pool and put in the cache. Use a
+    `BlobFetcher` to share the downloads between several callers.
+
+    Parameters
+    ----------
+    blob_paths : list of str
+        The paths of the blobs in libcfgraph.
+    cache : BlobCache, optional
+        The cache to use, if any.
+    offline : bool, optional
+        If True, only the blobs in the cache are returned.
+    url : str, optional
+        The URL of libcfgraph.
+    n_jobs : int, optional
+        The number of blobs to download at once.
+
+    Returns
+    -------
+    file_lists : dict
+        A dictionary mapping each blob path to its file list, or None if it
+        could not be downloaded.
+    """
+    with BlobFetcher(cache=cache, offline=offline, url=url, n_jobs=n_jobs) as fetcher:
+        return fetcher.fetch(blob_paths)
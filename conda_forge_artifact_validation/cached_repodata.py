@@ -1,22 +1,347 @@
+import os
+import sys
+import gzip
+import json
+import hashlib
+import logging
 import functools
+import threading
 from collections import UserDict
 
 import tenacity
 import requests
 
+from .download import get_session, TIMEOUT
+
+LOGGER = logging.getLogger(__name__)
+
 SUBDIRS = [
     "linux-64", "osx-64", "noarch", "win-64",
     "linux-ppc64le", "linux-aarch64", "osx-arm64",
 ]
 CHANNEL_URL = "https://conda.anaconda.org/conda-forge"
 
+# repodata is cached here across runs - set the environment variable to an
+# empty string to turn this off
+REPODATA_CACHE_DIR = os.environ.get(
+    "CF_ARTIFACT_VALIDATION_REPODATA_CACHE_DIR",
+    os.path.join(
+        os.path.expanduser("~"), ".cache", "conda-forge-artifact-validation",
+        "repodata",
+    ),
+)
+
+
+def _blake2b_hexdigest(data, key=b""):
+    return hashlib.blake2b(data, key=key, digest_size=32).hexdigest()
+
+
+def _unescape_pointer_token(token):
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def _resolve_pointer(doc, pointer):
+    # returns the parent container and the final key of a JSON pointer
+    tokens = [_unescape_pointer_token(t) for t in pointer.split("/")[1:]]
+    parent = doc
+    for token in tokens[:-1]:
+        if isinstance(parent, list):
+            parent = parent[int(token)]
+        else:
+            parent = parent[token]
+    return parent, tokens[-1]
+
+
+def _get_pointer(doc, pointer):
+    if pointer == "":
+        return doc
+    parent, key = _resolve_pointer(doc, pointer)
+    return parent[int(key)] if isinstance(parent, list) else parent[key]
+
+
+def _add_pointer(doc, pointer, value):
+    parent, key = _resolve_pointer(doc, pointer)
+    if isinstance(parent, list):
+        if key == "-":
+            parent.append(value)
+        else:
+            parent.insert(int(key), value)
+    else:
+        parent[key] = value
+
+
+def _remove_pointer(doc, pointer):
+    parent, key = _resolve_pointer(doc, pointer)
+    if isinstance(parent, list):
+        return parent.pop(int(key))
+    else:
+        return parent.pop(key)
+
+
+def apply_json_patch(doc, patch):
+    """Apply an RFC 6902 JSON patch to a document in place.
+
+    Parameters
+    ----------
+    doc : dict
+        The document.
+    patch : list of dict
+        The patch operations.
+
+    Returns
+    -------
+    doc : dict
+        The patched document.
+    """
+    for op in patch:
+        if op["op"] == "add":
+            _add_pointer(doc, op["path"], op["value"])
+        elif op["op"] == "remove":
+            _remove_pointer(doc, op["path"])
+        elif op["op"] == "replace":
+            parent, key = _resolve_pointer(doc, op["path"])
+            if isinstance(parent, list):
+                parent[int(key)] = op["value"]
+            else:
+                parent[key] = op["value"]
+        elif op["op"] == "move":
+            _add_pointer(doc, op["path"], _remove_pointer(doc, op["from"]))
+        elif op["op"] == "copy":
+            _add_pointer(doc, op["path"], _get_pointer(doc, op["from"]))
+        elif op["op"] == "test":
+            if _get_pointer(doc, op["path"]) != op["value"]:
+                raise ValueError("JSON patch test failed for %s" % op["path"])
+        else:
+            raise ValueError("unknown JSON patch op %s" % op["op"])
+    return doc
+
+
+def _parse_jlap(data, iv):
+    """Parse and verify the lines of a (partial) .jlap file.
+
+    Returns the patches, the metadata, the running hash before the metadata line
+    and the number of bytes before the metadata line.
+    """
+    lines = data.split(b"\n")
+    if lines[-1] == b"":
+        lines = lines[:-1]
+    if len(lines) < 2:
+        raise ValueError("jlap data is too short")
+
+    running = bytes.fromhex(iv)
+    hashes = []
+    for line in lines[:-1]:
+        hashes.append(running)
+        running = bytes.fromhex(_blake2b_hexdigest(line, key=running))
+    if running.hex() != lines[-1].decode("utf-8").strip():
+        raise ValueError("jlap checksum does not match")
+
+    patches = [json.loads(line) for line in lines[:-2]]
+    metadata = json.loads(lines[-2])
+    meta_pos = sum(len(line) + 1 for line in lines[:-2])
+    return patches, metadata, hashes[-1].hex(), meta_pos
+
+
+def _find_patch_chain(patches, start, end):
+    by_to = {p["to"]: p for p in patches}
+    chain = []
+    curr = end
+    while curr != start:
+        if curr not in by_to:
+            return None
+        chain.append(by_to[curr])
+        curr = by_to[curr]["from"]
+    return chain[::-1]
+
+
+class DiskRepodataCache:
+    """A persistent on-disk cache of repodata.
+
+    Each subdir is stored along with the ETag, Last-Modified header and hash of
+    the repodata it came from. Updates first try the incremental `repodata.jlap`
+    patch format and then fall back to a conditional request for the full
+    `repodata.json`, so that only changes are transferred when possible.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The directory for the cache.
+    channel_url : str, optional
+        The URL of the channel.
+    compress : bool, optional
+        If True, store the repodata gzip-compressed.
+    use_jlap : bool, optional
+        If True, try to update the repodata with `repodata.jlap` patches.
+    session : requests.Session, optional
+        The session to use for requests. Defaults to the shared session from
+        `download.get_session`.
+    offline : bool, optional
+        If True, only use the cached repodata and never make a request.
+    """
+    def __init__(
+        self, cache_dir, channel_url=CHANNEL_URL, compress=True, use_jlap=True,
+        session=None, offline=False,
+    ):
+        self.cache_dir = cache_dir
+        self.channel_url = channel_url
+        self.compress = compress
+        self.use_jlap = use_jlap
+        self.offline = offline
+        self.session = session or get_session()
+
+    def _paths(self, subdir):
+        base = os.path.join(self.cache_dir, self.channel_url.split("://")[-1], subdir)
+        return (
+            base,
+            os.path.join(base, "repodata.json" + (".gz" if self.compress else "")),
+            os.path.join(base, "state.json"),
+        )
+
+    def _read(self, subdir):
+        _, data_pth, state_pth = self._paths(subdir)
+        if not (os.path.exists(data_pth) and os.path.exists(state_pth)):
+            return None, {}
+
+        try:
+            opener = gzip.open if self.compress else open
+            with opener(data_pth, "rb") as fp:
+                rd = json.loads(fp.read())
+            with open(state_pth, "r") as fp:
+                state = json.load(fp)
+        except Exception as e:
+            LOGGER.info("could not read cached repodata for %s: %s", subdir, repr(e))
+            return None, {}
+
+        return rd, state
+
+    def _write(self, subdir, data, state):
+        base, data_pth, state_pth = self._paths(subdir)
+        os.makedirs(base, exist_ok=True)
+
+        # the data is skipped if only the state changed
+        if data is not None:
+            if not isinstance(data, bytes):
+                data = json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+            opener = gzip.open if self.compress else open
+            with opener(data_pth + ".tmp", "wb") as fp:
+                fp.write(data)
+            os.replace(data_pth + ".tmp", data_pth)
+
+        with open(state_pth + ".tmp", "w") as fp:
+            json.dump(state, fp)
+        os.replace(state_pth + ".tmp", state_pth)
+
+    def _update_with_jlap(self, subdir, rd, state):
+        url = f"{self.channel_url}/{subdir}/repodata.jlap"
+        jlap = state.get("jlap", None)
+
+        r = None
+        patches = None
+        if jlap is not None:
+            r = self.session.get(
+                url, headers={"Range": "bytes=%d-" % jlap["pos"]}, timeout=TIMEOUT,
+            )
+            if r.status_code == 206:
+                try:
+                    patches, metadata, iv, pos = _parse_jlap(r.content, jlap["iv"])
+                    pos += jlap["pos"]
+                except ValueError:
+                    # the file was replaced so we start over
+                    r = None
+
+        if patches is None:
+            if r is None or r.status_code != 200:
+                r = self.session.get(url, timeout=TIMEOUT)
+            if r.status_code != 200:
+                return None
+            first, rest = r.content.split(b"\n", 1)
+            patches, metadata, iv, pos = _parse_jlap(
+                rest, first.decode("utf-8").strip(),
+            )
+            pos += len(first) + 1
+
+        chain = _find_patch_chain(patches, state["hash"], metadata["latest"])
+        if chain is None:
+            return None
+
+        for patch in chain:
+            apply_json_patch(rd, patch["patch"])
+        LOGGER.info("applied %d jlap patches to %s", len(chain), subdir)
+
+        new_state = dict(state)
+        new_state["hash"] = metadata["latest"]
+        new_state["jlap"] = {"pos": pos, "iv": iv}
+        self._write(subdir, rd if chain else None, new_state)
+        return rd
+
+    def get(self, subdir):
+        """Get the repodata for a subdir, updating the cache as needed."""
+        rd, state = self._read(subdir)
+
+        if self.offline:
+            if rd is None:
+                raise RuntimeError(
+                    "there is no cached repodata for %s to use offline" % subdir
+                )
+            return rd
+
+        if rd is not None and self.use_jlap and "hash" in state:
+            try:
+                _rd = self._update_with_jlap(subdir, rd, state)
+            except Exception as e:
+                LOGGER.info("jlap update failed for %s: %s", subdir, repr(e))
+                _rd = None
+                rd, state = self._read(subdir)
+            if _rd is not None:
+                return _rd
+
+        headers = {}
+        if rd is not None:
+            if state.get("etag", None):
+                headers["If-None-Match"] = state["etag"]
+            if state.get("last_modified", None):
+                headers["If-Modified-Since"] = state["last_modified"]
+
+        r = self.session.get(
+            f"{self.channel_url}/{subdir}/repodata.json",
+            headers=headers,
+            timeout=TIMEOUT,
+        )
+        if r.status_code == 304 and rd is not None:
+            LOGGER.info("cached repodata for %s is current", subdir)
+            return rd
+        r.raise_for_status()
+
+        data = r.content
+        state = {
+            "etag": r.headers.get("ETag", None),
+            "last_modified": r.headers.get("Last-Modified", None),
+            "hash": _blake2b_hexdigest(data),
+        }
+        self._write(subdir, data, state)
+        return json.loads(data)
+
+
+def _load_repodata_retry(subdir, offline=False):
+    # offline there is nothing to retry
+    if offline:
+        if not REPODATA_CACHE_DIR:
+            raise RuntimeError("there is no repodata cache to use offline")
+        return DiskRepodataCache(REPODATA_CACHE_DIR, offline=True).get(subdir)
+
+    return _download_repodata_retry(subdir)
+
 
 @tenacity.retry(
     wait=tenacity.wait_random_exponential(multiplier=1, max=10),
     stop=tenacity.stop_after_attempt(5),
     reraise=True,
 )
-def _load_repodata_retry(subdir):
+def _download_repodata_retry(subdir):
+    if REPODATA_CACHE_DIR:
+        return DiskRepodataCache(REPODATA_CACHE_DIR).get(subdir)
+
     rd = requests.get(
         f"{CHANNEL_URL}/{subdir}/repodata.json"
     )
@@ -49,3 +374,132 @@ class RepodataCache(UserDict):
 
 
 REPODATA_CACHE = RepodataCache()
+
+
+class PackageRecord:
+    """The parts of a repodata entry used by the scanner.
+
+    The name, version and build strings are interned since they are shared by
+    many artifacts.
+    """
+    __slots__ = (
+        "fn", "name", "version", "build", "md5", "sha256", "size", "timestamp",
+    )
+
+    def __init__(
+        self, fn, name, version, build, md5, sha256=None, size=0, timestamp=0,
+    ):
+        self.fn = fn
+        self.name = sys.intern(name)
+        self.version = sys.intern(version)
+        self.build = sys.intern(build)
+        self.md5 = md5
+        self.sha256 = sha256
+        self.size = size
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_repodata(cls, fn, entry):
+        return cls(
+            fn,
+            entry["name"],
+            entry.get("version", ""),
+            entry.get("build", ""),
+            entry["md5"],
+            sha256=entry.get("sha256", None),
+            size=entry.get("size", 0),
+            timestamp=entry.get("timestamp", 0),
+        )
+
+    def __repr__(self):
+        return "PackageRecord(%r)" % self.fn
+
+    def __eq__(self, other):
+        if not isinstance(other, PackageRecord):
+            return NotImplemented
+        return all(getattr(self, k) == getattr(other, k) for k in self.__slots__)
+
+    def __getstate__(self):
+        return tuple(getattr(self, k) for k in self.__slots__)
+
+    def __setstate__(self, state):
+        for k, v in zip(self.__slots__, state):
+            setattr(self, k, v)
+
+
+class CompactRepodata:
+    """A memory-lean view of the repodata for a subdir.
+
+    Only a `PackageRecord` per artifact is kept and everything else in the
+    repodata (dependencies, licenses, etc.) is dropped.
+
+    Parameters
+    ----------
+    repodata : dict
+        The parsed repodata.
+
+    Attributes
+    ----------
+    packages : dict
+        A dictionary mapping the `.tar.bz2` artifacts to their records.
+    packages_conda : dict
+        A dictionary mapping the `.conda` artifacts to their records.
+    """
+    __slots__ = ("packages", "packages_conda")
+
+    def __init__(self, repodata):
+        self.packages = {
+            sys.intern(fn): PackageRecord.from_repodata(fn, entry)
+            for fn, entry in repodata.get("packages", {}).items()
+        }
+        self.packages_conda = {
+            sys.intern(fn): PackageRecord.from_repodata(fn, entry)
+            for fn, entry in repodata.get("packages.conda", {}).items()
+        }
+
+    def __contains__(self, fn):
+        return fn in self.packages or fn in self.packages_conda
+
+    def __len__(self):
+        return len(self.packages) + len(self.packages_conda)
+
+    def get(self, fn, default=None):
+        """Get the record for an artifact of either format."""
+        rec = self.packages.get(fn, None)
+        if rec is None:
+            rec = self.packages_conda.get(fn, default)
+        return rec
+
+
+class CompactRepodataCache(UserDict):
+    """A cache of `CompactRepodata`.
+
+    The full repodata for each subdir is parsed once and then thrown away, so
+    unlike `RepodataCache` it is never held in memory for long.
+
+    >>> compact_repodata_cache["linux-64"].packages["numpy-..."].md5
+    '...'
+
+    The repodata for a subdir is only loaded once when it is first used from
+    several threads at the same time.
+    """
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+
+    def load(self, index, offline=False):
+        """Get the repodata for a subdir, only using the disk cache if `offline`."""
+        if index not in self.data:
+            with self._lock:
+                if index not in self.data:
+                    self[index] = CompactRepodata(
+                        _load_repodata_retry(index, offline=offline)
+                    )
+
+        return self.data[index]
+
+    def __getitem__(self, index):
+        return self.load(index)
+
+
+COMPACT_REPODATA_CACHE = CompactRepodataCache()
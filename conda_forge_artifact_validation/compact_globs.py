@@ -0,0 +1,160 @@
+from collections import defaultdict
+
+from .rules import GLOB_CHARS
+
+# the glob that matches everything in a directory
+DIR_GLOB_SUFFIX = "/**/*"
+
+
+def _is_literal(patt):
+    return not any(c in patt for c in GLOB_CHARS)
+
+
+def _get_dir_glob_dir(patt):
+    # the directory of a glob like `share/doc/foo/**/*` or None
+    if patt.endswith(DIR_GLOB_SUFFIX):
+        dirname = patt[:-len(DIR_GLOB_SUFFIX)]
+        if dirname and _is_literal(dirname):
+            return dirname
+    return None
+
+
+def is_dir_glob(patt):
+    """Test if a pattern is a directory glob like `share/doc/foo/**/*`."""
+    return _get_dir_glob_dir(patt) is not None
+
+
+def _is_under(path, dirnames):
+    parts = path.split("/")
+    return any("/".join(parts[:i]) in dirnames for i in range(1, len(parts)))
+
+
+def compact_files(files, iter_known_paths, min_files=2, min_depth=2):
+    """Collapse the literal paths of a validate YAML into directory globs.
+
+    A directory of literal paths is replaced by a glob like `share/doc/foo/**/*`
+    when every known path in that directory is already one of the literal
+    paths. So, on all of the known paths, the new globs match exactly what the
+    literal paths did and never a file of another artifact. The highest such
+    directories are used. Literal paths already covered by a directory glob in
+    `files` are removed too.
+
+    Parameters
+    ----------
+    files : list of str
+        The `files` of the validate YAML. Only the literal paths are changed.
+    iter_known_paths : callable
+        A function that takes a prefix like `share/doc/` and returns an iterable
+        of all of the known paths that start with it (e.g.,
+        `FileListIndex.iter_paths`).
+    min_files : int, optional
+        The fewest literal paths a directory needs to be collapsed.
+    min_depth : int, optional
+        The fewest components a directory needs to be collapsed. This keeps
+        broad top-level directories like `ssl/` as literal paths.
+
+    Returns
+    -------
+    files : list of str
+        The new sorted `files`.
+    """
+    literals = {f for f in files if _is_literal(f)}
+    others = {f for f in files if f not in literals}
+    covered = {d for d in map(_get_dir_glob_dir, others) if d is not None}
+    literals = {f for f in literals if not _is_under(f, covered)}
+
+    # the literal paths in each directory that could be collapsed
+    dir_counts = defaultdict(int)
+    for f in literals:
+        parts = f.split("/")
+        for i in range(min_depth, len(parts)):
+            dir_counts["/".join(parts[:i])] += 1
+
+    chosen = set()
+    for dirname in sorted(dir_counts, key=lambda d: (d.count("/"), d)):
+        if dir_counts[dirname] < min_files or _is_under(dirname, chosen):
+            continue
+
+        # every known path must be one of ours and all of ours must be known,
+        # so that an empty or partial index cannot make the glob look safe
+        n_known = 0
+        for pth in iter_known_paths(dirname + "/"):
+            if pth not in literals:
+                break
+            n_known += 1
+        else:
+            if n_known == dir_counts[dirname]:
+                chosen.add(dirname)
+
+    return sorted(
+        others
+        | {d + DIR_GLOB_SUFFIX for d in chosen}
+        | {f for f in literals if not _is_under(f, chosen)}
+    )
+
+
+def find_unsafe_dir_globs(globs, files, iter_known_paths):
+    """Find the directory globs that match a known path not in `files`.
+
+    A glob made by `compact_files` is only safe as long as every known path
+    in its directory is one of the literal paths it replaced. This stops
+    being true once another artifact ships a file there.
+
+    Parameters
+    ----------
+    globs : list of str
+        The globs to check. Patterns that are not directory globs are
+        ignored.
+    files : list of str
+        The `files` of the validate YAML. Only the literal paths are used.
+    iter_known_paths : callable
+        A function that takes a prefix and returns an iterable of all of the
+        known paths that start with it (e.g., `FileListIndex.iter_paths`).
+
+    Returns
+    -------
+    unsafe : list of str
+        The globs that match a known path that is not one of the literal
+        paths.
+    """
+    literals = {f for f in files if _is_literal(f)}
+    unsafe = []
+    for patt in globs:
+        dirname = _get_dir_glob_dir(patt)
+        if dirname is not None and any(
+            pth not in literals for pth in iter_known_paths(dirname + "/")
+        ):
+            unsafe.append(patt)
+    return unsafe
+
+
+def format_compaction_report(stats):
+    """Format a report of the rules removed by compaction.
+
+    Parameters
+    ----------
+    stats : dict
+        A dictionary mapping the path of each generated validate YAML to the
+        number of `files` it had before and after compaction.
+
+    Returns
+    -------
+    report : str
+        The report.
+    """
+    lines = ["%-56s %8s %8s" % ("validate yaml", "before", "after")]
+    for pth, (n_before, n_after) in sorted(stats.items()):
+        if n_before != n_after:
+            lines.append("%-56s %8d %8d" % (pth, n_before, n_after))
+
+    n_before = sum(v[0] for v in stats.values())
+    n_after = sum(v[1] for v in stats.values())
+    lines.append(
+        "compacted %d rules to %d (%.1f%% fewer) in %d validate yamls" % (
+            n_before,
+            n_after,
+            100 * (n_before - n_after) / max(n_before, 1),
+            sum(v[0] != v[1] for v in stats.values()),
+        )
+    )
+    return "\n".join(lines)
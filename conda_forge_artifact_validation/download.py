@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import os
+import time
+import threading
+
+import requests
+import tenacity
+
+from .metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = (10, 60)
+MAX_ATTEMPTS = 5
+MAX_WAIT = 10
+# a bad checksum is usually a corrupted transfer, but a few retries are enough
+# to tell that apart from a file that really does not match
+MAX_CHECKSUM_RETRIES = 2
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+class ChecksumError(RuntimeError):
+    """Raised when a downloaded file does not have the expected checksum."""
+    def __init__(self, url, kind, expected, actual):
+        super().__init__(
+            "%s checksum for %s is %s but expected %s" % (kind, url, actual, expected)
+        )
+        self.kind = kind
+
+
+def get_session():
+    """Get the shared, connection-pooled `requests.Session`.
+
+    The session is created on first use and is reused so that connections are
+    kept alive across downloads. It is safe to share between threads for the
+    simple GET requests made here.
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=16, pool_maxsize=32,
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _SESSION = session
+    return _SESSION
+
+
+def _is_transient(e):
+    # only errors that could go away on their own are retried - a missing
+    # file will not change
+    if isinstance(e, requests.HTTPError):
+        status = e.response.status_code if e.response is not None else None
+        return status is None or status == 429 or status >= 500
+    return isinstance(
+        e,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ),
+    )
+
+
+def _download_once(url, path, session, md5sum, sha256):
+    # sha256 is a lot slower than md5, so it is only computed to check it
+    hashes = {"md5": hashlib.md5()}
+    if sha256 is not None:
+        hashes["sha256"] = hashlib.sha256()
+    n_bytes = 0
+    checksum_time = 0.0
+    with METRICS.time("download"):
+        with session.get(url, stream=True, timeout=TIMEOUT) as r:
+            r.raise_for_status()
+            with open(path, "wb") as fp:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    fp.write(chunk)
+                    t0 = time.perf_counter()
+                    for h in hashes.values():
+                        h.update(chunk)
+                    checksum_time += time.perf_counter() - t0
+                    n_bytes += len(chunk)
+                    METRICS.count("bytes_downloaded", len(chunk))
+    # the checksums are computed as the data arrives so this is part of the
+    # download time
+    METRICS.add_time("checksum", checksum_time)
+
+    digests = {"sha256": None}
+    digests.update((k, h.hexdigest()) for k, h in hashes.items())
+    for kind, expected in [("md5", md5sum), ("sha256", sha256)]:
+        if expected is not None and expected != digests[kind]:
+            os.remove(path)
+            raise ChecksumError(url, kind, expected, digests[kind])
+
+    digests["bytes"] = n_bytes
+    return digests
+
+
+def download_file(
+    url, path, md5sum=None, sha256=None, session=None, max_attempts=None,
+    max_wait=None, max_checksum_retries=None,
+):
+    """Download a file, computing its checksums as the data arrives.
+
+    Connection errors, timeouts and HTTP 429 and 5xx responses are retried
+    with randomized exponential backoff. Checksum mismatches are retried the
+    same way, but only `max_checksum_retries` times. Other HTTP errors, like a
+    missing file, are raised right away.
+
+    Parameters
+    ----------
+    url : str
+        The URL to download.
+    path : str
+        The path to write the file to.
+    md5sum : str, optional
+        If not None, the expected md5 checksum of the file.
+    sha256 : str, optional
+        If not None, the expected sha256 checksum of the file. The sha256
+        checksum is only computed if this is given.
+    session : requests.Session, optional
+        The session to use. Defaults to the shared session from `get_session`.
+    max_attempts : int, optional
+        The maximum number of attempts to make. Defaults to `MAX_ATTEMPTS`.
+    max_wait : float, optional
+        The maximum time in seconds to wait between attempts. Defaults to
+        `MAX_WAIT`.
+    max_checksum_retries : int, optional
+        The maximum number of times to retry after a checksum mismatch.
+        Defaults to `MAX_CHECKSUM_RETRIES`.
+
+    Returns
+    -------
+    info : dict
+        A dictionary with the `md5` and `sha256` hex digests and the number
+        of `bytes` downloaded. The `sha256` is None if it was not checked.
+
+    Raises
+    ------
+    ChecksumError
+        If the file does not have the right checksum.
+    requests.RequestException
+        If the file could not be downloaded.
+    """
+    session = session or get_session()
+    max_attempts = max_attempts or MAX_ATTEMPTS
+    max_wait = MAX_WAIT if max_wait is None else max_wait
+    if max_checksum_retries is None:
+        max_checksum_retries = MAX_CHECKSUM_RETRIES
+    n_checksum_errors = 0
+
+    def _retry(e):
+        nonlocal n_checksum_errors
+        if isinstance(e, ChecksumError):
+            n_checksum_errors += 1
+            return n_checksum_errors <= max_checksum_retries
+        return _is_transient(e)
+
+    for attempt in tenacity.Retrying(
+        wait=tenacity.wait_random_exponential(multiplier=1, max=max_wait),
+        stop=tenacity.stop_after_attempt(max_attempts),
+        retry=tenacity.retry_if_exception(_retry),
+        reraise=True,
+    ):
+        with attempt:
+            if attempt.retry_state.attempt_number > 1:
+                LOGGER.info(
+                    "retrying download of %s (attempt %d)",
+                    url,
+                    attempt.retry_state.attempt_number,
+                )
+            return _download_once(url, path, session, md5sum, sha256)
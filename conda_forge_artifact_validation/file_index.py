@@ -0,0 +1,426 @@
+import os
+import time
+import array
+import sqlite3
+import threading
+
+import rapidjson as json
+
+# how long a miss is trusted before libcfgraph is checked again
+DEFAULT_MISS_TTL = 7 * 24 * 3600
+
+# the most path ids to keep in memory while building an index
+_MAX_PATH_ID_CACHE = 1_000_000
+
+# sqlite limits the number of parameters in a query
+_MAX_PARAMS = 900
+
+
+def get_artifact_key(subdir, pkg):
+    """Get the key of an artifact in the index.
+
+    libcfgraph does not distinguish between the `.tar.bz2` and `.conda`
+    artifacts of a build, so the extension is removed.
+    """
+    for ext in [".tar.bz2", ".conda", ".json"]:
+        if pkg.endswith(ext):
+            pkg = pkg[:-len(ext)]
+            break
+    return f"{subdir}/{pkg}"
+
+
+class FileListIndex:
+    """A local index of the files in each artifact.
+
+    The file lists from libcfgraph and from downloaded artifacts are stored in a
+    single SQLite database with each distinct path stored once. The source of
+    each list is stored with it, since lists read from an artifact are matched
+    differently than lists from libcfgraph (see `scan.match_file_list`).
+    Artifacts that are known not to be in libcfgraph are also recorded, so
+    that they can be skipped without asking GitHub again until the miss is
+    older than `miss_ttl`.
+
+    The scanner also records which artifacts were matched against which
+    rules, along with the rules themselves, so that a change to the rules can
+    be applied to the stored file lists without the network. See
+    `conda_forge_artifact_validation.rescan`.
+
+    The index is safe to use from multiple threads.
+
+    Parameters
+    ----------
+    path : str
+        The path to the SQLite database. It is created if it does not exist.
+    miss_ttl : float, optional
+        The time in seconds a recorded miss is used for.
+    commit_every : int, optional
+        Commit to disk after this many changes.
+    """
+    def __init__(self, path, miss_ttl=DEFAULT_MISS_TTL, commit_every=256):
+        self.path = path
+        self.miss_ttl = miss_ttl
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self._n_uncommitted = 0
+        self._path_ids = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS paths ("
+            "id INTEGER PRIMARY KEY, "
+            "path TEXT NOT NULL UNIQUE)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS artifacts ("
+            "artifact TEXT PRIMARY KEY, "
+            "path_ids BLOB NOT NULL, "
+            "source TEXT NOT NULL DEFAULT 'libcfgraph')"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS misses ("
+            "artifact TEXT PRIMARY KEY, "
+            "updated REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS scanned ("
+            "artifact TEXT PRIMARY KEY, "
+            "name TEXT NOT NULL, "
+            "source TEXT NOT NULL, "
+            "fingerprint TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rules ("
+            "fingerprint TEXT PRIMARY KEY, "
+            "validate_yamls TEXT NOT NULL)"
+        )
+        self._add_source_column()
+        self._conn.commit()
+
+    def _add_source_column(self):
+        # indexes from before the source was stored get the source of each
+        # list from how the artifact was last scanned
+        columns = [r[1] for r in self._conn.execute("PRAGMA table_info(artifacts)")]
+        if "source" in columns:
+            return
+        self._conn.execute(
+            "ALTER TABLE artifacts "
+            "ADD COLUMN source TEXT NOT NULL DEFAULT 'libcfgraph'"
+        )
+        self._conn.executemany(
+            "UPDATE artifacts SET source = 'download' WHERE artifact = ?",
+            (
+                (get_artifact_key(*r[0].split("/", 1)),)
+                for r in self._conn.execute(
+                    "SELECT artifact FROM scanned WHERE source = 'download'"
+                ).fetchall()
+            ),
+        )
+
+    def _maybe_commit(self):
+        self._n_uncommitted += 1
+        if self._n_uncommitted >= self.commit_every:
+            self._conn.commit()
+            self._n_uncommitted = 0
+
+    def _get_path_ids(self, fnames):
+        missing = [f for f in set(fnames) if f not in self._path_ids]
+        if missing:
+            if len(self._path_ids) + len(missing) > _MAX_PATH_ID_CACHE:
+                self._path_ids = {}
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO paths (path) VALUES (?)",
+                ((f,) for f in missing),
+            )
+            for i in range(0, len(missing), _MAX_PARAMS):
+                chunk = missing[i:i + _MAX_PARAMS]
+                self._path_ids.update(
+                    (path, id_) for id_, path in self._conn.execute(
+                        "SELECT id, path FROM paths WHERE path IN (%s)" % (
+                            ",".join("?" * len(chunk))
+                        ),
+                        chunk,
+                    )
+                )
+        return sorted({self._path_ids[f] for f in fnames})
+
+    def get(self, subdir, pkg, return_source=False):
+        """Get the files in an artifact.
+
+        Parameters
+        ----------
+        subdir : str
+            The subdir of the artifact.
+        pkg : str
+            The artifact file name.
+        return_source : bool, optional
+            If True, return where the list came from as well.
+
+        Returns
+        -------
+        files : list of str or None
+            The files in the artifact or None if it is not in the index.
+        source : str or None
+            Where the list came from, either "libcfgraph" or "download". Only
+            returned if `return_source` is True.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT path_ids, source FROM artifacts WHERE artifact = ?",
+                (get_artifact_key(subdir, pkg),),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return (None, None) if return_source else None
+            self.hits += 1
+
+            ids = array.array("q")
+            ids.frombytes(row[0])
+            ids = ids.tolist()
+            files = []
+            for i in range(0, len(ids), _MAX_PARAMS):
+                chunk = ids[i:i + _MAX_PARAMS]
+                files.extend(
+                    r[0] for r in self._conn.execute(
+                        "SELECT path FROM paths WHERE id IN (%s)" % (
+                            ",".join("?" * len(chunk))
+                        ),
+                        chunk,
+                    )
+                )
+            return (files, row[1]) if return_source else files
+
+    def put(self, subdir, pkg, files, source="libcfgraph"):
+        """Put the files in an artifact in the index, removing any miss.
+
+        Parameters
+        ----------
+        subdir : str
+            The subdir of the artifact.
+        pkg : str
+            The artifact file name.
+        files : list of str
+            The files in the artifact.
+        source : str, optional
+            Where the list came from, either "libcfgraph" or "download".
+        """
+        key = get_artifact_key(subdir, pkg)
+        with self._lock:
+            ids = array.array("q", self._get_path_ids(files))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?)",
+                (key, ids.tobytes(), source),
+            )
+            self._conn.execute("DELETE FROM misses WHERE artifact = ?", (key,))
+            self._maybe_commit()
+
+    def is_known_miss(self, subdir, pkg):
+        """Test if an artifact was recently found to not be in libcfgraph."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT updated FROM misses WHERE artifact = ?",
+                (get_artifact_key(subdir, pkg),),
+            ).fetchone()
+        return row is not None and time.time() - row[0] < self.miss_ttl
+
+    def add_miss(self, subdir, pkg):
+        """Record that an artifact is not in libcfgraph."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO misses VALUES (?, ?)",
+                (get_artifact_key(subdir, pkg), time.time()),
+            )
+            self._maybe_commit()
+
+    def clear_misses(self):
+        """Remove all of the recorded misses."""
+        with self._lock:
+            self._conn.execute("DELETE FROM misses")
+            self._conn.commit()
+
+    def mark_scanned(self, subdir, pkg, name, source, fingerprint):
+        """Record that an artifact was matched against a set of rules.
+
+        Parameters
+        ----------
+        subdir : str
+            The subdir of the artifact.
+        pkg : str
+            The artifact file name.
+        name : str
+            The name of the output.
+        source : str
+            Where the file list came from, either "libcfgraph" or "download".
+        fingerprint : str
+            The fingerprint of the rules.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO scanned VALUES (?, ?, ?, ?)",
+                (f"{subdir}/{pkg}", name, source, fingerprint),
+            )
+            self._maybe_commit()
+
+    def iter_scanned(self):
+        """Iterate over the (subdir/pkg, name, source, fingerprint) of the
+        scanned artifacts."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT artifact, name, source, fingerprint FROM scanned "
+                "ORDER BY artifact"
+            ).fetchall()
+        yield from rows
+
+    def set_scanned_fingerprint(self, fingerprint):
+        """Record that every scanned artifact was matched against a set of rules."""
+        with self._lock:
+            self._conn.execute("UPDATE scanned SET fingerprint = ?", (fingerprint,))
+            self._conn.commit()
+
+    def put_rules(self, rule_set):
+        """Store a set of rules under its fingerprint."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO rules VALUES (?, ?)",
+                (rule_set.fingerprint, json.dumps(rule_set.to_validate_yamls())),
+            )
+            self._conn.commit()
+
+    def get_rules(self, fingerprint):
+        """Get the validate YAMLs for a fingerprint or None if they were not stored."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT validate_yamls FROM rules WHERE fingerprint = ?",
+                (fingerprint,),
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def find_artifacts(self, path_filter):
+        """Find the artifacts with any path that passes a filter.
+
+        Each distinct path is only tested once.
+
+        Parameters
+        ----------
+        path_filter : callable
+            A function that takes a path and returns True if it is wanted.
+
+        Returns
+        -------
+        keys : set of str
+            The keys of the artifacts from `get_artifact_key`.
+        """
+        with self._lock:
+            ids = {
+                id_ for id_, path in self._conn.execute("SELECT id, path FROM paths")
+                if path_filter(path)
+            }
+            if not ids:
+                return set()
+
+            keys = set()
+            for key, blob in self._conn.execute(
+                "SELECT artifact, path_ids FROM artifacts"
+            ):
+                path_ids = array.array("q")
+                path_ids.frombytes(blob)
+                if not ids.isdisjoint(path_ids):
+                    keys.add(key)
+            return keys
+
+    def iter_paths(self, prefix, chunk_size=1000):
+        """Iterate over the distinct paths that start with `prefix` in sorted
+        order.
+
+        The paths are read in chunks using the index on the paths, so this is
+        cheap to stop early.
+        """
+        # paths are compared as utf-8 bytes, so this is the first string
+        # after all of the ones that start with the prefix
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else None
+        last = prefix
+        first = True
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT path FROM paths WHERE path %s ? %s "
+                    "ORDER BY path LIMIT ?" % (
+                        ">=" if first else ">",
+                        "" if end is None else "AND path < ?",
+                    ),
+                    (last,) + (() if end is None else (end,)) + (chunk_size,),
+                ).fetchall()
+            for row in rows:
+                yield row[0]
+            if len(rows) < chunk_size:
+                return
+            last = rows[-1][0]
+            first = False
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM artifacts").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _iter_libcfgraph_artifacts(libcfgraph_path):
+    # the blobs are at artifacts/{name}/conda-forge/{subdir}/{pkg}.json
+    root = os.path.join(libcfgraph_path, "artifacts")
+    for name_entry in os.scandir(root):
+        chan_pth = os.path.join(name_entry.path, "conda-forge")
+        if not name_entry.is_dir() or not os.path.isdir(chan_pth):
+            continue
+        for subdir_entry in os.scandir(chan_pth):
+            if not subdir_entry.is_dir():
+                continue
+            for pkg_entry in os.scandir(subdir_entry.path):
+                if pkg_entry.name.endswith(".json"):
+                    yield subdir_entry.name, pkg_entry.name, pkg_entry.path
+
+
+def build_file_index(libcfgraph_path, index, verbose=0):
+    """Add every artifact in a local checkout of libcfgraph to an index.
+
+    Any recorded misses are removed since the checkout is newer than them.
+
+    Parameters
+    ----------
+    libcfgraph_path : str
+        The path to the libcfgraph checkout.
+    index : FileListIndex
+        The index.
+    verbose : int, optional
+        If greater than zero, report progress.
+
+    Returns
+    -------
+    n_artifacts : int
+        The number of artifacts that were added.
+    """
+    index.clear_misses()
+    n_artifacts = 0
+    for subdir, pkg_json, pth in _iter_libcfgraph_artifacts(libcfgraph_path):
+        try:
+            with open(pth, "r") as fp:
+                files = json.load(fp).get("files", None)
+        except Exception:
+            files = None
+
+        if files is not None:
+            index.put(subdir, pkg_json, files)
+            n_artifacts += 1
+            if verbose > 0 and n_artifacts % 10000 == 0:
+                print("indexed %d artifacts" % n_artifacts, flush=True)
+
+    return n_artifacts
@@ -1,18 +1,35 @@
 import os
-import requests
 import re
+import gzip
+import hashlib
 import logging
+import threading
 
-import joblib
+import rapidjson as json
+import yaml
 
 from .glob_to_re import glob_to_re
-from .cached_repodata import REPODATA_CACHE
+from .compact_globs import is_dir_glob, find_unsafe_dir_globs
+from .blob_cache import fetch_blob_file_lists
+from .cached_repodata import COMPACT_REPODATA_CACHE
+from .libcfgraph_listing import load_listing
 
 LOGGER = logging.getLogger(__name__)
 
-# holds the libcfgraph file index - used for finding out which possible
-# files there are to download
+# holds the libcfgraph file index as a LibcfgraphListing - used for finding
+# out which possible files there are to download
 LIBCFGRAPH_INDEX = None
+_LIBCFGRAPH_INDEX_LOCK = threading.Lock()
+
+# a BlobCache of the file lists of the libcfgraph json blobs, if any
+BLOB_CACHE = None
+
+# a BlobFetcher shared by all of the artifacts, if any - otherwise the blobs
+# of each artifact are downloaded on their own
+BLOB_FETCHER = None
+
+# if True, only the cached libcfgraph listing, blobs and repodata are used
+OFFLINE = False
 
 # this is a default exclude set for a python package
 DEFAULT_PYTHON_GLOBS = [
@@ -39,6 +56,10 @@ DEFAULT_PYTHON_EXCLUDES = [
     "bin/python.bak",
 ]
 
+# bump this if the format of the generation state changes or if the generated
+# validate yamls need to be made again from scratch
+GENERATION_STATE_VERSION = 2
+
 
 def _get_subdir_pkg_from_libcfgraph_artifact(artifact_pth, tail):
     subdir_pkg = "/".join(artifact_pth.split('/')[-2:])
@@ -51,59 +72,66 @@ def _get_subdir_pkg_from_libcfgraph_artifact(artifact_pth, tail):
 
 def _download_libcfgraph_index():
     global LIBCFGRAPH_INDEX
-    r = requests.get(
-        "https://raw.githubusercontent.com/regro/libcfgraph"
-        "/master/.file_listing_meta.json",
-    )
-    r.raise_for_status()
-    n_files = r.json()["n_files"]
-    LIBCFGRAPH_INDEX = []
-    for i in range(n_files):
-        r = requests.get(
-            "https://raw.githubusercontent.com/regro/libcfgraph"
-            "/master/.file_listing_%d.json" % i,
-        )
-        r.raise_for_status()
-        LIBCFGRAPH_INDEX += r.json()
+    with _LIBCFGRAPH_INDEX_LOCK:
+        if LIBCFGRAPH_INDEX is None:
+            LIBCFGRAPH_INDEX = load_listing(offline=OFFLINE)
+
 
+def _get_all_json_blobs_for_artifact(artifact_name, verbose=0, seen_blobs=None):
+    """Given the name of a conda package, download all libcfgraph entries for it.
 
-def _get_all_json_blobs_for_artifact(artifact_name, verbose=0):
-    """Given the name of a conda package, download all libcfgraph entries for it."""
+    If `seen_blobs` is given, the libcfgraph paths in it are skipped and the
+    paths of the entries that are returned are added to it.
+    """
     global LIBCFGRAPH_INDEX
     if LIBCFGRAPH_INDEX is None:
         _download_libcfgraph_index()
 
-    sentinel = os.path.join("artifacts", artifact_name) + "/"
-    artifact_pths = [pth for pth in LIBCFGRAPH_INDEX if pth.startswith(sentinel)]
-
-    def _download_jsob_blob(artifact_pth, tail):
-        # ignore things not on the main channel
-        subdir, pkg = _get_subdir_pkg_from_libcfgraph_artifact(artifact_pth, tail)
-        if pkg not in REPODATA_CACHE[subdir]["packages"]:
-            return None
-
-        try:
-            r = requests.get(
-                "https://raw.githubusercontent.com/regro/libcfgraph/master/"
-                f"{artifact_pth}"
+    artifact_pths = LIBCFGRAPH_INDEX.get_artifact_paths(artifact_name)
+
+    # ignore things not on the main channel or already seen
+    artifact_pths = [
+        pth for pth in artifact_pths
+        if (seen_blobs is None or pth not in seen_blobs)
+        and any(
+            pkg in COMPACT_REPODATA_CACHE.load(subdir, offline=OFFLINE)
+            for subdir, pkg in (
+                _get_subdir_pkg_from_libcfgraph_artifact(pth, tail)
+                for tail in [".tar.bz2", ".conda"]
             )
-            r.raise_for_status()
-            return r.json()
-        except Exception:
-            return None
-
-    jobs = []
-    for artifact_pth in artifact_pths:
-        for tail in [".tar.bz2", ".conda"]:
-            jobs.append(joblib.delayed(_download_jsob_blob)(artifact_pth, tail))
+        )
+    ]
 
-    artifacts = joblib.Parallel(n_jobs=5, backend="threading", verbose=verbose)(jobs)
+    if BLOB_FETCHER is not None:
+        file_lists = BLOB_FETCHER.fetch(artifact_pths)
+    else:
+        file_lists = fetch_blob_file_lists(
+            artifact_pths, cache=BLOB_CACHE, offline=OFFLINE,
+        )
+    if verbose > 0:
+        print(
+            "got %d of %d json blobs for %s" % (
+                sum(files is not None for files in file_lists.values()),
+                len(file_lists),
+                artifact_name,
+            ),
+            flush=True,
+        )
 
-    return [a for a in artifacts if a is not None]
+    blobs = [
+        {"files": files}
+        for _, files in sorted(file_lists.items())
+        if files is not None
+    ]
+    if seen_blobs is not None:
+        seen_blobs.update(
+            pth for pth, files in file_lists.items() if files is not None
+        )
+    return blobs
 
 
 def generate_validate_yaml_from_libcfgraph(
-    artifact_name, exclude_globs=None, verbose=0
+    artifact_name, exclude_globs=None, verbose=0, seen_blobs=None,
 ):
     """Generate a validation YAML file from an artifact using libcfgraph.
 
@@ -121,8 +149,12 @@ def generate_validate_yaml_from_libcfgraph(
         If given, any file in artifact that would be matched by any of the glob
         patterns will be excluded.
     verbose : int, optional
-        Integer between 0 and 100. Passed to joblib. Zero produces no output (default)
-        and 100 produces the maximum amount of output.
+        If greater than zero, print how many libcfgraph json blobs were found.
+        Zero produces no output (default).
+    seen_blobs : set of str, optional
+        If given, the libcfgraph json blobs in this set are skipped and the
+        paths of the blobs that are used are added to it. This is used to only
+        add the files from new artifacts to a validate YAML.
 
     Returns
     -------
@@ -137,7 +169,9 @@ def generate_validate_yaml_from_libcfgraph(
     LOGGER.debug("using %s regexes for %s", re_patt_comps, artifact_name)
 
     # get all json blobs for artifact
-    blobs = _get_all_json_blobs_for_artifact(artifact_name, verbose=verbose)
+    blobs = _get_all_json_blobs_for_artifact(
+        artifact_name, verbose=verbose, seen_blobs=seen_blobs,
+    )
     LOGGER.debug("found %s json blobs for %s", len(blobs), artifact_name)
 
     # now find any files not matched by the excluide_globs, if any
@@ -161,6 +195,7 @@ def generate_validate_yaml_for_python(
     allowed=None,
     exclude_files=None,
     verbose=0,
+    seen_blobs=None,
 ):
     """Generate a validation YAML file from an artifact that is a python package.
 
@@ -184,8 +219,12 @@ def generate_validate_yaml_for_python(
         Any files matching these glob patterns will not be added to the list of
         files in the outputs.
     verbose : int, optional
-        Integer between 0 and 100. Passed to joblib. Zero produces no output (default)
-        and 100 produces the maximum amount of output.
+        If greater than zero, print how many libcfgraph json blobs were found.
+        Zero produces no output (default).
+    seen_blobs : set of str, optional
+        If given, the libcfgraph json blobs in this set are skipped and the
+        paths of the blobs that are used are added to it. See
+        `generate_validate_yaml_from_libcfgraph`.
 
     Returns
     -------
@@ -193,10 +232,9 @@ def generate_validate_yaml_for_python(
         A dictionary with the contents of the validate YAML file.
     """
     allowed = allowed or []
-    exclude_files = exclude_files or []
 
     # add in the defaults that any python package is allowed to write
-    exclude_files += DEFAULT_PYTHON_EXCLUDES
+    exclude_files = (exclude_files or []) + DEFAULT_PYTHON_EXCLUDES
 
     # first make the default globs
     default_globs = []
@@ -208,6 +246,7 @@ def generate_validate_yaml_for_python(
         artifact_name,
         exclude_globs=default_globs + exclude_files,
         verbose=verbose,
+        seen_blobs=seen_blobs,
     )
 
     validate_yaml["files"].extend(default_globs)
@@ -218,3 +257,179 @@ def generate_validate_yaml_for_python(
         validate_yaml[key] = sorted(list(set(validate_yaml[key])))
 
     return validate_yaml
+
+
+def get_source_fingerprint(source):
+    """Get a fingerprint of the source of a generated validate YAML.
+
+    The source is the entry in `validate_yamls/` or `python_packages.yaml`.
+    The default python globs and excludes are included since they change
+    the output too.
+    """
+    data = json.dumps(
+        {
+            "source": source,
+            "python_globs": DEFAULT_PYTHON_GLOBS,
+            "python_excludes": DEFAULT_PYTHON_EXCLUDES,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def load_generation_state(path):
+    """Load the state of previous runs of the generator.
+
+    Returns
+    -------
+    state : dict
+        A dictionary mapping the path of each generated validate YAML to a
+        dictionary with the "fingerprint" of its source, the libcfgraph json
+        "blobs" whose files are in it and its "files" before they were
+        compacted. This is empty if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return {}
+
+    with gzip.open(path, "rt") as fp:
+        data = json.load(fp)
+
+    if data.get("version", None) != GENERATION_STATE_VERSION:
+        print("ignoring generation state in %s with old format" % path, flush=True)
+        return {}
+
+    return data["targets"]
+
+
+def save_generation_state(path, state):
+    """Save the state of the generator. See `load_generation_state`."""
+    tmp_pth = path + ".tmp"
+    with gzip.open(tmp_pth, "wt") as fp:
+        json.dump({"version": GENERATION_STATE_VERSION, "targets": state}, fp)
+    os.replace(tmp_pth, path)
+
+
+def start_target(state, target, fingerprint):
+    """Find what is left to do for a generated validate YAML.
+
+    Parameters
+    ----------
+    state : dict or None
+        The generation state from `load_generation_state`, if any.
+    target : str
+        The path of the generated validate YAML.
+    fingerprint : str
+        The fingerprint of its source from `get_source_fingerprint`.
+
+    Returns
+    -------
+    seen_blobs : set of str or None
+        The libcfgraph json blobs already in the validate YAML. This is None if
+        there is no state.
+    replace : bool
+        If True, the source changed and the validate YAML should be replaced
+        instead of added to.
+    files : list of str or None
+        The files already in the validate YAML before they were compacted, or
+        None if they are not known. Every json blob is read again when they
+        are not known.
+    """
+    if state is None:
+        return None, False, None
+
+    entry = state.get(target, None)
+    if entry is None:
+        # we do not know what made the file so it is only added to
+        return set(), False, None
+    elif entry["fingerprint"] != fingerprint:
+        return set(), True, None
+    else:
+        return set(entry["blobs"]), False, entry["files"]
+
+
+def finish_target(state, target, fingerprint, seen_blobs, files):
+    """Record the libcfgraph json blobs that are in a generated validate YAML
+    and its files before they were compacted."""
+    if state is not None:
+        state[target] = {
+            "fingerprint": fingerprint,
+            "blobs": sorted(seen_blobs),
+            "files": sorted(files),
+        }
+
+
+def merge_generated_validate_yaml(
+    validate_yaml_path, validate_yaml, old_files=None, iter_known_paths=None,
+):
+    """Add what is in a generated validate YAML from an earlier run to a new one.
+
+    The files written by an earlier run may have been compacted into
+    directory globs by `compact_files`, so they are not trusted as is. If the
+    files from before compaction are known from the generation state, they
+    are used instead. Otherwise every json blob was read again, so the new
+    validate YAML has all of the literal paths. Then the directory globs that
+    this run did not make are kept only if they still match no known path
+    outside of the literal paths. If one of them does, the old validate YAML
+    is dropped and the new one is used as is.
+
+    Parameters
+    ----------
+    validate_yaml_path : str
+        The path of the validate YAML written by the earlier run. It does not
+        need to exist.
+    validate_yaml : dict
+        The new validate YAML.
+    old_files : list of str, optional
+        The files of the earlier run before they were compacted from
+        `start_target`, if they are known.
+    iter_known_paths : callable, optional
+        A function that takes a prefix and returns an iterable of all of the
+        known paths that start with it (e.g., `FileListIndex.iter_paths`). If
+        not given, directory globs from an earlier run cannot be checked and
+        so are never kept.
+
+    Returns
+    -------
+    validate_yaml : dict
+        The merged validate YAML. The files are not compacted.
+    files : list of str
+        The files to record in the generation state. These are the merged
+        files without any directory globs from an earlier run.
+    """
+    old_validate_yaml = None
+    if os.path.exists(validate_yaml_path):
+        with open(validate_yaml_path, "r") as fp:
+            old_validate_yaml = yaml.safe_load(fp)
+
+    files = set(validate_yaml["files"])
+    allowed = set(validate_yaml["allowed"])
+    kept_globs = set()
+    if old_files is not None:
+        files.update(old_files)
+    elif old_validate_yaml is not None:
+        old = set(old_validate_yaml["files"])
+        old_globs = sorted(f for f in old - files if is_dir_glob(f))
+        if iter_known_paths is None:
+            unsafe = old_globs
+        else:
+            unsafe = find_unsafe_dir_globs(old_globs, files | old, iter_known_paths)
+
+        if unsafe:
+            print(
+                "making %s from scratch since these globs match other files: %s" % (
+                    validate_yaml_path, unsafe,
+                ),
+                flush=True,
+            )
+            old_validate_yaml = None
+        else:
+            files.update(old)
+            kept_globs.update(old_globs)
+
+    if old_validate_yaml is not None:
+        allowed.update(old_validate_yaml["allowed"])
+
+    return (
+        {"files": sorted(files), "allowed": sorted(allowed)},
+        sorted(files - kept_globs),
+    )
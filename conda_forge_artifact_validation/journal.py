@@ -0,0 +1,124 @@
+import json
+import os
+import threading
+
+
+class ScanJournal:
+    """An append-only journal of the artifacts finished by a scan.
+
+    Each result is written as a line of JSON as soon as it is recorded, so a
+    scan that is stopped or killed can be restarted with exactly the
+    artifacts that were done skipped and its results rebuilt from the journal.
+    A partial line left by a process that was killed while writing is dropped
+    when the journal is opened.
+
+    The journal is safe to use from multiple threads.
+
+    Parameters
+    ----------
+    path : str
+        The path to the journal. It is created if it does not exist.
+    sync_every : int, optional
+        Flush the journal to disk with `fsync` after this many new results. Each
+        result is always flushed to the operating system when it is recorded.
+
+    Attributes
+    ----------
+    done : set of str
+        The artifacts (e.g., `linux-64/numpy-...`) in the journal.
+    invalid : dict
+        A dictionary mapping the name of each output to a dictionary of its
+        invalid artifacts in the journal and their bad paths, in the same format
+        as the scan data.
+    """
+    def __init__(self, path, sync_every=64):
+        self.path = path
+        self.sync_every = sync_every
+        self.done = set()
+        self.invalid = {}
+        self._n_unsynced = 0
+        self._lock = threading.Lock()
+
+        self._load()
+        self._fp = open(path, "a")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rb") as fp:
+            data = fp.read()
+
+        # drop anything after the last complete line
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            with open(self.path, "r+b") as fp:
+                fp.truncate(end)
+
+        for line in data[:end].splitlines():
+            self._add(json.loads(line))
+
+    def _add(self, entry):
+        artifact = f"{entry['subdir']}/{entry['pkg']}"
+        self.done.add(artifact)
+        if not entry["valid"]:
+            self.invalid.setdefault(entry["name"], {})[artifact] = {
+                "bad_paths": entry["bad_paths"],
+            }
+
+    def __contains__(self, artifact):
+        return artifact in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def record(self, subdir, pkg, name, valid, bad_paths):
+        """Record the final result for an artifact.
+
+        Parameters
+        ----------
+        subdir : str
+            The subdir of the artifact.
+        pkg : str
+            The artifact file name.
+        name : str
+            The name of the output.
+        valid : bool
+            If the artifact is valid.
+        bad_paths : dict
+            The bad paths of the artifact.
+        """
+        entry = {
+            "subdir": subdir,
+            "pkg": pkg,
+            "name": name,
+            "valid": bool(valid),
+            "bad_paths": bad_paths,
+        }
+        with self._lock:
+            self._fp.write(json.dumps(entry, sort_keys=True) + "\n")
+            self._fp.flush()
+            self._add(entry)
+            self._n_unsynced += 1
+            if self._n_unsynced >= self.sync_every:
+                os.fsync(self._fp.fileno())
+                self._n_unsynced = 0
+
+    def close(self):
+        with self._lock:
+            if not self._fp.closed:
+                self._fp.flush()
+                os.fsync(self._fp.fileno())
+                self._fp.close()
+
+    def clear(self):
+        """Close and remove the journal, e.g., once a scan is complete."""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
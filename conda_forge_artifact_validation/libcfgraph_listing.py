@@ -0,0 +1,253 @@
+import os
+import mmap
+import time
+import struct
+import bisect
+import logging
+import tempfile
+import concurrent.futures
+
+import rapidjson as json
+
+from .download import get_session, TIMEOUT
+
+LOGGER = logging.getLogger(__name__)
+
+LIBCFGRAPH_URL = "https://raw.githubusercontent.com/regro/libcfgraph/master"
+
+# the listing is cached here across runs - set the environment variable to an
+# empty string to turn this off
+LISTING_CACHE_DIR = os.environ.get(
+    "CF_ARTIFACT_VALIDATION_LIBCFGRAPH_CACHE_DIR",
+    os.path.join(
+        os.path.expanduser("~"), ".cache", "conda-forge-artifact-validation",
+        "libcfgraph",
+    ),
+)
+
+# how old a cached listing can be before it is downloaded again
+DEFAULT_MAX_AGE = 24 * 3600
+
+# the file starts with this and the number of paths as a little-endian uint64,
+# then has the offset of each path in the data and the end of the data as
+# little-endian uint64s and then the sorted paths encoded as utf-8
+_MAGIC = b"CFLIST01"
+_HEADER = struct.Struct("<8sQ")
+_OFFSET = struct.Struct("<Q")
+
+
+class _Offsets:
+    """A read-only sequence of the uint64 offsets in a memory-mapped listing."""
+    def __init__(self, buf, start, n):
+        self._buf = buf
+        self._start = start
+        self._n = n
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, i):
+        return _OFFSET.unpack_from(self._buf, self._start + i * _OFFSET.size)[0]
+
+
+class _Keys:
+    """A sequence of the paths in a listing as bytes for `bisect`."""
+    def __init__(self, listing):
+        self._listing = listing
+
+    def __len__(self):
+        return len(self._listing)
+
+    def __getitem__(self, i):
+        return self._listing._get_bytes(i)
+
+
+class LibcfgraphListing:
+    """A sorted listing of the artifact JSON blobs in libcfgraph.
+
+    The listing is stored on disk in a compact binary format that is
+    memory-mapped, so that opening it is cheap and only the pages that are
+    used are read. The paths are sorted, so the blobs of an artifact are
+    next to each other and are found with a binary search.
+
+    Parameters
+    ----------
+    path : str
+        The path to a listing written by `write_listing`.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC:
+            self._mmap.close()
+            raise ValueError("%s is not a libcfgraph listing" % path)
+        self._n = n
+        self._offsets = _Offsets(self._mmap, _HEADER.size, n + 1)
+        self._data_start = _HEADER.size + (n + 1) * _OFFSET.size
+
+    def __len__(self):
+        return self._n
+
+    def _get_bytes(self, i):
+        start = self._data_start + self._offsets[i]
+        end = self._data_start + self._offsets[i + 1]
+        return self._mmap[start:end]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError("listing index out of range")
+        return self._get_bytes(i).decode("utf-8")
+
+    def __iter__(self):
+        for i in range(self._n):
+            yield self._get_bytes(i).decode("utf-8")
+
+    def iter_prefix(self, prefix):
+        """Iterate over the paths that start with `prefix` in sorted order."""
+        prefix = prefix.encode("utf-8")
+        # the keys are only read for the O(log n) probes of the search
+        keys = _Keys(self)
+        i = bisect.bisect_left(keys, prefix)
+        while i < self._n:
+            pth = self._get_bytes(i)
+            if not pth.startswith(prefix):
+                break
+            yield pth.decode("utf-8")
+            i += 1
+
+    def get_artifact_paths(self, artifact_name):
+        """Get the paths of all of the JSON blobs of an artifact."""
+        return list(self.iter_prefix("artifacts/%s/" % artifact_name))
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_listing(paths, path):
+    """Write a listing of libcfgraph paths to disk for `LibcfgraphListing`.
+
+    The paths are sorted and duplicates are removed. The file is written
+    atomically.
+
+    Parameters
+    ----------
+    paths : iterable of str
+        The paths in libcfgraph (e.g., `artifacts/foo/conda-forge/noarch/...`).
+    path : str
+        The path of the file to write.
+
+    Returns
+    -------
+    n_paths : int
+        The number of paths written.
+    """
+    data = [pth.encode("utf-8") for pth in sorted(set(paths))]
+    offsets = [0]
+    for pth in data:
+        offsets.append(offsets[-1] + len(pth))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp%d" % os.getpid()
+    with open(tmp_path, "wb") as fp:
+        fp.write(_HEADER.pack(_MAGIC, len(data)))
+        fp.write(struct.pack("<%dQ" % len(offsets), *offsets))
+        for pth in data:
+            fp.write(pth)
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+def download_listing(path, url=LIBCFGRAPH_URL, n_jobs=8):
+    """Download the libcfgraph file listing and write it to `path`.
+
+    The shards of the listing are downloaded concurrently with the shared
+    connection pool.
+
+    Parameters
+    ----------
+    path : str
+        The path of the file to write.
+    url : str, optional
+        The URL of libcfgraph.
+    n_jobs : int, optional
+        The number of shards to download at once.
+
+    Returns
+    -------
+    n_paths : int
+        The number of paths in the listing.
+    """
+    session = get_session()
+
+    def _get_json(name):
+        r = session.get("%s/%s" % (url, name), timeout=TIMEOUT)
+        r.raise_for_status()
+        return json.loads(r.content)
+
+    n_files = _get_json(".file_listing_meta.json")["n_files"]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        shards = executor.map(
+            _get_json, [".file_listing_%d.json" % i for i in range(n_files)],
+        )
+        paths = [pth for shard in shards for pth in shard]
+
+    LOGGER.debug("downloaded %d libcfgraph paths in %d shards", len(paths), n_files)
+    return write_listing(paths, path)
+
+
+def load_listing(
+    cache_dir=None, url=LIBCFGRAPH_URL, max_age=DEFAULT_MAX_AGE, n_jobs=8,
+    offline=False,
+):
+    """Get the libcfgraph listing, downloading it if the cache is stale.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        The directory to cache the listing in. Defaults to `LISTING_CACHE_DIR`.
+        If it is empty, the listing is written to a temporary file that is
+        removed once it is opened.
+    url : str, optional
+        The URL of libcfgraph.
+    max_age : float, optional
+        The time in seconds a cached listing is used for.
+    n_jobs : int, optional
+        The number of shards to download at once.
+    offline : bool, optional
+        If True, the cached listing is used no matter how old it is.
+
+    Returns
+    -------
+    listing : LibcfgraphListing
+        The listing.
+    """
+    if cache_dir is None:
+        cache_dir = LISTING_CACHE_DIR
+
+    if offline:
+        path = os.path.join(cache_dir, "file_listing.bin") if cache_dir else ""
+        if not os.path.exists(path):
+            raise RuntimeError("there is no cached libcfgraph listing to use offline")
+        return LibcfgraphListing(path)
+
+    if not cache_dir:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "file_listing.bin")
+            download_listing(path, url=url, n_jobs=n_jobs)
+            # the mapping keeps the data after the file is removed
+            return LibcfgraphListing(path)
+
+    path = os.path.join(cache_dir, "file_listing.bin")
+    if not os.path.exists(path) or time.time() - os.path.getmtime(path) > max_age:
+        download_listing(path, url=url, n_jobs=n_jobs)
+    return LibcfgraphListing(path)
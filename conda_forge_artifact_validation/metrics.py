@@ -0,0 +1,190 @@
+import time
+import threading
+import contextlib
+from collections import defaultdict
+
+import rapidjson as json
+
+# the prefix of the metric names in the Prometheus text format
+PROMETHEUS_PREFIX = "cf_artifact_validation"
+
+
+class Metrics:
+    """Timings and counters for the stages of validating artifacts.
+
+    Each stage records how many times it ran and the total and largest time
+    it took. Counters hold everything else, like the bytes downloaded or the
+    hits and misses of a cache. A pair of counters named `{name}_hits` and
+    `{name}_misses` is reported as a hit rate.
+
+    The metrics are safe to update from multiple threads. Worker processes
+    keep their own metrics, which are sent back with their results and
+    merged in with `merge`.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clear all of the metrics and restart the wall clock."""
+        with self._lock:
+            self.start_time = time.time()
+            # stage -> [count, total seconds, max seconds]
+            self.stages = {}
+            self.counters = defaultdict(int)
+
+    def add_time(self, stage, seconds):
+        """Record a run of a stage that took `seconds`."""
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = [0, 0.0, 0.0]
+            data = self.stages[stage]
+            data[0] += 1
+            data[1] += seconds
+            data[2] = max(data[2], seconds)
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        """Time the body of a `with` statement as a run of a stage."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - t0)
+
+    def count(self, name, value=1):
+        """Add `value` to a counter."""
+        with self._lock:
+            self.counters[name] += value
+
+    def snapshot(self, reset=False):
+        """Get a copy of the stages and counters that can be pickled.
+
+        If `reset` is True, the metrics are cleared at the same time.
+        """
+        with self._lock:
+            data = {
+                "stages": {k: list(v) for k, v in self.stages.items()},
+                "counters": dict(self.counters),
+            }
+            if reset:
+                self.stages = {}
+                self.counters = defaultdict(int)
+        return data
+
+    def merge(self, snapshot):
+        """Add the metrics from a `snapshot` of another process."""
+        with self._lock:
+            for stage, (count, total, max_) in snapshot["stages"].items():
+                if stage not in self.stages:
+                    self.stages[stage] = [0, 0.0, 0.0]
+                data = self.stages[stage]
+                data[0] += count
+                data[1] += total
+                data[2] = max(data[2], max_)
+            for name, value in snapshot["counters"].items():
+                self.counters[name] += value
+
+    def to_dict(self):
+        """Get the metrics as a dictionary that can be dumped to JSON."""
+        snapshot = self.snapshot()
+        wall = max(time.time() - self.start_time, 1e-9)
+        counters = snapshot["counters"]
+
+        hit_rates = {}
+        for name in counters:
+            if name.endswith("_hits"):
+                base = name[:-len("_hits")]
+                total = counters[name] + counters.get(base + "_misses", 0)
+                hit_rates[base] = counters[name] / total if total > 0 else 0.0
+
+        return {
+            "wall_seconds": wall,
+            "artifacts_per_second": counters.get("artifacts", 0) / wall,
+            "stages": {
+                stage: {
+                    "count": count,
+                    "total_seconds": total,
+                    "mean_seconds": total / count if count > 0 else 0.0,
+                    "max_seconds": max_,
+                }
+                for stage, (count, total, max_) in sorted(snapshot["stages"].items())
+            },
+            "counters": dict(sorted(counters.items())),
+            "hit_rates": dict(sorted(hit_rates.items())),
+        }
+
+    def to_prometheus(self):
+        """Get the metrics in the Prometheus text exposition format."""
+        data = self.to_dict()
+        p = PROMETHEUS_PREFIX
+        lines = [
+            "# TYPE %s_wall_seconds gauge" % p,
+            "%s_wall_seconds %r" % (p, data["wall_seconds"]),
+            "# TYPE %s_artifacts_per_second gauge" % p,
+            "%s_artifacts_per_second %r" % (p, data["artifacts_per_second"]),
+        ]
+
+        for name, typ, field in [
+            ("stage_seconds_total", "counter", "total_seconds"),
+            ("stage_runs_total", "counter", "count"),
+            ("stage_max_seconds", "gauge", "max_seconds"),
+        ]:
+            lines.append("# TYPE %s_%s %s" % (p, name, typ))
+            for stage, stage_data in data["stages"].items():
+                lines.append(
+                    '%s_%s{stage="%s"} %r' % (p, name, stage, stage_data[field])
+                )
+
+        for name, value in data["counters"].items():
+            lines.append("# TYPE %s_%s_total counter" % (p, name))
+            lines.append("%s_%s_total %r" % (p, name, value))
+
+        lines.append("# TYPE %s_hit_rate gauge" % p)
+        for name, value in data["hit_rates"].items():
+            lines.append('%s_hit_rate{cache="%s"} %r' % (p, name, value))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Get a human readable summary of the metrics."""
+        data = self.to_dict()
+        lines = [
+            "wall time: %.2f seconds" % data["wall_seconds"],
+            "artifacts/second: %.2f" % data["artifacts_per_second"],
+        ]
+        if data["stages"]:
+            lines.append(
+                "%-24s %10s %12s %12s %12s" % (
+                    "stage", "runs", "total [s]", "mean [ms]", "max [s]",
+                )
+            )
+            for stage, stage_data in data["stages"].items():
+                lines.append(
+                    "%-24s %10d %12.2f %12.2f %12.2f" % (
+                        stage,
+                        stage_data["count"],
+                        stage_data["total_seconds"],
+                        stage_data["mean_seconds"] * 1000,
+                        stage_data["max_seconds"],
+                    )
+                )
+        for name, value in data["counters"].items():
+            lines.append("%s: %s" % (name, value))
+        for name, value in data["hit_rates"].items():
+            lines.append("%s hit rate: %.1f%%" % (name, value * 100))
+        return "\n".join(lines)
+
+    def write(self, path):
+        """Write the metrics to `path` as JSON if it ends in `.json` and in the
+        Prometheus text format otherwise."""
+        if path.endswith(".json"):
+            text = json.dumps(self.to_dict(), indent=2)
+        else:
+            text = self.to_prometheus()
+        with open(path, "w") as fp:
+            fp.write(text)
+
+
+# the metrics of this process
+METRICS = Metrics()
@@ -0,0 +1,482 @@
+import time
+import queue
+import threading
+import functools
+from collections import OrderedDict, deque
+
+from .scan import (
+    get_libcfgraph_file_list,
+    match_file_list,
+    match_file_list_in_worker,
+    download_and_validate_artifact,
+    download_and_validate_artifact_in_worker,
+)
+from .metrics import METRICS
+
+# how long blocked threads wait before checking if the pipeline was stopped
+_POLL_INTERVAL = 0.1
+
+# the largest artifact in bytes for each lane - anything bigger is huge
+LANE_SIZES = [
+    ("small", 16 * 1024**2),
+    ("medium", 256 * 1024**2),
+]
+HUGE_LANE = "huge"
+
+# the default limit on the total size of the artifacts being downloaded at once
+DEFAULT_MAX_BYTES = 4 * 1024**3
+
+# returned by a lookup when the file list was sent to the executor for matching
+_SUBMITTED = object()
+
+
+def get_lane(size):
+    """Get the lane for an artifact from its size in bytes."""
+    for lane, max_size in LANE_SIZES:
+        if size <= max_size:
+            return lane
+    return HUGE_LANE
+
+
+class _ByteBudget:
+    """A limit on the total bytes in flight.
+
+    An artifact bigger than the whole budget can run once nothing else is in
+    flight. The budget is not locked, so the caller has to hold a lock.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+
+    def fits(self, n_bytes):
+        return self.in_flight == 0 or self.in_flight + n_bytes <= self.max_bytes
+
+    def acquire(self, n_bytes):
+        self.in_flight += n_bytes
+
+    def release(self, n_bytes):
+        self.in_flight -= n_bytes
+
+
+class ScanPipeline:
+    """A streaming pipeline that validates artifacts as soon as workers are free.
+
+    Artifacts flow through three stages:
+
+    1. lookup: threads take artifacts from a bounded queue, check the result
+       cache and libcfgraph for each one and match the file list if it is
+       found - right away with threads or in the executor with processes, so
+       that the matching is not held up by the GIL
+    2. download: the remaining artifacts are downloaded, inspected and matched
+       by the executor, with at most `max_downloads` of them in flight
+    3. record: the results are yielded by `run` in the order they finish
+
+    There are no barriers between artifacts, so a slow artifact only holds up
+    the worker it is on. Downloads are also routed into small, medium and huge
+    lanes by their size in the repodata. Each lane has its own queue and its
+    own limit on the number of artifacts in flight and all of them share a
+    limit on the total bytes in flight, so that a few multi-GB artifacts do
+    not exhaust the disk or memory while the small ones keep flowing. The
+    lookup threads only put artifacts in the lane queues and a dispatcher
+    thread starts the oldest artifact at the front of a lane with a free slot.
+    So a queue of huge artifacts never holds up the other lanes, while an
+    artifact waiting for bytes is not starved by a stream of smaller ones.
+
+    Parameters
+    ----------
+    executor : concurrent.futures.Executor
+        The executor for the download stage from `make_executor`.
+    rule_set : RuleSet
+        The rules.
+    libcfgraph_path : str or None
+        The path to a local checkout of libcfgraph.
+    backend : str, optional
+        The backend of the executor. Jobs sent to processes use the rules
+        loaded by each worker. With processes, at most `max_downloads` file
+        lists from the lookup stage wait in the executor to be matched.
+    verbose : int, optional
+        The verbosity level.
+    range_requests : bool, optional
+        If True, only fetch the info of `.conda` artifacts with HTTP range
+        requests.
+    result_cache : ResultCache, optional
+        If given, results in the cache are used instead of validating the
+        artifact again.
+    file_index : FileListIndex, optional
+        If given, file lists are looked up in the index before libcfgraph. The
+        lists of downloaded artifacts are added to it and every artifact that
+        is matched is marked as scanned with the current rules.
+    n_lookup : int, optional
+        The number of lookup threads.
+    max_downloads : int, optional
+        The maximum number of artifacts in the download stage at once.
+    max_queued : int, optional
+        The size of the queue of artifacts waiting for the lookup stage.
+    lane_limits : dict, optional
+        The maximum number of artifacts in flight for each lane. Defaults to
+        `max_downloads` for small artifacts, a quarter of that for medium
+        ones and one for huge ones.
+    max_bytes : int, optional
+        The maximum total size of the artifacts in the download stage at once.
+        Defaults to `DEFAULT_MAX_BYTES`.
+    """
+    def __init__(
+        self, executor, rule_set, libcfgraph_path, backend="threading", verbose=0,
+        range_requests=False, result_cache=None, file_index=None, n_lookup=8,
+        max_downloads=16, max_queued=256, lane_limits=None, max_bytes=None,
+    ):
+        self.executor = executor
+        self.rule_set = rule_set
+        self.libcfgraph_path = libcfgraph_path
+        self.backend = backend
+        self.verbose = verbose
+        self.range_requests = range_requests
+        self.result_cache = result_cache
+        self.file_index = file_index
+        self.n_lookup = n_lookup
+        self.lane_limits = {
+            "small": max_downloads,
+            "medium": max(max_downloads // 4, 1),
+            HUGE_LANE: 1,
+        }
+        self.lane_limits.update(lane_limits or {})
+        self.max_bytes = max_bytes or DEFAULT_MAX_BYTES
+
+        self._lookup_queue = queue.Queue(maxsize=max_queued)
+        # results are only held until the caller takes them so this can be
+        # unbounded, which means the stages never block on the caller
+        self._result_queue = queue.Queue()
+        self.max_downloads = max_downloads
+
+        # the state of the download stage, which is guarded by the condition
+        self._cond = threading.Condition()
+        # the lane queues hold (number, enqueue time, n_bytes, item) - they
+        # are not bounded so that the lookup threads never block on a lane
+        self._lane_queues = {lane: deque() for lane in self.lane_limits}
+        self._lane_active = {lane: 0 for lane in self.lane_limits}
+        self._n_active = 0
+        self._n_enqueued = 0
+        self._n_lookups_running = 0
+        self._bytes = _ByteBudget(self.max_bytes)
+        self._match_slots = threading.BoundedSemaphore(max_downloads)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._futures = set()
+        # artifacts that have been taken from the input but have no result yet
+        self._unfinished = OrderedDict()
+        self._n_fed = None
+
+    def stop(self):
+        """Stop the pipeline.
+
+        No new artifacts are started, but the ones being validated are
+        finished and yielded by `run`.
+        """
+        self._stop.set()
+        with self._lock:
+            futures = list(self._futures)
+        for fut in futures:
+            fut.cancel()
+
+    def oldest_unfinished(self):
+        """Get the (subdir, pkg) of the first artifact from the input without a
+        result, or None if there is none."""
+        with self._lock:
+            return next(iter(self._unfinished), None)
+
+    def _put(self, q, item):
+        while True:
+            try:
+                q.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                if self._stop.is_set():
+                    return False
+
+    def _feed(self, artifacts):
+        n_fed = 0
+        try:
+            for subdir, pkg, rec in artifacts:
+                with self._lock:
+                    self._unfinished[(subdir, pkg)] = None
+                if self._stop.is_set() or not self._put(
+                    self._lookup_queue, (subdir, pkg, rec),
+                ):
+                    break
+                n_fed += 1
+        except Exception as e:
+            self._result_queue.put(("error", e))
+        finally:
+            for _ in range(self.n_lookup):
+                self._lookup_queue.put(None)
+            self._n_fed = n_fed
+
+    def _lookup_one(self, item):
+        subdir, pkg, rec = item
+        if self.result_cache is not None:
+            with METRICS.time("result_cache_lookup"):
+                res = self.result_cache.get(rec.md5, self.rule_set.fingerprint)
+            if res is not None:
+                return res, True
+
+        data, source = get_libcfgraph_file_list(
+            rec.name, subdir, pkg, self.libcfgraph_path, file_index=self.file_index,
+            return_source=True,
+        )
+        if data is not None:
+            if self.file_index is not None:
+                self.file_index.mark_scanned(
+                    subdir, pkg, rec.name, source, self.rule_set.fingerprint,
+                )
+            if self.backend != "threading":
+                self._submit_match(item, data, source)
+                return _SUBMITTED, False
+            # lists from earlier downloads are matched like the download was
+            return match_file_list(self.rule_set, rec.name, data, source), False
+
+        return None, False
+
+    def _lookup(self):
+        try:
+            while True:
+                item = self._lookup_queue.get()
+                if item is None:
+                    break
+
+                if self._stop.is_set():
+                    self._result_queue.put(("skipped", item))
+                    continue
+
+                try:
+                    res, cached = self._lookup_one(item)
+                except Exception as e:
+                    self._result_queue.put(("error", e))
+                    continue
+
+                if res is _SUBMITTED:
+                    continue
+                elif res is not None:
+                    self._result_queue.put(("done", item, res, cached))
+                else:
+                    self._enqueue(item)
+        finally:
+            with self._cond:
+                self._n_lookups_running -= 1
+                self._cond.notify_all()
+
+    def _submit_match(self, item, files, source):
+        # the slots bound the file lists waiting in the executor
+        while not self._match_slots.acquire(timeout=_POLL_INTERVAL):
+            if self._stop.is_set():
+                self._result_queue.put(("skipped", item))
+                return
+
+        if self._stop.is_set():
+            self._match_slots.release()
+            self._result_queue.put(("skipped", item))
+            return
+
+        try:
+            fut = self.executor.submit(
+                match_file_list_in_worker, item[2].name, files, source,
+            )
+        except RuntimeError:
+            # the executor was shut down
+            self._match_slots.release()
+            self._result_queue.put(("skipped", item))
+        else:
+            with self._lock:
+                self._futures.add(fut)
+            fut.add_done_callback(functools.partial(self._match_done, item))
+
+    def _match_done(self, item, fut):
+        with self._lock:
+            self._futures.discard(fut)
+        self._match_slots.release()
+
+        if fut.cancelled():
+            self._result_queue.put(("skipped", item))
+        elif fut.exception() is not None:
+            self._result_queue.put(("error", fut.exception()))
+        else:
+            res, metrics = fut.result()
+            METRICS.merge(metrics)
+            self._result_queue.put(("done", item, res, False))
+
+    def _enqueue(self, item):
+        n_bytes = max(item[2].size, 0)
+        with self._cond:
+            self._lane_queues[get_lane(n_bytes)].append(
+                (self._n_enqueued, time.perf_counter(), n_bytes, item)
+            )
+            self._n_enqueued += 1
+            self._cond.notify_all()
+
+    def _next_download(self):
+        # the oldest artifact at the front of a lane with a free slot is
+        # started once it fits in the byte budget - younger artifacts wait
+        # behind it so that it is not starved
+        if self._n_active >= self.max_downloads:
+            return None
+        heads = [
+            (q[0], lane)
+            for lane, q in self._lane_queues.items()
+            if q and self._lane_active[lane] < self.lane_limits[lane]
+        ]
+        if not heads:
+            return None
+        (_, t0, n_bytes, item), lane = min(heads, key=lambda h: h[0][0])
+        if not self._bytes.fits(n_bytes):
+            return None
+
+        self._lane_queues[lane].popleft()
+        self._lane_active[lane] += 1
+        self._n_active += 1
+        self._bytes.acquire(n_bytes)
+        METRICS.add_time("download_slot_wait", time.perf_counter() - t0)
+        return lane, n_bytes, item
+
+    def _release(self, lane, n_bytes):
+        with self._cond:
+            self._lane_active[lane] -= 1
+            self._n_active -= 1
+            self._bytes.release(n_bytes)
+            self._cond.notify_all()
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stop.is_set():
+                        # what is left is skipped, including artifacts that
+                        # lookup threads are still adding
+                        for q in self._lane_queues.values():
+                            while q:
+                                self._result_queue.put(("skipped", q.popleft()[-1]))
+                        if self._n_lookups_running == 0:
+                            return
+                    else:
+                        nxt = self._next_download()
+                        if nxt is not None:
+                            break
+                        if self._n_lookups_running == 0 and not any(
+                            self._lane_queues.values()
+                        ):
+                            return
+                    self._cond.wait(timeout=_POLL_INTERVAL)
+
+            try:
+                self._submit(*nxt)
+            except Exception as e:
+                self._result_queue.put(("error", e))
+
+    def _submit(self, lane, n_bytes, item):
+        subdir, pkg, rec = item
+        release = functools.partial(self._release, lane, n_bytes)
+        try:
+            fut = self.executor.submit(
+                # processes send their metrics back with the result
+                download_and_validate_artifact
+                if self.backend == "threading"
+                else download_and_validate_artifact_in_worker,
+                pkg,
+                {"name": rec.name, "md5": rec.md5, "sha256": rec.sha256},
+                subdir,
+                # processes use the rules they loaded at startup
+                rule_set=self.rule_set if self.backend == "threading" else None,
+                verbose=self.verbose,
+                range_requests=self.range_requests,
+                return_paths=True,
+            )
+        except RuntimeError:
+            # the executor was shut down
+            release()
+            self._result_queue.put(("skipped", item))
+        else:
+            with self._lock:
+                self._futures.add(fut)
+            fut.add_done_callback(functools.partial(self._done, item, release))
+
+    def _done(self, item, release, fut):
+        with self._lock:
+            self._futures.discard(fut)
+        release()
+
+        if fut.cancelled():
+            self._result_queue.put(("skipped", item))
+        elif fut.exception() is not None:
+            self._result_queue.put(("error", fut.exception()))
+        else:
+            if self.backend == "threading":
+                valid, bad_pths, paths = fut.result()
+            else:
+                (valid, bad_pths, paths), metrics = fut.result()
+                METRICS.merge(metrics)
+            try:
+                self._store_paths(item, paths)
+            except Exception as e:
+                self._result_queue.put(("error", e))
+            else:
+                self._result_queue.put(("done", item, (valid, bad_pths), False))
+
+    def _store_paths(self, item, paths):
+        if paths is not None and self.file_index is not None:
+            subdir, pkg, rec = item
+            self.file_index.put(subdir, pkg, paths, source="download")
+            self.file_index.mark_scanned(
+                subdir, pkg, rec.name, "download", self.rule_set.fingerprint,
+            )
+
+    def run(self, artifacts):
+        """Run the pipeline.
+
+        Parameters
+        ----------
+        artifacts : iterable of tuple
+            The (subdir, pkg, `PackageRecord`) of each artifact to validate. It
+            is consumed lazily in a separate thread.
+
+        Yields
+        ------
+        subdir : str
+            The subdir of the artifact.
+        pkg : str
+            The artifact file name.
+        rec : PackageRecord
+            The record of the artifact.
+        result : tuple of (bool, dict)
+            The validity and bad paths of the artifact.
+        cached : bool
+            True if the result came from the result cache.
+        """
+        self._n_lookups_running = self.n_lookup
+        threads = [threading.Thread(target=self._feed, args=(artifacts,), daemon=True)]
+        threads += [
+            threading.Thread(target=self._lookup, daemon=True)
+            for _ in range(self.n_lookup)
+        ]
+        threads.append(threading.Thread(target=self._dispatch, daemon=True))
+        for thread in threads:
+            thread.start()
+
+        n_seen = 0
+        try:
+            while self._n_fed is None or n_seen < self._n_fed:
+                try:
+                    status, *data = self._result_queue.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+
+                if status == "error":
+                    raise data[0]
+
+                n_seen += 1
+                if status == "done":
+                    (subdir, pkg, rec), res, cached = data
+                    with self._lock:
+                        self._unfinished.pop((subdir, pkg), None)
+                    yield subdir, pkg, rec, res, cached
+        finally:
+            self.stop()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,217 @@
+from collections import defaultdict
+
+from .rules import RuleSet
+from .artifact_paths import add_parent_dirs
+from .file_index import get_artifact_key
+from .scan import match_file_list, finalize_result
+
+
+def diff_rules(old_validate_yamls, new_validate_yamls):
+    """Find what changed between two sets of validate YAMLs.
+
+    Parameters
+    ----------
+    old_validate_yamls : dict
+        A dictionary mapping the name of each validation yaml to its contents
+        for the old rules.
+    new_validate_yamls : dict
+        The same for the new rules.
+
+    Returns
+    -------
+    changes : dict
+        A dictionary mapping the name of each validation yaml that changed to
+        a dictionary with the sets of patterns that were "added" and
+        "removed" and the sets of output names that were "allowed_added" and
+        "allowed_removed". A validation yaml that was removed has all of its
+        patterns removed and a new one has all of its patterns added.
+    """
+    changes = {}
+    for key in set(old_validate_yamls) | set(new_validate_yamls):
+        old = old_validate_yamls.get(key, {"files": [], "allowed": []})
+        new = new_validate_yamls.get(key, {"files": [], "allowed": []})
+        change = {
+            "added": set(new["files"]) - set(old["files"]),
+            "removed": set(old["files"]) - set(new["files"]),
+            "allowed_added": set(new["allowed"]) - set(old["allowed"]),
+            "allowed_removed": set(old["allowed"]) - set(new["allowed"]),
+        }
+        if key not in new_validate_yamls:
+            # nothing is allowed by rules that do not exist anymore
+            change["allowed_added"] = set()
+        if any(change.values()):
+            changes[key] = change
+    return changes
+
+
+def _find_artifacts_with_added_patterns(file_index, changes):
+    added = {
+        key: {"files": sorted(change["added"]), "allowed": []}
+        for key, change in changes.items()
+        if change["added"]
+    }
+    if not added:
+        return set()
+    added_rules = RuleSet(added)
+
+    def _path_filter(path):
+        # parent directories are included since lists from downloads are
+        # matched with them
+        hits = added_rules.iter_hits(None, add_parent_dirs([path]))
+        return next(hits, None) is not None
+
+    return file_index.find_artifacts(_path_filter)
+
+
+def _could_change(change_key, change, name, bad_pths):
+    if name in change["allowed_removed"]:
+        return True
+    if change_key not in bad_pths:
+        return False
+    return (
+        name in change["allowed_added"]
+        or not change["removed"].isdisjoint(bad_pths[change_key])
+    )
+
+
+def find_affected_artifacts(file_index, changes, artifacts, scan_data_bad_paths):
+    """Find the artifacts whose results could change with the rules.
+
+    Parameters
+    ----------
+    file_index : FileListIndex
+        The file list index.
+    changes : dict
+        The changes to the rules from `diff_rules`.
+    artifacts : list of tuple
+        The (subdir/pkg, name) of the artifacts to check.
+    scan_data_bad_paths : dict
+        A dictionary mapping the `subdir/pkg` of each invalid artifact in the
+        scan data to its bad paths.
+
+    Returns
+    -------
+    affected : set of str
+        The `subdir/pkg` of the affected artifacts.
+    """
+    # only artifacts with a file that matches a new pattern can become invalid
+    added_keys = _find_artifacts_with_added_patterns(file_index, changes)
+
+    affected = set()
+    for subdir_pkg, name in artifacts:
+        subdir, pkg = subdir_pkg.split("/", 1)
+        if get_artifact_key(subdir, pkg) in added_keys:
+            affected.add(subdir_pkg)
+            continue
+
+        # and only invalid artifacts can become valid
+        bad_pths = scan_data_bad_paths.get(subdir_pkg, None) or {}
+        if any(
+            _could_change(change_key, change, name, bad_pths)
+            for change_key, change in changes.items()
+        ):
+            affected.add(subdir_pkg)
+    return affected
+
+
+def rescan_rules(file_index, rule_set, scan_data, verbose=0):
+    """Apply a change to the rules to the stored file lists of scanned artifacts.
+
+    For each set of rules the artifacts were last matched against, the patterns
+    and allowed outputs that changed are found and only the artifacts that
+    could be affected by them are matched again with the new rules. Nothing
+    is downloaded.
+
+    Parameters
+    ----------
+    file_index : FileListIndex
+        The file list index written by the scanner.
+    rule_set : RuleSet
+        The new rules.
+    scan_data : dict
+        The current scan data keyed on the artifact name and then `subdir/pkg`.
+    verbose : int, optional
+        If greater than zero, report what changed in the rules.
+
+    Returns
+    -------
+    final_data : dict
+        The invalid artifacts keyed on the artifact name and then `subdir/pkg`.
+    valid_artifacts : set of str
+        The `subdir/pkg` of the artifacts that were matched again and are valid.
+    stats : dict
+        The number of artifacts that were "scanned" before, the number that
+        were "rematched" and the number that were affected but are "missing"
+        a file list.
+    """
+    scan_data_bad_paths = {
+        subdir_pkg: res["bad_paths"]
+        for arts in (scan_data or {}).values()
+        for subdir_pkg, res in arts.items()
+    }
+
+    groups = defaultdict(list)
+    n_scanned = 0
+    for subdir_pkg, name, _, fingerprint in file_index.iter_scanned():
+        n_scanned += 1
+        if fingerprint != rule_set.fingerprint:
+            groups[fingerprint].append((subdir_pkg, name))
+
+    new_validate_yamls = rule_set.to_validate_yamls()
+    affected = {}
+    for fingerprint, artifacts in groups.items():
+        old_validate_yamls = file_index.get_rules(fingerprint)
+        if old_validate_yamls is None:
+            print(
+                "rules %s are unknown - matching all %d of its artifacts again" % (
+                    fingerprint[:8], len(artifacts),
+                ),
+                flush=True,
+            )
+            affected.update(artifacts)
+            continue
+
+        changes = diff_rules(old_validate_yamls, new_validate_yamls)
+        if verbose > 0:
+            for key, change in sorted(changes.items()):
+                print(
+                    "rules %s -> %s: %s changed: %s" % (
+                        fingerprint[:8],
+                        rule_set.fingerprint[:8],
+                        key,
+                        {k: sorted(v) for k, v in change.items() if v},
+                    ),
+                    flush=True,
+                )
+        names = dict(artifacts)
+        for subdir_pkg in find_affected_artifacts(
+            file_index, changes, artifacts, scan_data_bad_paths,
+        ):
+            affected[subdir_pkg] = names[subdir_pkg]
+
+    final_data = defaultdict(dict)
+    valid_artifacts = set()
+    n_missing = 0
+    for subdir_pkg in sorted(affected):
+        name = affected[subdir_pkg]
+        subdir, pkg = subdir_pkg.split("/", 1)
+        # the source is taken from the list itself, which may have been
+        # stored by a different scan than the one that marked the artifact
+        files, source = file_index.get(subdir, pkg, return_source=True)
+        if files is None:
+            n_missing += 1
+            continue
+
+        valid, bad_pths = match_file_list(rule_set, name, files, source)
+        d_valid, d = finalize_result(pkg, name, subdir, valid, bad_pths)
+        if d_valid:
+            valid_artifacts.add(subdir_pkg)
+        else:
+            for k, v in d.items():
+                final_data[k].update(v)
+
+    return final_data, valid_artifacts, {
+        "scanned": n_scanned,
+        "rematched": len(affected) - n_missing,
+        "missing": n_missing,
+    }
@@ -0,0 +1,132 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+class ResultCache:
+    """An on-disk cache of validation results.
+
+    Results are keyed on the md5 checksum of the artifact from the repodata and
+    the fingerprint of the rule set used to validate it. If the rules change,
+    the fingerprint changes and the old entries are simply never looked up
+    again. They can be removed with `prune`.
+
+    The cache is safe to use from multiple threads.
+
+    Parameters
+    ----------
+    path : str
+        The path to the SQLite database. It is created if it does not exist.
+    commit_every : int, optional
+        Commit to disk after this many new results.
+    """
+    def __init__(self, path, commit_every=64):
+        self.path = path
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self._n_uncommitted = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "md5 TEXT NOT NULL, "
+            "fingerprint TEXT NOT NULL, "
+            "artifact TEXT NOT NULL, "
+            "valid INTEGER NOT NULL, "
+            "bad_paths TEXT NOT NULL, "
+            "updated REAL NOT NULL, "
+            "PRIMARY KEY (md5, fingerprint))"
+        )
+        self._conn.commit()
+
+    def get(self, md5, fingerprint):
+        """Get a result from the cache.
+
+        Parameters
+        ----------
+        md5 : str
+            The md5 checksum of the artifact.
+        fingerprint : str
+            The fingerprint of the rule set.
+
+        Returns
+        -------
+        result : tuple of (bool, dict) or None
+            The validity and bad paths of the artifact, or None if the result
+            is not in the cache.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT valid, bad_paths FROM results "
+                "WHERE md5 = ? AND fingerprint = ?",
+                (md5, fingerprint),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            else:
+                self.hits += 1
+                return bool(row[0]), json.loads(row[1])
+
+    def put(self, md5, fingerprint, artifact, valid, bad_paths):
+        """Put a result in the cache.
+
+        Parameters
+        ----------
+        md5 : str
+            The md5 checksum of the artifact.
+        fingerprint : str
+            The fingerprint of the rule set.
+        artifact : str
+            The artifact (e.g., `linux-64/numpy-...`). This is only stored for
+            reference.
+        valid : bool
+            If the artifact is valid.
+        bad_paths : dict
+            The bad paths of the artifact.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    md5, fingerprint, artifact, int(bool(valid)),
+                    json.dumps(bad_paths, sort_keys=True), time.time(),
+                ),
+            )
+            self._n_uncommitted += 1
+            if self._n_uncommitted >= self.commit_every:
+                self._conn.commit()
+                self._n_uncommitted = 0
+
+    def prune(self, fingerprint):
+        """Remove all results not made with the rule set `fingerprint`.
+
+        Returns
+        -------
+        n_removed : int
+            The number of entries that were removed.
+        """
+        with self._lock:
+            cur = self._conn.execute(
+                "DELETE FROM results WHERE fingerprint != ?", (fingerprint,),
+            )
+            self._conn.commit()
+            return cur.rowcount
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,385 @@
+import os
+import re
+import glob
+import hashlib
+import json
+import logging
+import pickle
+import functools
+from collections import defaultdict
+
+import yaml
+
+from .glob_to_re import glob_to_re
+from .metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+GLOB_CHARS = "*?[]"
+
+# globs relative to the root of the repo for the validate YAMLs
+VALIDATE_YAML_GLOBS = [
+    "validate_yamls/*.yaml",
+    "generated_validate_yamls/*.generated.yaml",
+]
+
+# bump this if the structure of the RuleSet changes - changes to the code that
+# makes the bundle are picked up from its hash
+BUNDLE_VERSION = 1
+
+# rule bundles are cached here and never in the repo, since a bundle is a pickle
+# and one left in the working directory by someone else could run any code when
+# loaded - set the environment variable to an empty string to turn this off
+RULES_CACHE_DIR = os.environ.get(
+    "CF_ARTIFACT_VALIDATION_RULES_CACHE_DIR",
+    os.path.join(
+        os.path.expanduser("~"), ".cache", "conda-forge-artifact-validation",
+        "rules",
+    ),
+)
+
+# the modules whose code is pickled in a bundle
+_BUNDLE_CODE_PATHS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.py"),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "glob_to_re.py"),
+]
+
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def _is_literal(patt):
+    return not any(c in patt for c in GLOB_CHARS)
+
+
+def _literal_prefix(patt):
+    for i, c in enumerate(patt):
+        if c in GLOB_CHARS:
+            # "/**" can match nothing at all, so the slash is not required
+            if patt[i:i + 2] == "**" and i > 0 and patt[i - 1] == "/":
+                i -= 1
+            return patt[:i]
+    return patt
+
+
+def compute_fingerprint(validate_yamls):
+    """Compute a stable hash of the rules in a set of validate YAMLs.
+
+    Only the `files` and `allowed` keys are used, since they are the only ones
+    that change the result of validation.
+    """
+    data = {
+        key: {"files": validate_yaml["files"], "allowed": validate_yaml["allowed"]}
+        for key, validate_yaml in validate_yamls.items()
+    }
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+class _TrieNode:
+    __slots__ = ("children", "rules", "regexes")
+
+    def __init__(self):
+        self.children = {}
+        self.rules = []
+        self.regexes = None
+
+    def get_regexes(self):
+        # compiled lazily so that loading a rule bundle does not recompile
+        # every pattern up front
+        if self.regexes is None:
+            self.regexes = [
+                (key, index, re.compile(re_patt)) for key, index, re_patt in self.rules
+            ]
+        return self.regexes
+
+    def __getstate__(self):
+        return {"children": self.children, "rules": self.rules}
+
+    def __setstate__(self, state):
+        self.children = state["children"]
+        self.rules = state["rules"]
+        self.regexes = None
+
+
+class RuleSet:
+    """A compiled set of validation rules.
+
+    Literal paths from the validate YAMLs are put in a hash table and glob patterns
+    are put in a trie keyed on the literal prefix of the glob. Matching a list of
+    files is then roughly linear in the number of files, since each file is only
+    tested against the globs whose literal prefix it starts with.
+
+    Parameters
+    ----------
+    validate_yamls : dict
+        A dictionary mapping the name of the validation yaml to its contents.
+    """
+    def __init__(self, validate_yamls):
+        # rules are identified by (key, index of the pattern in the files list)
+        self.patterns = {}
+        self.allowed = {}
+        # inverted index of output name to the rules that allow it
+        self.allowed_index = defaultdict(set)
+        self.literals = defaultdict(list)
+        self.trie = _TrieNode()
+        self.n_globs = 0
+        self.fingerprint = compute_fingerprint(validate_yamls)
+
+        for key, validate_yaml in validate_yamls.items():
+            self.allowed[key] = frozenset(validate_yaml["allowed"])
+            for output_name in validate_yaml["allowed"]:
+                self.allowed_index[output_name].add(key)
+            self.patterns[key] = list(validate_yaml["files"])
+            for index, patt in enumerate(validate_yaml["files"]):
+                self._add_pattern(key, index, patt)
+
+    def _add_pattern(self, key, index, patt):
+        # a trailing slash in a glob only matches a directory
+        _patt = patt.rstrip("/") or patt
+        if _is_literal(_patt):
+            self.literals[_patt].append((key, index))
+        else:
+            node = self.trie
+            for c in _literal_prefix(_patt):
+                if c not in node.children:
+                    node.children[c] = _TrieNode()
+                node = node.children[c]
+            node.rules.append((key, index, glob_to_re(_patt)))
+            self.n_globs += 1
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def keys_for(self, pkg_name):
+        """Get the names of the rules that apply to an output."""
+        skip = self.allowed_index.get(pkg_name, ())
+        return [key for key in self.patterns if key not in skip]
+
+    def to_validate_yamls(self):
+        """Convert the rules back to a dictionary of validate YAMLs."""
+        return {
+            key: {"files": list(self.patterns[key]), "allowed": sorted(allowed)}
+            for key, allowed in self.allowed.items()
+        }
+
+    def iter_hits(self, pkg_name, fnames):
+        """Iterate over all of the (key, pattern index, file name) hits for an output.
+
+        Each (key, pattern index) pair is yielded at most once, for the first
+        file that matches it.
+        """
+        skip = self.allowed_index.get(pkg_name, ())
+        seen = set()
+
+        for fname in fnames:
+            for key, index in self.literals.get(fname, ()):
+                if key not in skip and (key, index) not in seen:
+                    seen.add((key, index))
+                    yield key, index, fname
+
+            node = self.trie
+            pos = 0
+            while node is not None:
+                for key, index, rep in node.get_regexes():
+                    if (
+                        key not in skip
+                        and (key, index) not in seen
+                        and rep.fullmatch(fname) is not None
+                    ):
+                        seen.add((key, index))
+                        yield key, index, fname
+
+                if pos < len(fname):
+                    node = node.children.get(fname[pos], None)
+                    pos += 1
+                else:
+                    node = None
+
+    def match(self, pkg_name, fnames):
+        """Match a list of files from an output against the rules.
+
+        Parameters
+        ----------
+        pkg_name : str
+            The name of the output (e.g., `numpy`).
+        fnames : iterable of str
+            The paths of the files in the output.
+
+        Returns
+        -------
+        valid : bool
+            True if the files are valid, False otherwise.
+        bad_paths : dict
+            A dictionary mapping the name of each validation YAML with any matches
+            to the list of its patterns that matched, in the order they appear
+            in the YAML.
+        """
+        hits = defaultdict(list)
+        with METRICS.time("match"):
+            for key, index, fname in self.iter_hits(pkg_name, fnames):
+                LOGGER.info(
+                    "path %s failed for file %s", fname, self.patterns[key][index],
+                )
+                hits[key].append(index)
+
+        bad_pths = defaultdict(list)
+        for key in self.patterns:
+            if key in hits:
+                bad_pths[key] = [self.patterns[key][i] for i in sorted(hits[key])]
+
+        return len(bad_pths) == 0, bad_pths
+
+
+def as_rule_set(validate_yamls):
+    """Compile a dictionary of validate YAMLs to a `RuleSet` if needed."""
+    if isinstance(validate_yamls, RuleSet):
+        return validate_yamls
+    return RuleSet(validate_yamls)
+
+
+def find_validate_yamls(root="."):
+    """Find the paths to the validate YAMLs in the repo at `root`.
+
+    Returns
+    -------
+    paths : dict
+        A dictionary mapping the name of the validate YAML to its path.
+    """
+    paths = {}
+    for glb in VALIDATE_YAML_GLOBS:
+        for pth in sorted(glob.glob(os.path.join(root, glb))):
+            key = os.path.basename(pth).rsplit(".yaml", maxsplit=1)[0]
+            paths[key] = pth
+    return paths
+
+
+def load_validate_yamls(root="."):
+    """Load the validate YAMLs in the repo at `root`.
+
+    Returns
+    -------
+    validate_yamls : dict
+        A dictionary mapping the name of the validate YAML to its contents.
+    """
+    validate_yamls = {}
+    for key, pth in find_validate_yamls(root=root).items():
+        with open(pth, "r") as fp:
+            validate_yamls[key] = yaml.load(fp, Loader=YamlLoader)
+    return validate_yamls
+
+
+def _hash_sources(paths):
+    hashes = {}
+    for key, pth in paths.items():
+        with open(pth, "rb") as fp:
+            hashes[key] = hashlib.sha256(fp.read()).hexdigest()
+    return hashes
+
+
+@functools.lru_cache(maxsize=1)
+def _hash_code():
+    h = hashlib.sha256()
+    for pth in _BUNDLE_CODE_PATHS:
+        with open(pth, "rb") as fp:
+            h.update(fp.read())
+    return h.hexdigest()
+
+
+def get_default_bundle_path(root="."):
+    """Get the path of the rule bundle for the repo at `root`.
+
+    The bundles are kept in `RULES_CACHE_DIR` under the hash of the absolute
+    path of the repo. Returns None if `RULES_CACHE_DIR` is empty.
+    """
+    if not RULES_CACHE_DIR:
+        return None
+    key = hashlib.sha256(os.path.abspath(root).encode("utf-8")).hexdigest()
+    return os.path.join(RULES_CACHE_DIR, key[:32] + ".pkl")
+
+
+def compile_rules(root=".", bundle_path=None):
+    """Compile the validate YAMLs in the repo at `root` to a rule bundle.
+
+    The bundle holds the compiled `RuleSet`, the hashes of the YAML files it
+    was made from and the hash of the code that made it, so that it can be
+    invalidated when any of them changes.
+
+    Parameters
+    ----------
+    root : str, optional
+        The root of the repo.
+    bundle_path : str, optional
+        The path to write the bundle to. Defaults to the path from
+        `get_default_bundle_path`.
+
+    Returns
+    -------
+    rule_set : RuleSet
+        The compiled rules.
+    """
+    bundle_path = bundle_path or get_default_bundle_path(root=root)
+    paths = find_validate_yamls(root=root)
+    rule_set = RuleSet(load_validate_yamls(root=root))
+    if bundle_path is None:
+        return rule_set
+
+    bundle = {
+        "version": BUNDLE_VERSION,
+        "code": _hash_code(),
+        "sources": _hash_sources(paths),
+        "rule_set": rule_set,
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(bundle_path)), exist_ok=True)
+    tmp_pth = bundle_path + ".tmp"
+    with open(tmp_pth, "wb") as fp:
+        pickle.dump(bundle, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_pth, bundle_path)
+
+    return rule_set
+
+
+def load_rule_set(root=".", bundle_path=None, update=True):
+    """Load the rules for the repo at `root`, using the rule bundle if it is current.
+
+    Parameters
+    ----------
+    root : str, optional
+        The root of the repo.
+    bundle_path : str, optional
+        The path to the bundle. Defaults to the path from
+        `get_default_bundle_path`. The bundle is unpickled, so only give paths
+        written by `compile_rules`.
+    update : bool, optional
+        If True, write a new bundle if the existing one is missing or stale.
+
+    Returns
+    -------
+    rule_set : RuleSet
+        The compiled rules.
+    """
+    bundle_path = bundle_path or get_default_bundle_path(root=root)
+
+    if bundle_path is not None and os.path.exists(bundle_path):
+        try:
+            with open(bundle_path, "rb") as fp:
+                bundle = pickle.load(fp)
+            if (
+                bundle["version"] == BUNDLE_VERSION
+                and bundle.get("code", None) == _hash_code()
+                and bundle["sources"] == _hash_sources(find_validate_yamls(root=root))
+            ):
+                LOGGER.debug("using rule bundle %s", bundle_path)
+                return bundle["rule_set"]
+            LOGGER.info("rule bundle %s is stale", bundle_path)
+        except Exception as e:
+            LOGGER.info("could not load rule bundle %s: %s", bundle_path, repr(e))
+
+    if update and bundle_path is not None:
+        try:
+            return compile_rules(root=root, bundle_path=bundle_path)
+        except OSError as e:
+            LOGGER.info("could not write rule bundle %s: %s", bundle_path, repr(e))
+
+    return RuleSet(load_validate_yamls(root=root))
@@ -0,0 +1,741 @@
+import os
+import copy
+import gzip
+import pprint
+import traceback
+import hashlib
+import multiprocessing
+import concurrent.futures
+from collections import defaultdict
+
+import rapidjson as json
+import yaml
+from yaml.representer import Representer, SafeRepresenter
+
+from .validate import download_artifact_paths, validate_paths
+from .rules import load_rule_set, YamlLoader
+from .download import get_session, ChecksumError
+from .utils import split_pkg
+from .cached_repodata import CHANNEL_URL, COMPACT_REPODATA_CACHE
+from .metrics import METRICS
+
+LIBCFGRAPH_URL = "https://raw.githubusercontent.com/regro/libcfgraph/master"
+
+# bump this if the format of the seen artifacts file changes
+SEEN_ARTIFACTS_VERSION = 1
+
+# set in each worker process by `_init_worker`
+_WORKER_RULE_SET = None
+
+yaml.add_representer(defaultdict, Representer.represent_dict)
+
+
+# the scan data is big enough that libyaml is a lot faster when it is there
+class _ScanDataDumper(getattr(yaml, "CSafeDumper", yaml.SafeDumper)):
+    pass
+
+
+_ScanDataDumper.add_representer(defaultdict, SafeRepresenter.represent_dict)
+
+
+def get_libcfgraph_artifact_path(name, subdir, pkg):
+    """Get the path to the libcfgraph JSON blob for an artifact."""
+    if pkg.endswith(".tar.bz2"):
+        pkg_json = pkg[:-len(".tar.bz2")] + ".json"
+    elif pkg.endswith(".conda"):
+        pkg_json = pkg[:-len(".conda")] + ".json"
+    else:
+        pkg_json = pkg
+
+    return os.path.join("artifacts", name, "conda-forge", subdir, pkg_json)
+
+
+def get_libcfgraph_file_list(
+    name, subdir, pkg, libcfgraph_path, file_index=None, return_source=False,
+):
+    """Get the list of files in an artifact from libcfgraph.
+
+    The file list index is tried first if given, followed by a local checkout
+    of libcfgraph and then GitHub. What is found on GitHub is added to the
+    index, as are artifacts that GitHub does not have, so that it is not asked
+    again about them for a while. The index can also hold lists read from
+    downloaded artifacts, so use `match_file_list` with the returned source to
+    match the list.
+
+    Parameters
+    ----------
+    name : str
+        The name of the output.
+    subdir : str
+        The subdir of the artifact.
+    pkg : str
+        The artifact file name.
+    libcfgraph_path : str or None
+        The path to a local checkout of libcfgraph.
+    file_index : FileListIndex, optional
+        The file list index.
+    return_source : bool, optional
+        If True, return where the list came from as well.
+
+    Returns
+    -------
+    files : list of str or None
+        The files or None if the artifact could not be found.
+    source : str or None
+        Where the list came from, either "libcfgraph" or "download". Only
+        returned if `return_source` is True.
+    """
+    with METRICS.time("libcfgraph_lookup"):
+        data, source = _get_libcfgraph_file_list(
+            name, subdir, pkg, libcfgraph_path, file_index,
+        )
+    METRICS.count("libcfgraph_hits" if data is not None else "libcfgraph_misses")
+    return (data, source) if return_source else data
+
+
+def _get_libcfgraph_file_list(name, subdir, pkg, libcfgraph_path, file_index):
+    if file_index is not None:
+        data, source = file_index.get(subdir, pkg, return_source=True)
+        if data is not None:
+            return data, source
+        if file_index.is_known_miss(subdir, pkg):
+            return None, None
+
+    artif_pth = get_libcfgraph_artifact_path(name, subdir, pkg)
+
+    if libcfgraph_path is not None:
+        lcfg_pth = os.path.join(libcfgraph_path, artif_pth)
+        try:
+            with open(lcfg_pth, "r") as fp:
+                data = json.load(fp).get("files", None)
+        except Exception:
+            data = None
+    else:
+        data = None
+
+    not_found = False
+    if data is None:
+        http_url = os.path.join(LIBCFGRAPH_URL, artif_pth)
+        try:
+            _rr = get_session().get(http_url, timeout=1)
+            not_found = _rr.status_code == 404
+            _rr.raise_for_status()
+            data = _rr.json().get("files", None)
+        except Exception:
+            data = None
+
+    if file_index is not None:
+        if data is not None:
+            file_index.put(subdir, pkg, data)
+        elif not_found:
+            # network errors are not recorded since they are transient
+            file_index.add_miss(subdir, pkg)
+
+    return data, (None if data is None else "libcfgraph")
+
+
+def match_file_list(rule_set, name, files, source):
+    """Match a stored file list against the rules.
+
+    Lists read from an artifact are matched with their parent directories,
+    like `validate_paths`, while lists from libcfgraph are matched as is.
+
+    Parameters
+    ----------
+    rule_set : RuleSet
+        The rules.
+    name : str
+        The name of the output.
+    files : list of str
+        The files in the artifact.
+    source : str
+        Where the list came from, either "libcfgraph" or "download".
+
+    Returns
+    -------
+    valid : bool
+        True if the artifact is valid, False otherwise.
+    bad_paths : dict
+        A dictionary mapping the validation YAML name information in the case
+        that the package is not valid.
+    """
+    if source == "download":
+        return validate_paths(name, files, rule_set)
+    else:
+        return rule_set.match(name, files)
+
+
+def download_and_validate_artifact(
+    pkg, repodata, subdir, rule_set=None, verbose=0, range_requests=False,
+    return_paths=False,
+):
+    """Download an artifact from the channel and validate it.
+
+    See `validate_artifact` for the parameters and return values. If
+    `return_paths` is True, the paths read from the artifact, or None if they
+    could not be read, are returned as well.
+    """
+    if rule_set is None:
+        rule_set = _WORKER_RULE_SET
+
+    pkg_url = f"{CHANNEL_URL}/{subdir}/{pkg}"
+    if verbose > 0:
+        print("downloading artifact '%s'" % pkg_url, flush=True)
+
+    # the checksums can only be checked if we download the whole artifact
+    if range_requests and pkg.endswith(".conda"):
+        md5sum = None
+        sha256 = None
+    else:
+        md5sum = repodata["md5"]
+        sha256 = repodata.get("sha256", None)
+
+    paths = None
+    try:
+        paths = download_artifact_paths(
+            CHANNEL_URL,
+            f"{subdir}/{pkg}",
+            md5sum=md5sum,
+            sha256=sha256,
+            range_requests=range_requests,
+        )
+    except ChecksumError as e:
+        valid = False
+        bad_pths = {e.kind + "sum": {"valid": False}}
+    except Exception:
+        traceback.print_exc()
+        valid = False
+        bad_pths = {}
+    else:
+        if paths is None:
+            # archives that cannot be read are skipped
+            valid = True
+            bad_pths = {}
+        else:
+            valid, bad_pths = validate_paths(repodata["name"], paths, rule_set)
+
+    if return_paths:
+        return valid, bad_pths, paths
+    return valid, bad_pths
+
+
+def download_and_validate_artifact_in_worker(*args, **kwargs):
+    """Run `download_and_validate_artifact` in a worker process.
+
+    Returns
+    -------
+    result : tuple
+        The result of `download_and_validate_artifact`.
+    metrics : dict
+        The snapshot of the metrics of the worker for the job, to be merged
+        into the metrics of the main process.
+    """
+    METRICS.reset()
+    res = download_and_validate_artifact(*args, **kwargs)
+    return res, METRICS.snapshot(reset=True)
+
+
+def match_file_list_in_worker(name, files, source):
+    """Run `match_file_list` with the rules of a worker process.
+
+    Returns
+    -------
+    result : tuple
+        The result of `match_file_list`.
+    metrics : dict
+        The snapshot of the metrics of the worker for the job, to be merged
+        into the metrics of the main process.
+    """
+    METRICS.reset()
+    res = match_file_list(_WORKER_RULE_SET, name, files, source)
+    return res, METRICS.snapshot(reset=True)
+
+
+def validate_artifact(
+    pkg, repodata, libcfgraph_path, subdir, rule_set=None, verbose=0,
+    range_requests=False,
+):
+    """Validate an artifact on the channel.
+
+    The list of files is taken from libcfgraph if possible. Otherwise the
+    artifact is downloaded and its paths are read without extracting it.
+
+    Parameters
+    ----------
+    pkg : str
+        The artifact file name (e.g., `numpy-1.19.4-py36hcf5569d_1.tar.bz2`).
+    repodata : dict
+        The repodata entry for the artifact.
+    libcfgraph_path : str or None
+        The path to a local checkout of libcfgraph.
+    subdir : str
+        The subdir of the artifact.
+    rule_set : RuleSet, optional
+        The rules. If None, the rules loaded by the worker process are used.
+    verbose : int, optional
+        The verbosity level.
+    range_requests : bool, optional
+        If True, only fetch the info of `.conda` artifacts with HTTP range
+        requests, skipping the checksum.
+
+    Returns
+    -------
+    valid : bool
+        True if the artifact is valid, False otherwise.
+    bad_paths : dict or None
+        A dictionary mapping the validation YAML name information in the case
+        that the package is not valid.
+    """
+    if rule_set is None:
+        rule_set = _WORKER_RULE_SET
+
+    data = get_libcfgraph_file_list(repodata["name"], subdir, pkg, libcfgraph_path)
+
+    if data is None:
+        return download_and_validate_artifact(
+            pkg,
+            repodata,
+            subdir,
+            rule_set=rule_set,
+            verbose=verbose,
+            range_requests=range_requests,
+        )
+    else:
+        return rule_set.match(repodata["name"], data)
+
+
+def is_cacheable(valid, bad_pths):
+    """Test if a validation result is definitive enough to cache."""
+    # download errors and bad checksums are transient so we do not cache them
+    if valid:
+        return True
+    return bool(bad_pths) and not any(
+        k in ["md5sum", "sha256sum"] for k in bad_pths
+    )
+
+
+def finalize_result(pkg, name, subdir, valid, bad_pths):
+    """Report a validation result and put it in the format used for the scan data.
+
+    Artifacts with py34 or py35 in their build string are always reported as valid.
+
+    Returns
+    -------
+    valid : bool
+        True if the artifact is valid, False otherwise.
+    data : dict
+        The result keyed on the artifact name and then `subdir/pkg`.
+    """
+    if not valid:
+        print(
+            "invalid artifact %s/%s: %s" % (
+                subdir,
+                pkg,
+                pprint.pformat(bad_pths),
+            ),
+            flush=True,
+        )
+
+    if any(ss in split_pkg(os.path.join(subdir, pkg))[-1] for ss in ["py34", "py35"]):
+        valid = True
+        print(
+            "skipping invalid artifact %s/%s due to py34/py35 in build string: %s" % (
+                subdir,
+                pkg,
+                pprint.pformat(bad_pths)
+            )
+        )
+
+    return valid, {
+        name: {
+            f"{subdir}/{pkg}": {"bad_paths": bad_pths},
+        },
+    }
+
+
+def load_seen_artifacts(path):
+    """Load the artifacts seen by previous scans.
+
+    Returns
+    -------
+    seen : dict
+        A dictionary mapping each subdir to a dictionary of the md5 checksum
+        of each artifact that was validated. This is empty if the file does
+        not exist.
+    """
+    if not os.path.exists(path):
+        return {}
+
+    with gzip.open(path, "rt") as fp:
+        data = json.load(fp)
+
+    if data.get("version", None) != SEEN_ARTIFACTS_VERSION:
+        print("ignoring seen artifacts in %s with old format" % path, flush=True)
+        return {}
+
+    return data["subdirs"]
+
+
+def save_seen_artifacts(path, seen):
+    """Save the artifacts seen by a scan. See `load_seen_artifacts`."""
+    tmp_pth = path + ".tmp"
+    with gzip.open(tmp_pth, "wt") as fp:
+        json.dump({"version": SEEN_ARTIFACTS_VERSION, "subdirs": seen}, fp)
+    os.replace(tmp_pth, path)
+
+
+def find_new_artifacts(rd, seen, order="name"):
+    """Find the artifacts that are new or changed since they were last seen.
+
+    Artifacts no longer on the channel are removed from `seen` in place.
+
+    Parameters
+    ----------
+    rd : CompactRepodata
+        The repodata for the subdir.
+    seen : dict
+        A dictionary mapping the artifacts seen previously for this subdir to
+        their md5 checksums.
+    order : str, optional
+        Either "name" to sort the artifacts by name or "timestamp" to sort them
+        by upload time, oldest first.
+
+    Returns
+    -------
+    pkgs : list of str
+        The new or changed artifacts.
+    """
+    for pkg in list(seen):
+        if pkg not in rd.packages:
+            del seen[pkg]
+
+    pkgs = [
+        pkg for pkg, rec in rd.packages.items()
+        if seen.get(pkg, None) != rec.md5
+    ]
+
+    if order == "name":
+        return sorted(pkgs)
+    elif order == "timestamp":
+        return sorted(pkgs, key=lambda pkg: (rd.packages[pkg].timestamp, pkg))
+    else:
+        raise ValueError("order %s is not one of name or timestamp" % order)
+
+
+def parse_shard(shard):
+    """Parse a shard spec like `i/N` to the zero-based shard index and count."""
+    try:
+        index, n_shards = (int(v) for v in shard.split("/"))
+    except ValueError:
+        raise ValueError("shard %s is not of the form i/N" % shard)
+    if n_shards < 1 or index < 0 or index >= n_shards:
+        raise ValueError("shard %s must have 0 <= i < N" % shard)
+    return index, n_shards
+
+
+def _shard_key(pkg):
+    return hashlib.md5(pkg.encode("utf-8")).digest()[:8]
+
+
+def get_shard_artifacts(rd, shard, n_shards):
+    """Get the artifacts in a subdir that belong to a shard.
+
+    The artifacts are put in a fixed pseudo-random order by the hash of their
+    file name and then split into `n_shards` contiguous ranges with about the
+    same total size. Every shard sees the same partition as long as they use
+    the same repodata.
+
+    Parameters
+    ----------
+    rd : CompactRepodata
+        The repodata for the subdir.
+    shard : int
+        The zero-based index of the shard.
+    n_shards : int
+        The number of shards.
+
+    Returns
+    -------
+    pkgs : set of str
+        The artifacts in the shard.
+    """
+    pkgs = sorted(rd.packages, key=_shard_key)
+    # a tiny weight keeps artifacts without a size in the partition
+    weights = [max(rd.packages[pkg].size, 1) for pkg in pkgs]
+    total = sum(weights)
+
+    shard_pkgs = set()
+    cum = 0
+    for pkg, weight in zip(pkgs, weights):
+        if min(cum * n_shards // total, n_shards - 1) == shard:
+            shard_pkgs.add(pkg)
+        cum += weight
+    return shard_pkgs
+
+
+def _strip_md5_or_error(data):
+    any_nonmd5 = defaultdict(dict)
+    for pkg_nm, art_data in data.items():
+        for art, v in art_data.items():
+            if len(v["bad_paths"]) == 0:
+                continue
+            elif all(k in ["md5sum", "sha256sum"] for k in v["bad_paths"]):
+                continue
+            else:
+                any_nonmd5[pkg_nm][art] = v
+    return any_nonmd5
+
+
+def dump_scan_data(data):
+    """Dump scan data to YAML in the format of `invalid_packages.yaml`."""
+    return yaml.dump(data, Dumper=_ScanDataDumper, default_flow_style=False, indent=2)
+
+
+def load_scan_data(path):
+    """Load scan data from a YAML file, returning an empty dict if it does not
+    exist."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as fp:
+        return yaml.load(fp, Loader=YamlLoader) or {}
+
+
+def dump_finding(name, subdir, pkg, bad_pths):
+    """Dump an invalid artifact to a line of JSON for a findings file."""
+    return json.dumps(
+        {"name": name, "artifact": f"{subdir}/{pkg}", "bad_paths": bad_pths}
+    )
+
+
+def load_findings(path):
+    """Load the invalid artifacts in a findings file of JSON lines.
+
+    A partial last line from a scan that was killed while writing is skipped.
+    Later findings for an artifact replace earlier ones.
+
+    Returns
+    -------
+    data : dict
+        The invalid artifacts keyed on the artifact name and then `subdir/pkg`.
+    """
+    data = defaultdict(dict)
+    with open(path, "r") as fp:
+        for line in fp:
+            try:
+                finding = json.loads(line)
+            except ValueError:
+                continue
+            data[finding["name"]][finding["artifact"]] = {
+                "bad_paths": finding["bad_paths"],
+            }
+    return data
+
+
+def diff_scan_data(old_data, new_data):
+    """Find the findings that differ between two sets of scan data.
+
+    The scan data is compared by output, then artifact and then validation
+    YAML, so the cost is linear in the number of entries.
+
+    Parameters
+    ----------
+    old_data : dict
+        The old scan data keyed on the artifact name and then `subdir/pkg`.
+    new_data : dict
+        The new scan data.
+
+    Returns
+    -------
+    changes : list of tuple
+        The sorted (name, subdir/pkg, validation YAML name, old bad paths, new
+        bad paths) of each finding that changed. The old bad paths are None
+        for a finding that was added and the new ones are None for a finding
+        that was removed.
+    """
+    changes = []
+    for name in set(old_data) | set(new_data):
+        old_arts = old_data.get(name, None) or {}
+        new_arts = new_data.get(name, None) or {}
+        for art in set(old_arts) | set(new_arts):
+            old_bad = old_arts.get(art, {}).get("bad_paths", None) or {}
+            new_bad = new_arts.get(art, {}).get("bad_paths", None) or {}
+            if old_bad == new_bad:
+                continue
+            for key in set(old_bad) | set(new_bad):
+                old_v = old_bad.get(key, None)
+                new_v = new_bad.get(key, None)
+                if old_v != new_v:
+                    changes.append((name, art, key, old_v, new_v))
+    return sorted(changes, key=lambda c: c[:3])
+
+
+def _diff_block(data, indent, prefix):
+    return [
+        prefix + " " * indent + ln for ln in dump_scan_data(data).splitlines()
+    ]
+
+
+def format_scan_data_diff(old_data, new_data, changes):
+    """Render the changes from `diff_scan_data` as a diff of the scan data YAML.
+
+    Outputs and artifacts that are only on one side are shown in full and
+    the names of the ones on both sides are shown as context.
+
+    Returns
+    -------
+    diff : str
+        The diff or an empty string if there are no changes.
+    """
+    if not changes:
+        return ""
+
+    lines = ["--- ", "+++ "]
+    curr_name = None
+    curr_art = None
+    for name, art, key, old_v, new_v in changes:
+        old_arts = old_data.get(name, None) or {}
+        new_arts = new_data.get(name, None) or {}
+
+        if name != curr_name:
+            curr_name = name
+            curr_art = None
+            if not old_arts:
+                lines += _diff_block({name: new_arts}, 0, "+")
+            elif not new_arts:
+                lines += _diff_block({name: old_arts}, 0, "-")
+            else:
+                # a placeholder child gets the key on a line by itself
+                lines += _diff_block({name: {"": None}}, 0, " ")[:1]
+        if not old_arts or not new_arts:
+            continue
+
+        if art != curr_art:
+            curr_art = art
+            if art not in old_arts:
+                lines += _diff_block({art: new_arts[art]}, 2, "+")
+            elif art not in new_arts:
+                lines += _diff_block({art: old_arts[art]}, 2, "-")
+            else:
+                lines += _diff_block({art: {"bad_paths": {"": None}}}, 2, " ")[:2]
+        if art not in old_arts or art not in new_arts:
+            continue
+
+        if old_v is not None:
+            lines += _diff_block({key: old_v}, 6, "-")
+        if new_v is not None:
+            lines += _diff_block({key: new_v}, 6, "+")
+
+    return "\n".join(lines)
+
+
+def _diff_res(old_data, new_data):
+    return format_scan_data_diff(
+        old_data, new_data, diff_scan_data(old_data, new_data),
+    )
+
+
+def update_scan_data(output_path, final_data, valid_artifacts=None, clean=True):
+    """Merge new scan results into the scan data and report what changed.
+
+    Parameters
+    ----------
+    output_path : str or None
+        The path to the scan data YAML file. If None, nothing is written and
+        the diff is against no data.
+    final_data : dict
+        The new invalid artifacts keyed on the artifact name and then
+        `subdir/pkg`.
+    valid_artifacts : iterable of str, optional
+        The `subdir/pkg` of artifacts that are now valid. They are removed from
+        the scan data.
+    clean : bool, optional
+        If True, artifacts that are no longer on the main channel are removed
+        from the scan data. This needs the repodata.
+
+    Returns
+    -------
+    diff : str
+        A unified diff of the invalid artifacts, ignoring checksum errors.
+    """
+    if output_path is None:
+        return _diff_res({}, _strip_md5_or_error(final_data))
+
+    print("writing invalid packages to '%s'..." % output_path, flush=True)
+    old_data = load_scan_data(output_path)
+
+    orig_data = copy.deepcopy(old_data)
+
+    for k, v in final_data.items():
+        if k not in old_data:
+            old_data[k] = {}
+        old_data[k].update(final_data[k])
+
+    valid_artifacts = set(valid_artifacts or ())
+    if valid_artifacts:
+        for pkg_nm in list(old_data):
+            for subdir_pkg in list(old_data[pkg_nm]):
+                if subdir_pkg in valid_artifacts:
+                    del old_data[pkg_nm][subdir_pkg]
+
+            if not old_data[pkg_nm]:
+                del old_data[pkg_nm]
+
+    diff_lines = _diff_res(
+        _strip_md5_or_error(orig_data),
+        _strip_md5_or_error(old_data),
+    )
+
+    # clean out things not in the main channel
+    if clean:
+        for pkg_nm in list(old_data):
+            for subdir_pkg in list(old_data[pkg_nm]):
+                subdir, pkg = os.path.split(subdir_pkg)
+                if pkg not in COMPACT_REPODATA_CACHE[subdir].packages:
+                    del old_data[pkg_nm][subdir_pkg]
+
+            if not old_data[pkg_nm]:
+                del old_data[pkg_nm]
+
+    with open(output_path, "w") as fp:
+        fp.write(dump_scan_data(old_data))
+
+    return diff_lines
+
+
+def _init_worker(root, bundle_path):
+    global _WORKER_RULE_SET
+    _WORKER_RULE_SET = load_rule_set(root=root, bundle_path=bundle_path, update=False)
+
+
+def make_executor(backend, n_jobs, root=".", bundle_path=None):
+    """Make an executor to run `validate_artifact` jobs.
+
+    Parameters
+    ----------
+    backend : str
+        Either "threading" or "processes".
+    n_jobs : int
+        The number of worker threads or processes.
+    root : str, optional
+        The root of the repo with the validate YAMLs.
+    bundle_path : str, optional
+        The path to the rule bundle. Each worker process loads the rules
+        from it once when it starts.
+
+    Returns
+    -------
+    executor : concurrent.futures.Executor
+        The executor. When using processes, submit jobs with `rule_set=None` so
+        that the rules loaded by each worker are used.
+    """
+    if backend == "threading":
+        return concurrent.futures.ThreadPoolExecutor(max_workers=n_jobs)
+    elif backend == "processes":
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=n_jobs,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(root, bundle_path),
+        )
+    else:
+        raise ValueError("backend %s is not one of threading or processes" % backend)
@@ -0,0 +1,212 @@
+"""Synthetic artifacts, file lists and a local channel server.
+
+These stand in for conda-forge in the tests and the benchmarks, so that both
+run offline.
+"""
+import contextlib
+import functools
+import hashlib
+import http.server
+import io
+import json
+import os
+import random
+import re
+import tarfile
+import threading
+import zipfile
+
+import zstandard
+
+
+def _make_tarball(files, fileobj, mode):
+    with tarfile.open(fileobj=fileobj, mode=mode) as tf:
+        for name, data in files:
+            ti = tarfile.TarInfo(name)
+            ti.size = len(data)
+            tf.addfile(ti, io.BytesIO(data))
+
+
+def _make_info_files(name, pkg_files, paths_json=True):
+    index = {"name": name, "version": "1.0", "build": "0", "subdir": "linux-64"}
+    info_files = [("info/index.json", json.dumps(index).encode("utf-8"))]
+    if paths_json:
+        paths = {
+            "paths": [{"_path": f, "path_type": "hardlink"} for f in pkg_files],
+            "paths_version": 1,
+        }
+        info_files.append(("info/paths.json", json.dumps(paths).encode("utf-8")))
+    info_files.append(("info/files", "\n".join(pkg_files).encode("utf-8")))
+    return info_files
+
+
+def make_artifact(
+    dirname, fname, pkg_files, paths_json=True, info_first=True, payload_size=0,
+):
+    """Make a fake conda artifact with some files in it.
+
+    Parameters
+    ----------
+    dirname : str
+        The directory in which to make the artifact.
+    fname : str
+        The artifact file name (e.g., `foo-1.0-0.tar.bz2`).
+    pkg_files : list of str
+        The files in the artifact. Their contents are their own path.
+    paths_json : bool, optional
+        If False, do not write `info/paths.json`.
+    info_first : bool, optional
+        If False, put the `info/` files at the end of `.tar.bz2` artifacts.
+    payload_size : int, optional
+        If given, add this many random bytes to the contents of each file.
+
+    Returns
+    -------
+    path : str
+        The path to the artifact.
+    """
+    name = fname.rsplit("-", 2)[0]
+    info_files = _make_info_files(name, pkg_files, paths_json=paths_json)
+    payload = [(f, f.encode("utf-8") + os.urandom(payload_size)) for f in pkg_files]
+    path = os.path.join(dirname, fname)
+
+    if fname.endswith(".tar.bz2"):
+        files = info_files + payload if info_first else payload + info_files
+        with open(path, "wb") as fp:
+            _make_tarball(files, fp, "w:bz2")
+    else:
+        nm = fname[:-len(".conda")]
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as zf:
+            zf.writestr(
+                "metadata.json", json.dumps({"conda_pkg_format_version": 2})
+            )
+            for comp, files in [("info", info_files), ("pkg", payload)]:
+                buff = io.BytesIO()
+                _make_tarball(files, buff, "w")
+                zf.writestr(
+                    f"{comp}-{nm}.tar.zst",
+                    zstandard.ZstdCompressor().compress(buff.getvalue()),
+                )
+
+    return path
+
+
+def make_file_list(name, n_files, seed=0):
+    """Make the file list of a synthetic artifact.
+
+    The files are spread over a python package, headers, libraries and
+    scripts like a typical compiled python package.
+    """
+    rng = random.Random(seed)
+    files = set()
+    while len(files) < n_files:
+        kind = rng.random()
+        i = rng.randrange(10 * n_files)
+        if kind < 0.6:
+            files.add(
+                "lib/python3.9/site-packages/%s/sub%d/mod%d.py" % (name, i % 17, i)
+            )
+        elif kind < 0.8:
+            files.add("include/%s/detail%d/header%d.h" % (name, i % 7, i))
+        elif kind < 0.95:
+            files.add("lib/lib%s_%d.so.%d" % (name, i, i % 3))
+        else:
+            files.add("bin/%s-tool%d" % (name, i))
+    return sorted(files)
+
+
+class _ChannelHandler(http.server.SimpleHTTPRequestHandler):
+    """A static file handler that supports single byte ranges and ETags."""
+    def log_message(self, *args):
+        pass
+
+    def end_headers(self):
+        if getattr(self, "_etag", None) is not None:
+            self.send_header("ETag", self._etag)
+        super().end_headers()
+
+    def send_head(self):
+        self.server.stats["requests"] += 1
+        if self.server.errors:
+            self.send_error(self.server.errors.pop(0))
+            return None
+        rng = self.headers.get("Range", None)
+        mtch = re.match(r"bytes=(\d*)-(\d*)$", rng or "")
+        path = self.translate_path(self.path)
+
+        self._etag = None
+        if os.path.isfile(path):
+            with open(path, "rb") as fp:
+                self._etag = '"%s"' % hashlib.md5(fp.read()).hexdigest()
+            if self.headers.get("If-None-Match", None) == self._etag:
+                self.send_response(304)
+                self.end_headers()
+                return None
+
+        if not self.server.ranges or mtch is None or not os.path.isfile(path):
+            return super().send_head()
+
+        size = os.path.getsize(path)
+        if mtch.group(1) and int(mtch.group(1)) >= size:
+            self.send_error(416)
+            return None
+        if mtch.group(1):
+            start = int(mtch.group(1))
+            end = int(mtch.group(2)) if mtch.group(2) else size - 1
+        else:
+            start = max(size - int(mtch.group(2)), 0)
+            end = size - 1
+        end = min(end, size - 1)
+
+        with open(path, "rb") as fp:
+            fp.seek(start)
+            data = fp.read(end - start + 1)
+        self.send_response(206)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        return io.BytesIO(data)
+
+    def copyfile(self, source, outputfile):
+        data = source.read()
+        self.server.stats["bytes"] += len(data)
+        outputfile.write(data)
+
+
+@contextlib.contextmanager
+def local_channel(dirname):
+    """Serve a directory as a channel over HTTP from a thread.
+
+    The server supports single byte ranges and ETags. Set `server.ranges =
+    False` to turn off support for range requests. The next requests are
+    answered with the HTTP error codes in the list `server.errors`. The
+    number of requests and bytes sent are in `server.stats`.
+
+    Parameters
+    ----------
+    dirname : str
+        The directory to serve.
+
+    Yields
+    ------
+    server : http.server.ThreadingHTTPServer
+        The server, with the directory it serves in `server.dir` and its URL
+        in `server.url`.
+    """
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        functools.partial(_ChannelHandler, directory=dirname),
+    )
+    server.dir = dirname
+    server.url = "http://127.0.0.1:%d" % server.server_address[1]
+    server.ranges = True
+    server.errors = []
+    server.stats = {"requests": 0, "bytes": 0}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,31 @@
+import pytest
+
+from .. import rules
+from ..synthetic import local_channel, make_artifact
+
+
+@pytest.fixture(autouse=True)
+def rules_cache_dir(tmp_path, monkeypatch):
+    """Keep the rule bundles made by the tests out of the home directory."""
+    pth = str(tmp_path / "rules_cache")
+    # the environment variable is for worker processes
+    monkeypatch.setenv("CF_ARTIFACT_VALIDATION_RULES_CACHE_DIR", pth)
+    monkeypatch.setattr(rules, "RULES_CACHE_DIR", pth)
+    return pth
+
+
+@pytest.fixture
+def artifact_factory(tmp_path):
+    def _factory(fname, pkg_files, **kwargs):
+        return make_artifact(str(tmp_path), fname, pkg_files, **kwargs)
+
+    return _factory
+
+
+@pytest.fixture
+def channel_server(tmp_path):
+    """A local HTTP server for a fake channel. See `synthetic.local_channel`."""
+    chan_dir = tmp_path / "channel"
+    chan_dir.mkdir()
+    with local_channel(str(chan_dir)) as server:
+        yield server
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+from ..artifact_paths import (
+    get_artifact_paths,
+    get_remote_conda_paths,
+    add_parent_dirs,
+)
+from ..synthetic import make_artifact
+
+PKG_FILES = [
+    "bin/foo",
+    "lib/python3.9/site-packages/foo/__init__.py",
+    "lib/python3.9/site-packages/foo/bar/baz.py",
+]
+
+
+@pytest.mark.parametrize("paths_json", [True, False])
+@pytest.mark.parametrize("info_first", [True, False])
+@pytest.mark.parametrize("ext", [".tar.bz2", ".conda"])
+def test_get_artifact_paths(artifact_factory, ext, info_first, paths_json):
+    path = artifact_factory(
+        "foo-1.0-0" + ext, PKG_FILES, paths_json=paths_json, info_first=info_first,
+    )
+    paths = get_artifact_paths(path)
+
+    for fname in PKG_FILES + ["info/index.json"]:
+        assert fname in paths
+    assert ("info/paths.json" in paths) is paths_json
+    assert paths == sorted(set(paths))
+
+
+def test_get_artifact_paths_bad_ext():
+    with pytest.raises(RuntimeError):
+        get_artifact_paths("foo-1.0-0.zip")
+
+
+def test_add_parent_dirs():
+    assert add_parent_dirs(["a/b/c", "a/b/d", "e"]) == [
+        "a", "a/b", "a/b/c", "a/b/d", "e",
+    ]
+
+
+def test_get_remote_conda_paths(channel_server):
+    path = make_artifact(
+        channel_server.dir, "foo-1.0-0.conda", PKG_FILES, payload_size=5_000_000,
+    )
+    paths = get_remote_conda_paths(channel_server.url + "/foo-1.0-0.conda")
+
+    assert paths == get_artifact_paths(path)
+    # we should only get the end of the file and maybe the info component
+    assert channel_server.stats["bytes"] < os.path.getsize(path) / 10
+
+
+def test_get_remote_conda_paths_no_ranges(channel_server):
+    make_artifact(channel_server.dir, "foo-1.0-0.conda", PKG_FILES)
+    channel_server.ranges = False
+    assert get_remote_conda_paths(channel_server.url + "/foo-1.0-0.conda") is None
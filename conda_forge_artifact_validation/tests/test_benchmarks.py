@@ -0,0 +1,51 @@
+from ..benchmarks import (
+    make_validate_yamls,
+    run_benchmarks,
+    compare_results,
+)
+from ..rules import RuleSet
+from ..synthetic import make_file_list
+
+SMALL_PARAMS = {
+    "n_files": 20,
+    "payload_size": 8,
+    "n_literals": 30,
+    "n_python_yamls": 3,
+    "n_artifacts": 6,
+    "n_listing_paths": 100,
+    "repeat": 1,
+}
+
+
+def test_synthetic_data():
+    files = make_file_list("pypkg0", 100)
+    assert len(files) == 100
+    assert files == make_file_list("pypkg0", 100)
+
+    validate_yamls = make_validate_yamls(30, 3)
+    assert len(validate_yamls["openssl.generated"]["files"]) == 30
+    rule_set = RuleSet(validate_yamls)
+    assert len(rule_set) == 4
+
+    # the python files are owned by their package
+    valid, bad_pths = rule_set.match("foo", files)
+    assert not valid
+    assert list(bad_pths) == ["pypkg0.python.generated"]
+    assert rule_set.match("pypkg0", files)[0]
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(params=SMALL_PARAMS, label="blah")
+    assert results["label"] == "blah"
+    assert results["params"] == SMALL_PARAMS
+    for name in ["match", "validate_file_stream_conda", "generate_python", "scan"]:
+        assert results["benchmarks"][name]["seconds"] > 0
+        assert results["benchmarks"][name]["items"] > 0
+
+
+def test_compare_results():
+    old = {"label": "a", "benchmarks": {"x": {"seconds": 1.0}, "y": {"seconds": 1.0}}}
+    new = {"label": "b", "benchmarks": {"x": {"seconds": 1.5}, "y": {"seconds": 1.05}}}
+    report, regressions = compare_results(old, new, threshold=0.1)
+    assert regressions == ["x"]
+    assert "slower" in report.splitlines()[1]
@@ -0,0 +1,97 @@
+import concurrent.futures
+import json
+import os
+
+from ..blob_cache import BlobCache, BlobFetcher, fetch_blob_file_lists
+
+
+def test_blob_cache(tmp_path):
+    pth = str(tmp_path / "cache" / "blobs.sqlite")
+    with BlobCache(pth, commit_every=1) as cache:
+        assert cache.get("a.json") is None
+        cache.put("a.json", ["bin/a"])
+        cache.put("b.json", ["bin/b", "lib/libb.so"])
+        assert cache.get("a.json") == ["bin/a"]
+        assert "b.json" in cache
+        assert cache.hits == 1
+        assert cache.misses == 1
+        assert len(cache) == 2
+        total_bytes = cache.total_bytes
+
+    # make sure it persists
+    with BlobCache(pth) as cache:
+        assert len(cache) == 2
+        assert cache.total_bytes == total_bytes
+        assert cache.get("b.json") == ["bin/b", "lib/libb.so"]
+
+
+def test_blob_cache_evict(tmp_path):
+    files = ["lib/f%d" % i for i in range(100)]
+    with BlobCache(str(tmp_path / "blobs.sqlite")) as cache:
+        cache.put("0.json", files)
+        size = cache.total_bytes
+        cache.max_bytes = int(size * 3.5)
+        cache.put("1.json", files)
+        cache.put("2.json", files)
+        # 0 is used so 1 is the least recently used
+        assert cache.get("0.json") == files
+        cache.put("3.json", files)
+
+        assert len(cache) == 3
+        assert "1.json" not in cache
+        assert cache.total_bytes == 3 * size
+
+
+def _write_blob(root, pth, files):
+    full_pth = os.path.join(root, pth)
+    os.makedirs(os.path.dirname(full_pth), exist_ok=True)
+    with open(full_pth, "w") as fp:
+        json.dump({"name": "blah", "files": files}, fp)
+
+
+def test_fetch_blob_file_lists(tmp_path, channel_server):
+    _write_blob(channel_server.dir, "artifacts/a/a-1.json", ["bin/a"])
+    _write_blob(channel_server.dir, "artifacts/a/a-2.json", ["bin/a", "bin/a2"])
+    pths = ["artifacts/a/a-1.json", "artifacts/a/a-2.json", "artifacts/a/a-3.json"]
+
+    with BlobCache(str(tmp_path / "blobs.sqlite")) as cache:
+        file_lists = fetch_blob_file_lists(pths, cache=cache, url=channel_server.url)
+        assert file_lists == {
+            "artifacts/a/a-1.json": ["bin/a"],
+            "artifacts/a/a-2.json": ["bin/a", "bin/a2"],
+            "artifacts/a/a-3.json": None,
+        }
+        assert len(cache) == 2
+        n_requests = channel_server.stats["requests"]
+
+        # only the missing blob is asked for again
+        assert fetch_blob_file_lists(
+            pths, cache=cache, url=channel_server.url,
+        ) == file_lists
+        assert channel_server.stats["requests"] == n_requests + 1
+
+        assert fetch_blob_file_lists(
+            pths, cache=cache, url=channel_server.url, offline=True,
+        ) == file_lists
+        assert channel_server.stats["requests"] == n_requests + 1
+
+
+def test_blob_fetcher(tmp_path, channel_server):
+    pths = ["artifacts/a/a-%d.json" % i for i in range(20)]
+    for pth in pths:
+        _write_blob(channel_server.dir, pth, [pth])
+
+    with BlobCache(str(tmp_path / "blobs.sqlite")) as cache, \
+            BlobFetcher(cache=cache, url=channel_server.url, n_jobs=4) as fetcher:
+        # every caller gets all of its blobs but each is only downloaded once
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(
+                fetcher.fetch, [pths, pths[::-1], pths[5:], pths[:3]],
+            ))
+
+        for res in results:
+            assert all(res[pth] == [pth] for pth in res)
+        assert len(results[0]) == 20
+        assert fetcher.n_downloads == 20
+        assert channel_server.stats["requests"] == 20
+        assert len(cache) == 20
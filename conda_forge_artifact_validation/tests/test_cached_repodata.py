@@ -0,0 +1,290 @@
+import copy
+import gzip
+import hashlib
+import json
+import os
+import pickle
+
+import pytest
+import requests
+
+from .. import cached_repodata
+from ..cached_repodata import (
+    DiskRepodataCache,
+    apply_json_patch,
+    CompactRepodata,
+    PackageRecord,
+)
+
+
+def _rd(n):
+    return {
+        "info": {"subdir": "linux-64"},
+        "packages": {
+            "pkg-%d-0.tar.bz2" % i: {"name": "pkg", "md5": "%032d" % i}
+            for i in range(n)
+        },
+    }
+
+
+def _hash(data):
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+def _write_repodata(server, rd):
+    os.makedirs(os.path.join(server.dir, "linux-64"), exist_ok=True)
+    data = json.dumps(rd).encode("utf-8")
+    with open(os.path.join(server.dir, "linux-64", "repodata.json"), "wb") as fp:
+        fp.write(data)
+    return _hash(data)
+
+
+def _write_jlap(server, patches, latest):
+    iv = b"\x00" * 32
+    lines = [json.dumps(p).encode("utf-8") for p in patches]
+    lines.append(json.dumps({"url": "repodata.json", "latest": latest}).encode("utf-8"))
+    running = iv
+    for line in lines:
+        running = hashlib.blake2b(line, key=running, digest_size=32).digest()
+    lines = [iv.hex().encode("utf-8")] + lines + [running.hex().encode("utf-8")]
+    with open(os.path.join(server.dir, "linux-64", "repodata.jlap"), "wb") as fp:
+        fp.write(b"\n".join(lines) + b"\n")
+
+
+def _add_package(rd, i):
+    new_rd = copy.deepcopy(rd)
+    new_rd["packages"]["pkg-%d-0.tar.bz2" % i] = {"name": "pkg", "md5": "%032d" % i}
+    patch = [{
+        "op": "add",
+        "path": "/packages/pkg-%d-0.tar.bz2" % i,
+        "value": {"name": "pkg", "md5": "%032d" % i},
+    }]
+    return new_rd, patch
+
+
+def test_apply_json_patch():
+    doc = {"a/b": {"c~d": 1}, "l": [1, 2, 3]}
+    apply_json_patch(doc, [
+        {"op": "replace", "path": "/a~1b/c~0d", "value": 2},
+        {"op": "add", "path": "/l/1", "value": 5},
+        {"op": "add", "path": "/l/-", "value": 6},
+        {"op": "remove", "path": "/l/0"},
+        {"op": "move", "from": "/l", "path": "/m"},
+        {"op": "copy", "from": "/a~1b", "path": "/e"},
+        {"op": "test", "path": "/e/c~0d", "value": 2},
+    ])
+    assert doc == {"a/b": {"c~d": 2}, "m": [5, 2, 3, 6], "e": {"c~d": 2}}
+
+
+def test_disk_repodata_cache_conditional(channel_server, tmp_path):
+    rd = _rd(100)
+    _write_repodata(channel_server, rd)
+    cache = DiskRepodataCache(
+        str(tmp_path / "cache"), channel_url=channel_server.url,
+        session=requests.Session(),
+    )
+
+    assert cache.get("linux-64") == rd
+    full_bytes = channel_server.stats["bytes"]
+    assert full_bytes > 0
+
+    # nothing changed so nothing is sent
+    assert cache.get("linux-64") == rd
+    assert channel_server.stats["bytes"] == full_bytes
+
+    # a new instance reads from disk
+    cache = DiskRepodataCache(
+        str(tmp_path / "cache"), channel_url=channel_server.url,
+        session=requests.Session(),
+    )
+    assert cache.get("linux-64") == rd
+    assert channel_server.stats["bytes"] == full_bytes
+
+    rd = _rd(10)
+    _write_repodata(channel_server, rd)
+    assert cache.get("linux-64") == rd
+
+
+def test_disk_repodata_cache_compress(channel_server, tmp_path):
+    rd = _rd(10)
+    _write_repodata(channel_server, rd)
+    for compress in [True, False]:
+        cache_dir = tmp_path / ("cache-%s" % compress)
+        cache = DiskRepodataCache(
+            str(cache_dir), channel_url=channel_server.url, compress=compress,
+            session=requests.Session(),
+        )
+        assert cache.get("linux-64") == rd
+        base = os.path.join(
+            str(cache_dir), channel_server.url.split("://")[-1], "linux-64",
+        )
+        if compress:
+            with gzip.open(os.path.join(base, "repodata.json.gz"), "rb") as fp:
+                assert json.loads(fp.read()) == rd
+        else:
+            with open(os.path.join(base, "repodata.json"), "rb") as fp:
+                assert json.loads(fp.read()) == rd
+
+
+def test_disk_repodata_cache_jlap(channel_server, tmp_path):
+    rd = _rd(1000)
+    h0 = _write_repodata(channel_server, rd)
+    cache = DiskRepodataCache(
+        str(tmp_path / "cache"), channel_url=channel_server.url,
+        session=requests.Session(),
+    )
+    assert cache.get("linux-64") == rd
+
+    rd1, patch1 = _add_package(rd, 1000)
+    h1 = _write_repodata(channel_server, rd1)
+    patches = [{"from": h0, "to": h1, "patch": patch1}]
+    _write_jlap(channel_server, patches, h1)
+
+    n_bytes = channel_server.stats["bytes"]
+    assert cache.get("linux-64") == rd1
+    jlap_bytes = channel_server.stats["bytes"] - n_bytes
+    assert jlap_bytes < os.path.getsize(
+        os.path.join(channel_server.dir, "linux-64", "repodata.json")
+    )
+
+    # the next update only fetches the end of the jlap file
+    rd2, patch2 = _add_package(rd1, 1001)
+    h2 = _write_repodata(channel_server, rd2)
+    patches.append({"from": h1, "to": h2, "patch": patch2})
+    _write_jlap(channel_server, patches, h2)
+
+    n_bytes = channel_server.stats["bytes"]
+    assert cache.get("linux-64") == rd2
+    assert channel_server.stats["bytes"] - n_bytes < jlap_bytes
+
+    # no changes
+    n_bytes = channel_server.stats["bytes"]
+    assert cache.get("linux-64") == rd2
+    assert channel_server.stats["bytes"] - n_bytes < jlap_bytes
+
+
+def test_disk_repodata_cache_jlap_fallback(channel_server, tmp_path):
+    rd = _rd(10)
+    _write_repodata(channel_server, rd)
+    cache = DiskRepodataCache(
+        str(tmp_path / "cache"), channel_url=channel_server.url,
+        session=requests.Session(),
+    )
+    assert cache.get("linux-64") == rd
+
+    # the patches do not start at our version of the repodata
+    rd1, patch1 = _add_package(rd, 10)
+    h1 = _write_repodata(channel_server, rd1)
+    _write_jlap(channel_server, [{"from": "0" * 64, "to": h1, "patch": patch1}], h1)
+    assert cache.get("linux-64") == rd1
+
+    # a corrupt jlap file
+    rd2, _ = _add_package(rd1, 11)
+    _write_repodata(channel_server, rd2)
+    jlap_pth = os.path.join(channel_server.dir, "linux-64", "repodata.jlap")
+    with open(jlap_pth, "wb") as fp:
+        fp.write(b"blah\nblah\nblah\n")
+    assert cache.get("linux-64") == rd2
+
+
+def test_disk_repodata_cache_offline(channel_server, tmp_path, monkeypatch):
+    rd = _rd(10)
+    _write_repodata(channel_server, rd)
+    cache_dir = str(tmp_path / "cache")
+    DiskRepodataCache(cache_dir, channel_url=channel_server.url).get("linux-64")
+
+    n_requests = channel_server.stats["requests"]
+    _write_repodata(channel_server, _rd(11))
+    cache = DiskRepodataCache(
+        cache_dir, channel_url=channel_server.url, offline=True,
+    )
+    assert cache.get("linux-64") == rd
+    with pytest.raises(RuntimeError, match="no cached repodata"):
+        cache.get("osx-64")
+    assert channel_server.stats["requests"] == n_requests
+
+    # the repodata of the main channel
+    DiskRepodataCache(cache_dir)._write("linux-64", rd, {})
+    monkeypatch.setattr(cached_repodata, "REPODATA_CACHE_DIR", cache_dir)
+    assert cached_repodata._load_repodata_retry("linux-64", offline=True) == rd
+    monkeypatch.setattr(cached_repodata, "REPODATA_CACHE_DIR", "")
+    with pytest.raises(RuntimeError, match="no repodata cache"):
+        cached_repodata._load_repodata_retry("linux-64", offline=True)
+    assert channel_server.stats["requests"] == n_requests
+
+
+def test_compact_repodata():
+    rd = {
+        "info": {"subdir": "linux-64"},
+        "packages": {
+            "numpy-1.19.4-py36hcf5569d_1.tar.bz2": {
+                "name": "numpy",
+                "version": "1.19.4",
+                "build": "py36hcf5569d_1",
+                "md5": "a" * 32,
+                "sha256": "b" * 64,
+                "size": 100,
+                "timestamp": 1000,
+                "depends": ["python >=3.6,<3.7"],
+                "license": "BSD-3-Clause",
+            },
+            "numpy-1.19.4-py37hcf5569d_1.tar.bz2": {
+                "name": "numpy",
+                "version": "1.19.4",
+                "build": "py37hcf5569d_1",
+                "md5": "c" * 32,
+            },
+        },
+        "packages.conda": {
+            "numpy-1.19.4-py38hcf5569d_1.conda": {
+                "name": "numpy",
+                "version": "1.19.4",
+                "build": "py38hcf5569d_1",
+                "md5": "d" * 32,
+            },
+        },
+    }
+    crd = CompactRepodata(json.loads(json.dumps(rd)))
+
+    assert len(crd) == 3
+    assert "numpy-1.19.4-py36hcf5569d_1.tar.bz2" in crd
+    assert "numpy-1.19.4-py38hcf5569d_1.conda" in crd
+    assert "numpy-1.19.4-py38hcf5569d_1.conda" not in crd.packages
+    assert "numpy-1.19.4-py39hcf5569d_1.tar.bz2" not in crd
+    assert crd.get("numpy-1.19.4-py38hcf5569d_1.conda").md5 == "d" * 32
+
+    rec = crd.packages["numpy-1.19.4-py36hcf5569d_1.tar.bz2"]
+    assert rec.fn == "numpy-1.19.4-py36hcf5569d_1.tar.bz2"
+    assert rec.name == "numpy"
+    assert rec.version == "1.19.4"
+    assert rec.build == "py36hcf5569d_1"
+    assert rec.md5 == "a" * 32
+    assert rec.sha256 == "b" * 64
+    assert rec.size == 100
+    assert rec.timestamp == 1000
+    assert not hasattr(rec, "__dict__")
+
+    rec2 = crd.packages["numpy-1.19.4-py37hcf5569d_1.tar.bz2"]
+    assert rec2.sha256 is None
+    assert rec2.timestamp == 0
+    assert rec.name is rec2.name
+    assert rec.version is rec2.version
+
+    assert pickle.loads(pickle.dumps(rec)) == rec
+
+
+def test_compact_repodata_cache(monkeypatch):
+    calls = []
+
+    def _load(subdir, offline=False):
+        calls.append((subdir, offline))
+        return {"packages": {"a-1-0.tar.bz2": {"name": "a", "md5": "0" * 32}}}
+
+    monkeypatch.setattr(cached_repodata, "_load_repodata_retry", _load)
+    cache = cached_repodata.CompactRepodataCache()
+    assert "a-1-0.tar.bz2" in cache["linux-64"].packages
+    assert isinstance(cache["linux-64"].packages["a-1-0.tar.bz2"], PackageRecord)
+    assert calls == [("linux-64", False)]
+
+    assert "a-1-0.tar.bz2" in cache.load("osx-64", offline=True)
+    assert calls == [("linux-64", False), ("osx-64", True)]
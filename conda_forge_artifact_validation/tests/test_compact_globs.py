@@ -0,0 +1,86 @@
+from ..compact_globs import (
+    compact_files,
+    find_unsafe_dir_globs,
+    format_compaction_report,
+)
+from ..file_index import FileListIndex
+
+FILES = [
+    "share/doc/foo/a.txt",
+    "share/doc/foo/b.txt",
+    "share/doc/foo/html/c.html",
+    "share/doc/foo/html/d.html",
+    "lib/foo/x.so",
+    "lib/foo/y.so",
+    "lib/foo/sub/z.so",
+    "bin/foo",
+    "include/foo/one.h",
+    "site-packages/foo/**/*",
+]
+
+
+def test_compact_files(tmp_path):
+    with FileListIndex(str(tmp_path / "index.sqlite")) as index:
+        index.put("linux-64", "foo-1-0.tar.bz2", FILES[:-1])
+        # another artifact writes to one of the directories
+        index.put(
+            "linux-64", "bar-1-0.tar.bz2",
+            ["lib/foo/sub/bar.so", "bin/bar", "share/doc/bar/README"],
+        )
+
+        assert compact_files(FILES, index.iter_paths) == [
+            "bin/foo",
+            "include/foo/one.h",
+            "lib/foo/sub/z.so",
+            "lib/foo/x.so",
+            "lib/foo/y.so",
+            "share/doc/foo/**/*",
+            "site-packages/foo/**/*",
+        ]
+        assert compact_files(FILES, index.iter_paths, min_files=5) == sorted(FILES)
+        assert compact_files(FILES, index.iter_paths, min_depth=4) == [
+            "bin/foo",
+            "include/foo/one.h",
+            "lib/foo/sub/z.so",
+            "lib/foo/x.so",
+            "lib/foo/y.so",
+            "share/doc/foo/a.txt",
+            "share/doc/foo/b.txt",
+            "share/doc/foo/html/**/*",
+            "site-packages/foo/**/*",
+        ]
+
+        # literal paths under a directory glob are removed
+        assert compact_files(
+            ["share/doc/foo/**/*", "share/doc/foo/new.txt", "bin/foo"],
+            index.iter_paths,
+        ) == ["bin/foo", "share/doc/foo/**/*"]
+
+
+def test_compact_files_unknown_paths(tmp_path):
+    with FileListIndex(str(tmp_path / "index.sqlite")) as index:
+        # nothing is known so nothing can be shown to be safe
+        assert compact_files(FILES, index.iter_paths) == sorted(FILES)
+
+        index.put("linux-64", "foo-1-0.tar.bz2", FILES[:2])
+        assert compact_files(FILES, index.iter_paths) == sorted(FILES)
+
+
+def test_find_unsafe_dir_globs(tmp_path):
+    with FileListIndex(str(tmp_path / "index.sqlite")) as index:
+        index.put("linux-64", "foo-1-0.tar.bz2", FILES[:4])
+        globs = ["share/doc/foo/**/*", "share/doc/foo/html/**/*", "bin/*"]
+        assert find_unsafe_dir_globs(globs, FILES, index.iter_paths) == []
+
+        index.put("linux-64", "bar-1-0.tar.bz2", ["share/doc/foo/bar.txt"])
+        assert find_unsafe_dir_globs(globs, FILES, index.iter_paths) == [
+            "share/doc/foo/**/*",
+        ]
+
+
+def test_format_compaction_report():
+    report = format_compaction_report({"a.yaml": (10, 2), "b.yaml": (5, 5)})
+    lines = report.splitlines()
+    assert len(lines) == 3
+    assert lines[1].split() == ["a.yaml", "10", "2"]
+    assert lines[-1] == "compacted 15 rules to 7 (53.3% fewer) in 1 validate yamls"
@@ -0,0 +1,109 @@
+import hashlib
+import os
+
+import pytest
+import requests
+
+from ..download import download_file, get_session, ChecksumError
+
+
+def _write(channel_server, data):
+    with open(os.path.join(channel_server.dir, "foo.txt"), "wb") as fp:
+        fp.write(data)
+    return channel_server.url + "/foo.txt"
+
+
+def test_get_session():
+    assert get_session() is get_session()
+
+
+def test_download_file(channel_server, tmp_path):
+    data = os.urandom(3_000_000)
+    url = _write(channel_server, data)
+    md5 = hashlib.md5(data).hexdigest()
+    sha256 = hashlib.sha256(data).hexdigest()
+
+    pth = str(tmp_path / "foo.txt")
+    info = download_file(url, pth, md5sum=md5, sha256=sha256)
+    assert info == {"md5": md5, "sha256": sha256, "bytes": len(data)}
+    with open(pth, "rb") as fp:
+        assert fp.read() == data
+
+    # the sha256 is only computed to check it
+    info = download_file(url, pth, md5sum=md5)
+    assert info == {"md5": md5, "sha256": None, "bytes": len(data)}
+
+
+@pytest.mark.parametrize("kind", ["md5", "sha256"])
+def test_download_file_bad_checksum(channel_server, tmp_path, kind):
+    url = _write(channel_server, b"blah")
+    pth = str(tmp_path / "foo.txt")
+
+    # retried twice by default
+    with pytest.raises(ChecksumError) as e:
+        download_file(url, pth, max_wait=0, **{
+            ("md5sum" if kind == "md5" else "sha256"): "c7",
+        })
+
+    assert e.value.kind == kind
+    assert not os.path.exists(pth)
+    assert channel_server.stats["requests"] == 3
+
+    # and never more than the attempts
+    with pytest.raises(ChecksumError):
+        download_file(url, pth, md5sum="c7", max_attempts=2, max_wait=0)
+    assert channel_server.stats["requests"] == 5
+
+    with pytest.raises(ChecksumError):
+        download_file(url, pth, md5sum="c7", max_wait=0, max_checksum_retries=0)
+    assert channel_server.stats["requests"] == 6
+
+
+def test_download_file_checksum_retry(channel_server, tmp_path, monkeypatch):
+    data = b"blah"
+    url = _write(channel_server, data)
+    pth = str(tmp_path / "foo.txt")
+
+    # the first transfer is corrupted
+    n_calls = []
+    _iter_content = requests.Response.iter_content
+
+    def _corrupt(self, *args, **kwargs):
+        n_calls.append(1)
+        for chunk in _iter_content(self, *args, **kwargs):
+            yield chunk if len(n_calls) > 1 else chunk[::-1]
+
+    monkeypatch.setattr(requests.Response, "iter_content", _corrupt)
+    info = download_file(url, pth, md5sum=hashlib.md5(data).hexdigest(), max_wait=0)
+    assert info["bytes"] == 4
+    assert channel_server.stats["requests"] == 2
+    with open(pth, "rb") as fp:
+        assert fp.read() == data
+
+
+def test_download_file_missing(channel_server, tmp_path):
+    with pytest.raises(requests.HTTPError):
+        download_file(
+            channel_server.url + "/bar.txt",
+            str(tmp_path / "bar.txt"),
+            max_attempts=2,
+            max_wait=0,
+        )
+    # a missing file is not retried
+    assert channel_server.stats["requests"] == 1
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_download_file_retry(channel_server, tmp_path, status):
+    url = _write(channel_server, b"blah")
+    pth = str(tmp_path / "foo.txt")
+
+    channel_server.errors = [status]
+    info = download_file(url, pth, max_attempts=2, max_wait=0)
+    assert info["bytes"] == 4
+    assert channel_server.stats["requests"] == 2
+
+    channel_server.errors = [status] * 2
+    with pytest.raises(requests.HTTPError):
+        download_file(url, pth, max_attempts=2, max_wait=0)
+    assert channel_server.stats["requests"] == 4
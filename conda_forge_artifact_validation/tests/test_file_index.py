@@ -0,0 +1,151 @@
+import json
+import os
+
+from .. import scan
+from ..file_index import FileListIndex, build_file_index, get_artifact_key
+from ..scan import get_libcfgraph_artifact_path, get_libcfgraph_file_list
+
+
+def _write_blob(root, name, subdir, pkg, files):
+    pth = os.path.join(str(root), get_libcfgraph_artifact_path(name, subdir, pkg))
+    os.makedirs(os.path.dirname(pth), exist_ok=True)
+    with open(pth, "w") as fp:
+        json.dump({"files": files}, fp)
+
+
+def test_get_artifact_key():
+    assert get_artifact_key("linux-64", "a-1-0.tar.bz2") == "linux-64/a-1-0"
+    assert get_artifact_key("linux-64", "a-1-0.conda") == "linux-64/a-1-0"
+    assert get_artifact_key("linux-64", "a-1-0.json") == "linux-64/a-1-0"
+
+
+def test_file_list_index(tmp_path):
+    pth = str(tmp_path / "index.sqlite")
+    with FileListIndex(pth, commit_every=1) as index:
+        index.put("linux-64", "a-1-0.tar.bz2", ["bin/a", "lib/liba.so", "bin/a"])
+        index.put("linux-64", "b-1-0.tar.bz2", ["bin/b", "lib/liba.so"])
+        assert sorted(index.get("linux-64", "a-1-0.conda")) == ["bin/a", "lib/liba.so"]
+        assert index.get("linux-64", "c-1-0.tar.bz2") is None
+        assert index.get("noarch", "a-1-0.tar.bz2") is None
+        assert index.hits == 1
+        assert index.misses == 2
+
+    with FileListIndex(pth) as index:
+        assert len(index) == 2
+        assert sorted(index.get("linux-64", "b-1-0.tar.bz2")) == [
+            "bin/b", "lib/liba.so",
+        ]
+        # paths are stored once
+        n_paths = index._conn.execute("SELECT COUNT(*) FROM paths").fetchone()[0]
+        assert n_paths == 3
+
+        big = ["lib/f%d" % i for i in range(2000)]
+        index.put("linux-64", "big-1-0.tar.bz2", big)
+        assert sorted(index.get("linux-64", "big-1-0.tar.bz2")) == sorted(big)
+
+
+def test_file_list_index_source(tmp_path):
+    pth = str(tmp_path / "index.sqlite")
+    with FileListIndex(pth) as index:
+        index.put("linux-64", "a-1-0.tar.bz2", ["bin/a"])
+        index.put("linux-64", "b-1-0.conda", ["bin/b"], source="download")
+        assert index.get("linux-64", "a-1-0.conda", return_source=True) == (
+            ["bin/a"], "libcfgraph",
+        )
+        assert index.get("linux-64", "b-1-0.tar.bz2", return_source=True) == (
+            ["bin/b"], "download",
+        )
+        assert index.get("linux-64", "c-1-0.conda", return_source=True) == (
+            None, None,
+        )
+
+    # indexes without the source take it from how the artifact was scanned
+    with FileListIndex(pth) as index:
+        index.mark_scanned("linux-64", "b-1-0.conda", "b", "download", "fp")
+        index._conn.execute("ALTER TABLE artifacts DROP COLUMN source")
+        index._conn.commit()
+    with FileListIndex(pth) as index:
+        assert index.get("linux-64", "a-1-0.conda", return_source=True)[1] == (
+            "libcfgraph"
+        )
+        assert index.get("linux-64", "b-1-0.conda", return_source=True)[1] == (
+            "download"
+        )
+
+
+def test_file_list_index_iter_paths(tmp_path):
+    with FileListIndex(str(tmp_path / "index.sqlite")) as index:
+        index.put("linux-64", "a-1-0.tar.bz2", ["lib/a/%03d" % i for i in range(25)])
+        index.put("linux-64", "b-1-0.tar.bz2", ["lib/a", "lib/a0", "lib/b/x", "lib/é"])
+
+        assert list(index.iter_paths("lib/a/", chunk_size=4)) == [
+            "lib/a/%03d" % i for i in range(25)
+        ]
+        assert list(index.iter_paths("lib/b/")) == ["lib/b/x"]
+        assert list(index.iter_paths("lib/c/")) == []
+        assert len(list(index.iter_paths("", chunk_size=7))) == 29
+
+
+def test_file_list_index_misses(tmp_path):
+    with FileListIndex(str(tmp_path / "index.sqlite")) as index:
+        assert not index.is_known_miss("linux-64", "a-1-0.tar.bz2")
+        index.add_miss("linux-64", "a-1-0.tar.bz2")
+        assert index.is_known_miss("linux-64", "a-1-0.tar.bz2")
+
+        index.miss_ttl = 0
+        assert not index.is_known_miss("linux-64", "a-1-0.tar.bz2")
+        index.miss_ttl = 100
+
+        index.put("linux-64", "a-1-0.tar.bz2", ["bin/a"])
+        assert not index.is_known_miss("linux-64", "a-1-0.tar.bz2")
+
+
+def test_build_file_index(tmp_path):
+    lcfg = tmp_path / "libcfgraph"
+    _write_blob(lcfg, "a", "linux-64", "a-1-0.tar.bz2", ["bin/a"])
+    _write_blob(lcfg, "a", "osx-64", "a-1-0.tar.bz2", ["bin/a", "lib/liba.dylib"])
+    _write_blob(lcfg, "b", "noarch", "b-1-0.tar.bz2", ["site-packages/b.py"])
+
+    with FileListIndex(str(tmp_path / "index.sqlite")) as index:
+        index.add_miss("linux-64", "a-1-0.tar.bz2")
+        assert build_file_index(str(lcfg), index) == 3
+        assert len(index) == 3
+        assert index.get("linux-64", "a-1-0.conda") == ["bin/a"]
+        assert index.get("noarch", "b-1-0.tar.bz2") == ["site-packages/b.py"]
+        assert not index.is_known_miss("linux-64", "a-1-0.tar.bz2")
+
+
+def test_get_libcfgraph_file_list_index(tmp_path, channel_server, monkeypatch):
+    monkeypatch.setattr(scan, "LIBCFGRAPH_URL", channel_server.url)
+    _write_blob(channel_server.dir, "a", "linux-64", "a-1-0.tar.bz2", ["bin/a"])
+
+    with FileListIndex(str(tmp_path / "index.sqlite")) as index:
+        index.put("linux-64", "b-1-0.tar.bz2", ["bin/b"], source="download")
+        assert get_libcfgraph_file_list(
+            "b", "linux-64", "b-1-0.tar.bz2", None, file_index=index,
+            return_source=True,
+        ) == (["bin/b"], "download")
+        assert channel_server.stats["requests"] == 0
+
+        # found on the server and then stored
+        assert get_libcfgraph_file_list(
+            "a", "linux-64", "a-1-0.tar.bz2", None, file_index=index,
+        ) == ["bin/a"]
+        assert index.get("linux-64", "a-1-0.tar.bz2") == ["bin/a"]
+
+        # not found is recorded so the server is only asked once
+        n_requests = channel_server.stats["requests"]
+        for _ in range(2):
+            assert get_libcfgraph_file_list(
+                "c", "linux-64", "c-1-0.tar.bz2", None, file_index=index,
+            ) is None
+        assert channel_server.stats["requests"] == n_requests + 1
+        assert index.is_known_miss("linux-64", "c-1-0.tar.bz2")
+
+    # network errors are not recorded
+    monkeypatch.setattr(scan, "LIBCFGRAPH_URL", "http://127.0.0.1:1")
+    with FileListIndex(str(tmp_path / "index.sqlite")) as index:
+        assert get_libcfgraph_file_list(
+            "d", "linux-64", "d-1-0.tar.bz2", None, file_index=index,
+        ) is None
+        assert not index.is_known_miss("linux-64", "d-1-0.tar.bz2")
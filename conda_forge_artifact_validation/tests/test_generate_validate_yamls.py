@@ -1,8 +1,92 @@
+import types
+
+import pytest
+import requests
+import yaml
+
+from .. import cached_repodata, generate_validate_yamls
+from ..blob_cache import BlobCache
+from ..cached_repodata import COMPACT_REPODATA_CACHE, DiskRepodataCache
+from ..compact_globs import compact_files
+from ..file_index import FileListIndex
 from ..generate_validate_yamls import (
     generate_validate_yaml_for_python,
     generate_validate_yaml_from_libcfgraph,
     _get_subdir_pkg_from_libcfgraph_artifact,
+    get_source_fingerprint,
+    load_generation_state,
+    save_generation_state,
+    start_target,
+    finish_target,
+    merge_generated_validate_yaml,
 )
+from ..libcfgraph_listing import LibcfgraphListing, write_listing
+
+BLOBS = {
+    "artifacts/foo/conda-forge/linux-64/foo-1.0-0.json": ["bin/foo", "lib/a.py"],
+    "artifacts/foo/conda-forge/osx-64/foo-1.0-0.json": ["bin/foo", "lib/b.py"],
+    # not on the channel anymore
+    "artifacts/foo/conda-forge/linux-64/foo-0.1-0.json": ["bin/old"],
+}
+
+
+@pytest.fixture
+def offline_libcfgraph(tmp_path, monkeypatch):
+    """Run the generator offline from a cached listing and blobs.
+
+    Add blobs with `add_blob(path, files, pkg)` where `pkg` is the artifact
+    on the channel, if any.
+    """
+    packages = {
+        "linux-64": {"foo-1.0-0.tar.bz2"},
+        "osx-64": {"foo-1.0-0.conda"},
+        "noarch": set(),
+    }
+    repodata_dir = str(tmp_path / "repodata")
+    monkeypatch.setattr(cached_repodata, "REPODATA_CACHE_DIR", repodata_dir)
+    monkeypatch.setattr(COMPACT_REPODATA_CACHE, "data", {})
+    monkeypatch.setattr(generate_validate_yamls, "OFFLINE", True)
+
+    def _no_network(*args, **kwargs):
+        raise requests.ConnectionError("the tests are offline")
+
+    monkeypatch.setattr(requests.Session, "request", _no_network)
+    blobs = dict(BLOBS)
+
+    with BlobCache(str(tmp_path / "blobs.sqlite")) as cache:
+        monkeypatch.setattr(generate_validate_yamls, "BLOB_CACHE", cache)
+
+        def _add_blob(pth, files, pkg=None):
+            blobs[pth] = files
+            if pkg is not None:
+                packages[pth.split("/")[-2]].add(pkg)
+
+            # the repodata comes from its disk cache
+            for subdir, pkgs in packages.items():
+                DiskRepodataCache(repodata_dir)._write(subdir, {
+                    "packages": {
+                        p: {"name": "foo", "md5": "0" * 32}
+                        for p in pkgs if p.endswith(".tar.bz2")
+                    },
+                    "packages.conda": {
+                        p: {"name": "foo", "md5": "0" * 32}
+                        for p in pkgs if p.endswith(".conda")
+                    },
+                }, {})
+            COMPACT_REPODATA_CACHE.data.clear()
+
+            for pth, files in blobs.items():
+                cache.put(pth, files)
+            listing_pth = str(tmp_path / ("listing%d.bin" % len(blobs)))
+            write_listing(list(blobs), listing_pth)
+            monkeypatch.setattr(
+                generate_validate_yamls,
+                "LIBCFGRAPH_INDEX",
+                LibcfgraphListing(listing_pth),
+            )
+
+        _add_blob("artifacts/bar/conda-forge/noarch/bar-1.0-0.json", ["bin/bar"])
+        yield types.SimpleNamespace(add_blob=_add_blob)
 
 
 def test_get_subdir_pkg_from_libcfgraph_artifact():
@@ -78,3 +162,160 @@ def test_generate_validate_yaml_for_python():
     )
     assert "lib/python*/site-packages/desmeds/**/*" in validate_yaml["files"]
     assert "lib/python*/site-packages/blah/**/*" in validate_yaml["files"]
+
+
+def test_generate_validate_yaml_offline(offline_libcfgraph):
+    validate_yaml = generate_validate_yaml_from_libcfgraph(
+        "foo", exclude_globs=["lib/**/*"],
+    )
+    assert validate_yaml == {"files": ["bin/foo"], "allowed": ["foo"]}
+
+
+def test_generate_validate_yaml_offline_no_repodata(
+    offline_libcfgraph, tmp_path, monkeypatch,
+):
+    monkeypatch.setattr(
+        cached_repodata, "REPODATA_CACHE_DIR", str(tmp_path / "empty"),
+    )
+    COMPACT_REPODATA_CACHE.data.clear()
+    with pytest.raises(RuntimeError, match="no cached repodata"):
+        generate_validate_yaml_from_libcfgraph("foo")
+
+
+def test_generate_validate_yaml_seen_blobs(offline_libcfgraph):
+    seen_blobs = set()
+    validate_yaml = generate_validate_yaml_from_libcfgraph("foo", seen_blobs=seen_blobs)
+    assert validate_yaml["files"] == ["bin/foo", "lib/a.py", "lib/b.py"]
+    assert seen_blobs == {
+        "artifacts/foo/conda-forge/linux-64/foo-1.0-0.json",
+        "artifacts/foo/conda-forge/osx-64/foo-1.0-0.json",
+    }
+
+    # only the new artifact is used
+    offline_libcfgraph.add_blob(
+        "artifacts/foo/conda-forge/linux-64/foo-2.0-0.json",
+        ["bin/foo", "bin/foo2"],
+        pkg="foo-2.0-0.conda",
+    )
+    validate_yaml = generate_validate_yaml_for_python(
+        "foo", ["foo"], seen_blobs=seen_blobs,
+    )
+    assert "lib/a.py" not in validate_yaml["files"]
+    assert "bin/foo2" in validate_yaml["files"]
+    assert "lib/python*/site-packages/foo/**/*" in validate_yaml["files"]
+    assert len(seen_blobs) == 3
+
+    validate_yaml = generate_validate_yaml_from_libcfgraph("foo", seen_blobs=seen_blobs)
+    assert validate_yaml["files"] == []
+
+
+def test_generation_state(tmp_path):
+    fp1 = get_source_fingerprint({"foo": {"top_level_imports": ["foo"]}})
+    fp2 = get_source_fingerprint({"foo": {"top_level_imports": ["foo", "bar"]}})
+    assert fp1 != fp2
+
+    pth = str(tmp_path / "state.json.gz")
+    state = load_generation_state(pth)
+    assert state == {}
+
+    # with no state, nothing is tracked
+    assert start_target(None, "foo.yaml", fp1) == (None, False, None)
+    finish_target(None, "foo.yaml", fp1, None, [])
+
+    # unknown files are added to
+    seen_blobs, replace, old_files = start_target(state, "foo.yaml", fp1)
+    assert seen_blobs == set()
+    assert not replace
+    assert old_files is None
+    seen_blobs.update(["b.json", "a.json"])
+    finish_target(state, "foo.yaml", fp1, seen_blobs, ["bin/foo", "bin/bar"])
+    save_generation_state(pth, state)
+
+    state = load_generation_state(pth)
+    assert state == {
+        "foo.yaml": {
+            "fingerprint": fp1,
+            "blobs": ["a.json", "b.json"],
+            "files": ["bin/bar", "bin/foo"],
+        },
+    }
+    assert start_target(state, "foo.yaml", fp1) == (
+        {"a.json", "b.json"}, False, ["bin/bar", "bin/foo"],
+    )
+
+    # a changed source is made again from scratch
+    assert start_target(state, "foo.yaml", fp2) == (set(), True, None)
+
+
+def _write_compacted(pth, files, allowed, index):
+    validate_yaml = {
+        "files": compact_files(files, index.iter_paths), "allowed": allowed,
+    }
+    with open(pth, "w") as fp:
+        yaml.dump(validate_yaml, fp)
+    return validate_yaml
+
+
+def test_merge_generated_validate_yaml(tmp_path):
+    pth = str(tmp_path / "foo.generated.yaml")
+    foo_files = ["bin/foo", "share/doc/foo/a.txt", "share/doc/foo/b.txt"]
+
+    # with nothing written yet the new validate yaml is used as is
+    new = {"files": ["bin/foo2"], "allowed": ["foo"]}
+    assert merge_generated_validate_yaml(pth, new) == (new, ["bin/foo2"])
+
+    with FileListIndex(str(tmp_path / "index.sqlite")) as index:
+        index.put("linux-64", "foo-1-0.tar.bz2", foo_files)
+        index.put("linux-64", "baz-1-0.tar.bz2", ["share/doc/baz/README"])
+        old = _write_compacted(pth, foo_files, ["foo"], index)
+        assert "share/doc/foo/**/*" in old["files"]
+
+        # a glob that is still safe is kept, but it is not recorded since the
+        # literal paths were read again
+        new = {"files": foo_files + ["bin/foo2"], "allowed": ["foo", "bar"]}
+        validate_yaml, files = merge_generated_validate_yaml(
+            pth, new, iter_known_paths=index.iter_paths,
+        )
+        assert validate_yaml == {
+            "files": sorted(foo_files + ["bin/foo2", "share/doc/foo/**/*"]),
+            "allowed": ["bar", "foo"],
+        }
+        assert files == sorted(foo_files + ["bin/foo2"])
+
+        # globs cannot be checked without the file index
+        validate_yaml, files = merge_generated_validate_yaml(pth, new)
+        assert validate_yaml == {"files": files, "allowed": ["bar", "foo"]}
+        assert files == sorted(foo_files + ["bin/foo2"])
+
+        # another artifact ships a file in the compacted directory
+        index.put("linux-64", "bar-1-0.tar.bz2", ["share/doc/foo/bar.txt"])
+        validate_yaml, files = merge_generated_validate_yaml(
+            pth, {"files": foo_files, "allowed": ["foo"]},
+            iter_known_paths=index.iter_paths,
+        )
+        assert validate_yaml == {"files": foo_files, "allowed": ["foo"]}
+        assert "share/doc/foo/bar.txt" not in compact_files(
+            validate_yaml["files"], index.iter_paths,
+        )
+
+
+def test_merge_generated_validate_yaml_from_state(tmp_path):
+    # only new json blobs are read, so the old files come from the state
+    pth = str(tmp_path / "foo.generated.yaml")
+    foo_files = ["bin/foo", "share/doc/foo/a.txt", "share/doc/foo/b.txt"]
+    with FileListIndex(str(tmp_path / "index.sqlite")) as index:
+        index.put("linux-64", "foo-1-0.tar.bz2", foo_files)
+        index.put("linux-64", "baz-1-0.tar.bz2", ["share/doc/baz/README"])
+        _write_compacted(pth, foo_files, ["foo"], index)
+
+        # another artifact ships a file in the compacted directory
+        index.put("linux-64", "bar-1-0.tar.bz2", ["share/doc/foo/bar.txt"])
+        validate_yaml, files = merge_generated_validate_yaml(
+            pth, {"files": ["bin/foo2"], "allowed": ["foo"]}, old_files=foo_files,
+            iter_known_paths=index.iter_paths,
+        )
+        assert files == sorted(foo_files + ["bin/foo2"])
+        assert validate_yaml == {"files": files, "allowed": ["foo"]}
+
+        # so compacting again does not claim the other file
+        assert compact_files(validate_yaml["files"], index.iter_paths) == files
@@ -0,0 +1,51 @@
+import os
+
+from ..journal import ScanJournal
+
+
+def test_scan_journal(tmp_path):
+    pth = str(tmp_path / "journal.jsonl")
+
+    with ScanJournal(pth, sync_every=2) as journal:
+        assert len(journal) == 0
+        journal.record("linux-64", "a-1-0.tar.bz2", "a", True, {})
+        journal.record(
+            "linux-64", "b-1-0.tar.bz2", "b", False, {"openssl": ["bin/openssl"]},
+        )
+        journal.record("noarch", "b-1-0.tar.bz2", "b", True, {"openssl": ["bin/blah"]})
+        assert "linux-64/a-1-0.tar.bz2" in journal
+
+    journal = ScanJournal(pth)
+    assert journal.done == {
+        "linux-64/a-1-0.tar.bz2",
+        "linux-64/b-1-0.tar.bz2",
+        "noarch/b-1-0.tar.bz2",
+    }
+    assert journal.invalid == {
+        "b": {"linux-64/b-1-0.tar.bz2": {"bad_paths": {"openssl": ["bin/openssl"]}}},
+    }
+
+    journal.record("linux-64", "c-1-0.tar.bz2", "c", True, {})
+    journal.close()
+    assert len(ScanJournal(pth)) == 4
+
+    journal.clear()
+    assert not os.path.exists(pth)
+
+
+def test_scan_journal_partial_line(tmp_path):
+    pth = str(tmp_path / "journal.jsonl")
+
+    with ScanJournal(pth) as journal:
+        journal.record("linux-64", "a-1-0.tar.bz2", "a", True, {})
+
+    # a process killed while writing
+    with open(pth, "a") as fp:
+        fp.write('{"subdir": "linux-64", "pkg": "b-1')
+
+    with ScanJournal(pth) as journal:
+        assert journal.done == {"linux-64/a-1-0.tar.bz2"}
+        journal.record("linux-64", "c-1-0.tar.bz2", "c", True, {})
+
+    with ScanJournal(pth) as journal:
+        assert journal.done == {"linux-64/a-1-0.tar.bz2", "linux-64/c-1-0.tar.bz2"}
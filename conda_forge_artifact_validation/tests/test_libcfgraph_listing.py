@@ -0,0 +1,105 @@
+import json
+import os
+
+import pytest
+
+from ..libcfgraph_listing import (
+    LibcfgraphListing,
+    write_listing,
+    download_listing,
+    load_listing,
+)
+
+PATHS = [
+    "artifacts/foo/conda-forge/linux-64/foo-1.0-0.json",
+    "artifacts/foo-bar/conda-forge/noarch/foo-bar-1.0-0.json",
+    "artifacts/foo/conda-forge/osx-64/foo-1.0-0.json",
+    "artifacts/foo-bar/conda-forge/noarch/foo-bar-1.0-0.json",
+    "artifacts/fo/conda-forge/noarch/fo-1.0-0.json",
+    "artifacts/zzé/conda-forge/noarch/zzé-1.0-0.json",
+]
+
+
+def test_libcfgraph_listing(tmp_path):
+    pth = str(tmp_path / "listing.bin")
+    assert write_listing(PATHS, pth) == 5
+
+    with LibcfgraphListing(pth) as listing:
+        assert len(listing) == 5
+        assert list(listing) == sorted(set(PATHS))
+        assert listing[-1] == PATHS[-1]
+        with pytest.raises(IndexError):
+            listing[5]
+
+        assert listing.get_artifact_paths("foo") == [
+            "artifacts/foo/conda-forge/linux-64/foo-1.0-0.json",
+            "artifacts/foo/conda-forge/osx-64/foo-1.0-0.json",
+        ]
+        assert listing.get_artifact_paths("foo-bar") == [PATHS[1]]
+        assert listing.get_artifact_paths("zzé") == [PATHS[-1]]
+        assert listing.get_artifact_paths("f") == []
+        assert listing.get_artifact_paths("zzz") == []
+
+    with open(pth, "wb") as fp:
+        fp.write(b"blahblahblahblah")
+    with pytest.raises(ValueError):
+        LibcfgraphListing(pth)
+
+
+def test_libcfgraph_listing_empty(tmp_path):
+    pth = str(tmp_path / "listing.bin")
+    write_listing([], pth)
+    with LibcfgraphListing(pth) as listing:
+        assert len(listing) == 0
+        assert listing.get_artifact_paths("foo") == []
+
+
+def _write_shards(dirname, shards):
+    with open(os.path.join(dirname, ".file_listing_meta.json"), "w") as fp:
+        json.dump({"n_files": len(shards)}, fp)
+    for i, shard in enumerate(shards):
+        with open(os.path.join(dirname, ".file_listing_%d.json" % i), "w") as fp:
+            json.dump(shard, fp)
+
+
+def test_download_listing(tmp_path, channel_server):
+    _write_shards(channel_server.dir, [PATHS[:2], PATHS[2:4], PATHS[4:]])
+    pth = str(tmp_path / "listing.bin")
+    assert download_listing(pth, url=channel_server.url) == 5
+    with LibcfgraphListing(pth) as listing:
+        assert list(listing) == sorted(set(PATHS))
+
+
+def test_load_listing(tmp_path, channel_server):
+    _write_shards(channel_server.dir, [PATHS])
+    cache_dir = str(tmp_path / "cache")
+    with load_listing(cache_dir=cache_dir, url=channel_server.url) as listing:
+        assert len(listing) == 5
+    n_requests = channel_server.stats["requests"]
+
+    # the cached listing is used until it is too old
+    with load_listing(cache_dir=cache_dir, url=channel_server.url) as listing:
+        assert len(listing) == 5
+    assert channel_server.stats["requests"] == n_requests
+
+    _write_shards(channel_server.dir, [PATHS[:1]])
+    with load_listing(
+        cache_dir=cache_dir, url=channel_server.url, max_age=-1,
+    ) as listing:
+        assert len(listing) == 1
+
+    with load_listing(cache_dir="", url=channel_server.url) as listing:
+        assert len(listing) == 1
+
+
+def test_load_listing_offline(tmp_path, channel_server):
+    cache_dir = str(tmp_path / "cache")
+    with pytest.raises(RuntimeError):
+        load_listing(cache_dir=cache_dir, offline=True)
+
+    _write_shards(channel_server.dir, [PATHS])
+    load_listing(cache_dir=cache_dir, url=channel_server.url).close()
+    n_requests = channel_server.stats["requests"]
+    with load_listing(cache_dir=cache_dir, max_age=-1, offline=True) as listing:
+        assert len(listing) == 5
+    assert channel_server.stats["requests"] == n_requests
@@ -0,0 +1,68 @@
+import json
+import pickle
+import time
+
+from ..metrics import Metrics
+
+
+def test_metrics():
+    metrics = Metrics()
+    with metrics.time("download"):
+        time.sleep(0.01)
+    metrics.add_time("download", 0.5)
+    metrics.add_time("match", 0.25)
+    metrics.count("bytes_downloaded", 100)
+    metrics.count("artifacts")
+    metrics.count("result_cache_hits", 3)
+    metrics.count("result_cache_misses", 1)
+
+    data = metrics.to_dict()
+    assert data["stages"]["download"]["count"] == 2
+    assert 0.51 <= data["stages"]["download"]["total_seconds"] < 1
+    assert data["stages"]["download"]["max_seconds"] == 0.5
+    assert data["stages"]["match"]["mean_seconds"] == 0.25
+    assert data["counters"]["bytes_downloaded"] == 100
+    assert data["hit_rates"] == {"result_cache": 0.75}
+    assert data["artifacts_per_second"] > 0
+
+    text = metrics.to_prometheus()
+    assert 'cf_artifact_validation_stage_runs_total{stage="download"} 2' in text
+    assert "cf_artifact_validation_bytes_downloaded_total 100" in text
+    assert 'cf_artifact_validation_hit_rate{cache="result_cache"} 0.75' in text
+
+    summary = metrics.summary()
+    assert "result_cache hit rate: 75.0%" in summary
+    assert "download" in summary
+
+
+def test_metrics_merge():
+    metrics = Metrics()
+    metrics.add_time("download", 1.0)
+    metrics.count("bytes_downloaded", 10)
+
+    # what a worker process sends back
+    worker = Metrics()
+    worker.add_time("download", 2.0)
+    worker.add_time("read_paths", 0.5)
+    worker.count("bytes_downloaded", 5)
+    snapshot = pickle.loads(pickle.dumps(worker.snapshot(reset=True)))
+    assert worker.snapshot() == {"stages": {}, "counters": {}}
+
+    metrics.merge(snapshot)
+    assert metrics.snapshot() == {
+        "stages": {"download": [2, 3.0, 2.0], "read_paths": [1, 0.5, 0.5]},
+        "counters": {"bytes_downloaded": 15},
+    }
+
+
+def test_metrics_write(tmp_path):
+    metrics = Metrics()
+    metrics.add_time("match", 0.1)
+
+    metrics.write(str(tmp_path / "metrics.json"))
+    with open(tmp_path / "metrics.json") as fp:
+        assert json.load(fp)["stages"]["match"]["count"] == 1
+
+    metrics.write(str(tmp_path / "metrics.prom"))
+    with open(tmp_path / "metrics.prom") as fp:
+        assert "# TYPE cf_artifact_validation_stage_seconds_total counter" in fp.read()
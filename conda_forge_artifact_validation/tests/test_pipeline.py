@@ -0,0 +1,305 @@
+import os
+import threading
+import time
+import concurrent.futures
+
+import pytest
+import yaml
+
+from .. import pipeline, scan
+from ..pipeline import ScanPipeline, get_lane, _ByteBudget
+from ..cached_repodata import PackageRecord
+from ..file_index import FileListIndex
+from ..result_cache import ResultCache
+from ..rules import RuleSet, load_rule_set
+from ..scan import make_executor
+
+VALIDATE_YAMLS = {"openssl": {"files": ["bin/openssl"], "allowed": ["openssl"]}}
+
+
+def _artifacts(n, subdir="linux-64", name="foo", size=0):
+    for i in range(n):
+        pkg = "%s-1.%03d-0.tar.bz2" % (name, i)
+        yield subdir, pkg, PackageRecord(
+            pkg, name, "1.%03d" % i, "0", "%032d" % i, size=size,
+        )
+
+
+def _downloaded(pkg):
+    # the artifacts from `fake_channel` that are downloaded
+    return int(pkg.split("-")[1].split(".")[1]) % 2 == 1
+
+
+@pytest.fixture
+def fake_channel(monkeypatch):
+    """Artifacts with an even version are in libcfgraph and the rest are
+    downloaded. Downloads of artifacts named `slow` take a while."""
+    state = {"lock": threading.Lock(), "n_downloads": 0, "active": 0, "max_active": 0}
+
+    def _file_list(
+        name, subdir, pkg, libcfgraph_path, file_index=None, return_source=False,
+    ):
+        if not _downloaded(pkg):
+            return ["bin/openssl"], "libcfgraph"
+        return None, None
+
+    def _download(pkg, repodata, subdir, rule_set=None, **kwargs):
+        with state["lock"]:
+            state["n_downloads"] += 1
+            state["active"] += 1
+            state["max_active"] = max(state["max_active"], state["active"])
+        if repodata["name"] == "slow":
+            time.sleep(0.5)
+        else:
+            time.sleep(0.01)
+        with state["lock"]:
+            state["active"] -= 1
+        return True, {}, None
+
+    monkeypatch.setattr(pipeline, "get_libcfgraph_file_list", _file_list)
+    monkeypatch.setattr(pipeline, "download_and_validate_artifact", _download)
+    return state
+
+
+def test_scan_pipeline(fake_channel, tmp_path):
+    rule_set = RuleSet(VALIDATE_YAMLS)
+    with ResultCache(str(tmp_path / "cache.sqlite")) as cache:
+        cache.put(
+            "%032d" % 1, rule_set.fingerprint, "linux-64/foo-1.001-0.tar.bz2",
+            False, {"blah": ["blah"]},
+        )
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            pl = ScanPipeline(
+                executor, rule_set, None, result_cache=cache, n_lookup=2,
+                max_downloads=4, max_queued=8,
+            )
+            results = {
+                pkg: (res, cached)
+                for subdir, pkg, rec, res, cached in pl.run(_artifacts(50))
+            }
+
+    assert len(results) == 50
+    assert results["foo-1.001-0.tar.bz2"] == ((False, {"blah": ["blah"]}), True)
+    assert results["foo-1.002-0.tar.bz2"] == (
+        (False, {"openssl": ["bin/openssl"]}), False,
+    )
+    assert results["foo-1.003-0.tar.bz2"] == ((True, {}), False)
+    assert fake_channel["n_downloads"] == 24
+    assert fake_channel["max_active"] <= 4
+    assert pl.oldest_unfinished() is None
+
+
+def test_scan_pipeline_no_barrier(fake_channel):
+    def _artifacts_with_slow():
+        # only odd versions are downloaded
+        yield list(_artifacts(2, name="slow"))[1]
+        yield from _artifacts(20)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        pl = ScanPipeline(executor, RuleSet(VALIDATE_YAMLS), None, n_lookup=2)
+        order = [pkg for _, pkg, _, _, _ in pl.run(_artifacts_with_slow())]
+
+    # everything else finishes while the slow artifact is downloaded
+    assert order[-1] == "slow-1.001-0.tar.bz2"
+
+
+def test_get_lane():
+    assert get_lane(0) == "small"
+    assert get_lane(16 * 1024**2) == "small"
+    assert get_lane(16 * 1024**2 + 1) == "medium"
+    assert get_lane(5 * 1024**3) == "huge"
+
+
+def test_scan_pipeline_huge_lane(fake_channel):
+    def _artifacts_with_huge():
+        yield from _artifacts(10, name="slow", size=2 * 1024**3)
+        yield from _artifacts(10)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        pl = ScanPipeline(executor, RuleSet(VALIDATE_YAMLS), None, n_lookup=4)
+        t0 = time.time()
+        results = list(pl.run(_artifacts_with_huge()))
+
+    assert len(results) == 20
+    # the five slow downloads were run one at a time
+    assert time.time() - t0 >= 2.5
+
+
+def test_scan_pipeline_max_bytes(fake_channel):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        pl = ScanPipeline(
+            executor, RuleSet(VALIDATE_YAMLS), None, n_lookup=4,
+            lane_limits={"small": 4}, max_bytes=1000,
+        )
+        results = list(pl.run(_artifacts(20, size=600)))
+
+    assert len(results) == 20
+    assert fake_channel["max_active"] == 1
+
+
+def test_byte_budget():
+    budget = _ByteBudget(100)
+
+    assert budget.fits(60)
+    budget.acquire(60)
+    assert budget.fits(40)
+    budget.acquire(40)
+    assert not budget.fits(5)
+
+    budget.release(60)
+    assert budget.fits(60)
+    assert not budget.fits(90)
+    budget.release(40)
+    assert budget.in_flight == 0
+
+    # bigger than the budget runs alone
+    assert budget.fits(1000)
+    budget.acquire(1000)
+    assert not budget.fits(1)
+
+
+def test_scan_pipeline_huge_lane_no_blocking(fake_channel):
+    # many more huge artifacts than lookup threads are ahead of the small ones
+    def _artifacts_with_huge():
+        yield from _artifacts(24, name="slow", size=2 * 1024**3)
+        yield from _artifacts(10)
+
+    small = {pkg for _, pkg, _ in _artifacts(10)}
+    done = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        pl = ScanPipeline(executor, RuleSet(VALIDATE_YAMLS), None, n_lookup=4)
+        for _, pkg, _, _, _ in pl.run(_artifacts_with_huge()):
+            done.append(pkg)
+            if small <= set(done):
+                pl.stop()
+
+    # the small ones finish while the first huge download is still running
+    last_small = max(done.index(pkg) for pkg in small)
+    assert not [
+        pkg for pkg in done[:last_small] if pkg.startswith("slow") and _downloaded(pkg)
+    ]
+
+
+def test_scan_pipeline_huge_lane_bytes(fake_channel):
+    # a huge artifact waiting for bytes is not starved by the small ones
+    def _artifacts_with_huge():
+        yield list(_artifacts(2, size=600))[1]
+        yield list(_artifacts(2, name="slow", size=2 * 1024**3))[1]
+        yield from list(_artifacts(20, size=600))[2:]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        pl = ScanPipeline(
+            executor, RuleSet(VALIDATE_YAMLS), None, n_lookup=1, max_bytes=1000,
+        )
+        order = [pkg for _, pkg, _, _, _ in pl.run(_artifacts_with_huge())]
+
+    # the huge artifact ran alone and before the small ones behind it
+    assert fake_channel["max_active"] == 1
+    downloaded = [pkg for pkg in order if _downloaded(pkg)]
+    assert downloaded.index("slow-1.001-0.tar.bz2") <= 1
+
+
+def test_scan_pipeline_stop(fake_channel):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        pl = ScanPipeline(
+            executor, RuleSet(VALIDATE_YAMLS), None, n_lookup=1, max_downloads=1,
+            max_queued=2,
+        )
+        done = []
+        for _, pkg, _, _, _ in pl.run(_artifacts(1000, name="slow")):
+            done.append(pkg)
+            pl.stop()
+
+    assert 0 < len(done) < 1000
+    oldest = pl.oldest_unfinished()
+    assert oldest[0] == "linux-64"
+    assert oldest[1] not in done
+    assert oldest[1] > max(done)
+
+
+def test_scan_pipeline_error(monkeypatch):
+    def _file_list(*args, **kwargs):
+        raise RuntimeError("blah")
+
+    monkeypatch.setattr(pipeline, "get_libcfgraph_file_list", _file_list)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        pl = ScanPipeline(executor, RuleSet(VALIDATE_YAMLS), None)
+        with pytest.raises(RuntimeError, match="blah"):
+            list(pl.run(_artifacts(10)))
+
+
+def test_scan_pipeline_file_index(fake_channel, tmp_path, monkeypatch):
+    def _download(pkg, repodata, subdir, rule_set=None, **kwargs):
+        assert kwargs["return_paths"]
+        return True, {}, ["bin/%s" % repodata["name"]]
+
+    monkeypatch.setattr(pipeline, "download_and_validate_artifact", _download)
+    rule_set = RuleSet(VALIDATE_YAMLS)
+    with FileListIndex(str(tmp_path / "index.sqlite")) as index:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            pl = ScanPipeline(executor, rule_set, None, file_index=index, n_lookup=2)
+            assert len(list(pl.run(_artifacts(4)))) == 4
+
+        # the lists of downloaded artifacts are stored
+        assert index.get("linux-64", "foo-1.001-0.tar.bz2", return_source=True) == (
+            ["bin/foo"], "download",
+        )
+        assert list(index.iter_scanned()) == [
+            ("linux-64/foo-1.000-0.tar.bz2", "foo", "libcfgraph", rule_set.fingerprint),
+            ("linux-64/foo-1.001-0.tar.bz2", "foo", "download", rule_set.fingerprint),
+            ("linux-64/foo-1.002-0.tar.bz2", "foo", "libcfgraph", rule_set.fingerprint),
+            ("linux-64/foo-1.003-0.tar.bz2", "foo", "download", rule_set.fingerprint),
+        ]
+
+
+def test_scan_pipeline_file_index_rescan(tmp_path, monkeypatch):
+    # a list stored from a download must be matched the same way next time
+    rule_set = RuleSet({
+        "numpy": {"files": ["lib/python*/site-packages/numpy"], "allowed": ["numpy"]},
+    })
+    paths = ["lib/python3.9/site-packages/numpy/__init__.py"]
+    n_downloads = []
+
+    def _download(pkg, repodata, subdir, rule_set=None, **kwargs):
+        n_downloads.append(pkg)
+        return scan.validate_paths(repodata["name"], paths, rule_set) + (paths,)
+
+    monkeypatch.setattr(pipeline, "download_and_validate_artifact", _download)
+    # libcfgraph cannot be reached so only the index has the list
+    monkeypatch.setattr(scan, "LIBCFGRAPH_URL", "http://127.0.0.1:1")
+
+    results = []
+    with FileListIndex(str(tmp_path / "index.sqlite")) as index:
+        for _ in range(2):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                pl = ScanPipeline(executor, rule_set, None, file_index=index)
+                results.extend(res for _, _, _, res, _ in pl.run(_artifacts(1)))
+        scanned = list(index.iter_scanned())
+
+    assert n_downloads == ["foo-1.000-0.tar.bz2"]
+    assert results == [(False, {"numpy": ["lib/python*/site-packages/numpy"]})] * 2
+    assert scanned[0][2] == "download"
+
+
+def test_scan_pipeline_processes(fake_channel, tmp_path, monkeypatch):
+    os.makedirs(tmp_path / "validate_yamls")
+    with open(tmp_path / "validate_yamls" / "openssl.yaml", "w") as fp:
+        yaml.dump(VALIDATE_YAMLS["openssl"], fp)
+    rule_set = load_rule_set(root=str(tmp_path))
+
+    # the file lists are matched in the workers and not the lookup threads
+    def _match(*args, **kwargs):
+        raise RuntimeError("matched in the main process")
+
+    monkeypatch.setattr(pipeline, "match_file_list", _match)
+    artifacts = [a for a in _artifacts(20) if not _downloaded(a[1])]
+    with make_executor("processes", 2, root=str(tmp_path)) as executor:
+        pl = ScanPipeline(
+            executor, rule_set, None, backend="processes", n_lookup=2,
+            max_downloads=2,
+        )
+        results = [res for _, _, _, res, _ in pl.run(iter(artifacts))]
+
+    assert results == [(False, {"openssl": ["bin/openssl"]})] * 10
+    assert pl.oldest_unfinished() is None
@@ -0,0 +1,133 @@
+from ..file_index import FileListIndex
+from ..rescan import diff_rules, rescan_rules
+from ..rules import RuleSet
+
+OLD_YAMLS = {
+    "openssl": {"files": ["include/openssl/ssl.h", "lib/libssl.so"], "allowed": []},
+    "zlib": {"files": ["include/zlib.h"], "allowed": ["zlib"]},
+}
+
+
+def test_diff_rules():
+    new_yamls = {
+        "openssl": {"files": ["include/openssl/ssl.h", "bin/openssl"], "allowed": []},
+        "zlib": {"files": ["include/zlib.h"], "allowed": []},
+        "curl": {"files": ["bin/curl"], "allowed": ["curl"]},
+    }
+    assert diff_rules(OLD_YAMLS, OLD_YAMLS) == {}
+    assert diff_rules(OLD_YAMLS, new_yamls) == {
+        "openssl": {
+            "added": {"bin/openssl"},
+            "removed": {"lib/libssl.so"},
+            "allowed_added": set(),
+            "allowed_removed": set(),
+        },
+        "zlib": {
+            "added": set(),
+            "removed": set(),
+            "allowed_added": set(),
+            "allowed_removed": {"zlib"},
+        },
+        "curl": {
+            "added": {"bin/curl"},
+            "removed": set(),
+            "allowed_added": {"curl"},
+            "allowed_removed": set(),
+        },
+    }
+    assert diff_rules(OLD_YAMLS, {"zlib": OLD_YAMLS["zlib"]}) == {
+        "openssl": {
+            "added": set(),
+            "removed": {"include/openssl/ssl.h", "lib/libssl.so"},
+            "allowed_added": set(),
+            "allowed_removed": set(),
+        },
+    }
+
+
+def _scan(index, rule_set, artifacts):
+    # what the scanner stores for each artifact
+    scan_data = {}
+    index.put_rules(rule_set)
+    for name, pkg, files, source in artifacts:
+        index.put("linux-64", pkg, files, source=source)
+        index.mark_scanned("linux-64", pkg, name, source, rule_set.fingerprint)
+        valid, bad_pths = rule_set.match(name, files)
+        if not valid:
+            scan_data.setdefault(name, {})[f"linux-64/{pkg}"] = {
+                "bad_paths": dict(bad_pths),
+            }
+    return scan_data
+
+
+def test_rescan_rules(tmp_path):
+    old_rules = RuleSet(OLD_YAMLS)
+    with FileListIndex(str(tmp_path / "index.sqlite")) as index:
+        scan_data = _scan(index, old_rules, [
+            ("foo", "foo-1-0.tar.bz2", ["lib/libssl.so", "bin/foo"], "libcfgraph"),
+            ("bar", "bar-1-0.tar.bz2", ["include/openssl/ssl.h"], "download"),
+            ("zlib", "zlib-1-0.tar.bz2", ["include/zlib.h"], "libcfgraph"),
+            ("baz", "baz-1-0.tar.bz2", ["bin/openssl", "bin/baz"], "libcfgraph"),
+            ("qux", "qux-1-0.tar.bz2", ["share/qux/data"], "download"),
+        ])
+        assert set(scan_data) == {"foo", "bar"}
+
+        # nothing changed
+        final_data, valid_artifacts, stats = rescan_rules(index, old_rules, scan_data)
+        assert final_data == {}
+        assert valid_artifacts == set()
+        assert stats == {"scanned": 5, "rematched": 0, "missing": 0}
+
+        new_rules = RuleSet({
+            "openssl": {
+                "files": ["include/openssl/ssl.h", "bin/openssl", "share/qux"],
+                "allowed": [],
+            },
+            "zlib": {"files": ["include/zlib.h"], "allowed": []},
+        })
+        final_data, valid_artifacts, stats = rescan_rules(index, new_rules, scan_data)
+
+    assert final_data == {
+        "zlib": {
+            "linux-64/zlib-1-0.tar.bz2": {"bad_paths": {"zlib": ["include/zlib.h"]}},
+        },
+        "baz": {
+            "linux-64/baz-1-0.tar.bz2": {"bad_paths": {"openssl": ["bin/openssl"]}},
+        },
+        # directories are matched for downloaded artifacts
+        "qux": {
+            "linux-64/qux-1-0.tar.bz2": {"bad_paths": {"openssl": ["share/qux"]}},
+        },
+    }
+    assert valid_artifacts == {"linux-64/foo-1-0.tar.bz2"}
+    # bar is still invalid for a pattern that did not change
+    assert stats == {"scanned": 5, "rematched": 4, "missing": 0}
+
+
+def test_rescan_rules_only_affected(tmp_path):
+    old_rules = RuleSet(OLD_YAMLS)
+    artifacts = [
+        ("pkg%d" % i, "pkg%d-1-0.tar.bz2" % i, ["bin/pkg%d" % i], "libcfgraph")
+        for i in range(20)
+    ]
+    artifacts.append(("foo", "foo-1-0.tar.bz2", ["bin/foo", "bin/curl"], "download"))
+
+    with FileListIndex(str(tmp_path / "index.sqlite")) as index:
+        scan_data = _scan(index, old_rules, artifacts)
+        new_rules = RuleSet(dict(
+            OLD_YAMLS, curl={"files": ["bin/cur*"], "allowed": ["curl"]},
+        ))
+        final_data, valid_artifacts, stats = rescan_rules(index, new_rules, scan_data)
+        assert stats["rematched"] == 1
+        assert final_data == {
+            "foo": {"linux-64/foo-1-0.tar.bz2": {"bad_paths": {"curl": ["bin/cur*"]}}},
+        }
+
+        # once the scanned artifacts are marked nothing is matched again
+        index.put_rules(new_rules)
+        index.set_scanned_fingerprint(new_rules.fingerprint)
+        assert rescan_rules(index, new_rules, scan_data)[2]["rematched"] == 0
+
+        # rules that were not stored match everything again
+        index.set_scanned_fingerprint("blah")
+        assert rescan_rules(index, new_rules, scan_data)[2]["rematched"] == 21
@@ -0,0 +1,25 @@
+from ..result_cache import ResultCache
+
+
+def test_result_cache(tmp_path):
+    pth = str(tmp_path / "cache.sqlite")
+    with ResultCache(pth, commit_every=1) as cache:
+        assert cache.get("abc", "fp1") is None
+        cache.put("abc", "fp1", "linux-64/foo-1.0-0.tar.bz2", True, {})
+        cache.put(
+            "def", "fp1", "linux-64/bar-1.0-0.tar.bz2", False, {"numpy": ["bin/f2py"]},
+        )
+        assert cache.get("abc", "fp1") == (True, {})
+        assert cache.get("abc", "fp2") is None
+        assert cache.hits == 1
+        assert cache.misses == 2
+        assert len(cache) == 2
+
+    # make sure it persists
+    with ResultCache(pth) as cache:
+        assert cache.get("def", "fp1") == (False, {"numpy": ["bin/f2py"]})
+        cache.put("abc", "fp2", "linux-64/foo-1.0-0.tar.bz2", True, {})
+        assert cache.prune("fp2") == 2
+        assert len(cache) == 1
+        assert cache.get("abc", "fp2") == (True, {})
+        assert cache.get("def", "fp1") is None
@@ -0,0 +1,260 @@
+import functools
+import os
+import pickle
+import random
+import re
+from collections import defaultdict
+
+import pytest
+import yaml
+
+from .. import rules
+from ..glob_to_re import glob_to_re
+from ..rules import (
+    RuleSet,
+    as_rule_set,
+    compute_fingerprint,
+    compile_rules,
+    find_validate_yamls,
+    load_rule_set,
+    load_validate_yamls,
+    get_default_bundle_path,
+)
+
+REPO_ROOT = os.path.join(os.path.dirname(__file__), "..", "..")
+
+
+def _load_repo_validate_yamls():
+    return load_validate_yamls(root=REPO_ROOT)
+
+
+@functools.lru_cache(maxsize=None)
+def _compile(patt):
+    return re.compile(glob_to_re(patt))
+
+
+def _regex_loop(pkg_name, fnames, validate_yamls):
+    # this is the brute-force loop the rule set replaces
+    valid = True
+    bad_pths = defaultdict(list)
+    for key in validate_yamls:
+        if pkg_name in validate_yamls[key]["allowed"]:
+            continue
+
+        for patt in validate_yamls[key]["files"]:
+            rep = _compile(patt)
+            for fname in fnames:
+                if rep.fullmatch(fname) is not None:
+                    valid = False
+                    bad_pths[key].append(patt)
+                    break
+
+    return valid, bad_pths
+
+
+def _example_fnames(validate_yamls, rng):
+    # make paths that hit (or nearly hit) both literals and globs
+    fnames = set()
+    for validate_yaml in validate_yamls.values():
+        for patt in validate_yaml["files"]:
+            if rng.random() < 0.8:
+                continue
+            fname = (
+                patt
+                .replace("/**/", "/" + rng.choice(["", "a/", "a/b/"]))
+                .replace("**/", "")
+                .replace("/**", "/c")
+                .replace("*", rng.choice(["", "x", "3.9"]))
+            )
+            fnames.add(fname)
+            fnames.add(fname + rng.choice(["", ".bak", "/d"]))
+    fnames.update([
+        "lib/python3.9/site-packages/foo/__init__.py",
+        "bin/python",
+        "share/doc/README",
+    ])
+    return sorted(fnames)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize(
+    "pkg_name", ["foo", "openssl", "setuptools"],
+)
+def test_rule_set_matches_regex_loop_repo_yamls(pkg_name, seed):
+    validate_yamls = _load_repo_validate_yamls()
+    assert len(validate_yamls) > 0
+    rng = random.Random(seed)
+    fnames = _example_fnames(validate_yamls, rng)
+
+    rule_set = RuleSet(validate_yamls)
+    assert rule_set.match(pkg_name, fnames) == _regex_loop(
+        pkg_name, fnames, validate_yamls,
+    )
+
+
+@pytest.mark.parametrize(
+    "patt,fname,ok",
+    [
+        ("bar/**", "bar", False),
+        ("bar/**", "bar/baz/foo.py", False),
+        ("bar/*", "bar/baz/foo.py", True),
+        ("**/foo.py", "foo.py", False),
+        ("**/bar/**/foo.py", "baz/duck/bar/bam/quack/foo.py", False),
+        ("fo[o].py", "foo.py", False),
+        ("fo[!o].py", "foo.py", True),
+        ("bin/foo", "bin/foo", False),
+        ("bin/foo", "bin/foo2", True),
+        ("bin/foo/", "bin/foo", False),
+        ("lib/python*/site-packages/numpy", "lib/python3.9/site-packages/numpy", False),
+    ],
+)
+def test_rule_set_patterns(patt, fname, ok):
+    validate_yamls = {"foo": {"allowed": ["foo"], "files": [patt]}}
+    valid, bad_pths = RuleSet(validate_yamls).match("bar", [fname])
+    assert valid is ok
+    if ok:
+        assert bad_pths == {}
+    else:
+        assert bad_pths == {"foo": [patt]}
+
+    # allowed outputs never fail
+    valid, bad_pths = RuleSet(validate_yamls).match("foo", [fname])
+    assert valid
+    assert bad_pths == {}
+
+
+def test_rule_set_order_and_keys():
+    validate_yamls = {
+        "b": {"allowed": ["b"], "files": ["z/**/*", "a", "m*"]},
+        "a": {"allowed": ["a", "c"], "files": ["a"]},
+    }
+    rule_set = as_rule_set(validate_yamls)
+    assert as_rule_set(rule_set) is rule_set
+    assert rule_set.keys_for("c") == ["b"]
+
+    valid, bad_pths = rule_set.match("c", ["m1", "a", "z/y/x"])
+    assert not valid
+    assert bad_pths == {"b": ["z/**/*", "a", "m*"]}
+    assert list(bad_pths) == ["b"]
+
+
+def test_rule_set_fingerprint():
+    validate_yamls = {
+        "b": {"allowed": ["b"], "files": ["z/**/*", "a"]},
+        "a": {"allowed": ["a"], "files": ["a"], "generate_from_artifacts": ["a"]},
+    }
+    fp = RuleSet(validate_yamls).fingerprint
+    assert fp == compute_fingerprint(dict(reversed(list(validate_yamls.items()))))
+
+    # only the rules matter
+    del validate_yamls["a"]["generate_from_artifacts"]
+    assert compute_fingerprint(validate_yamls) == fp
+
+    validate_yamls["a"]["files"].append("b")
+    assert compute_fingerprint(validate_yamls) != fp
+
+
+def _write_yaml(pth, data):
+    with open(pth, "w") as fp:
+        yaml.dump(data, fp)
+
+
+def test_compile_and_load_rules(tmp_path):
+    os.makedirs(tmp_path / "validate_yamls")
+    os.makedirs(tmp_path / "generated_validate_yamls")
+    _write_yaml(
+        tmp_path / "validate_yamls" / "foo.yaml",
+        {"files": ["bin/foo", "lib/foo/**/*"], "allowed": ["foo"]},
+    )
+    _write_yaml(
+        tmp_path / "generated_validate_yamls" / "foo.generated.yaml",
+        {"files": ["share/foo/bar"], "allowed": ["foo", "foo-static"]},
+    )
+    # not a generated yaml, so should be ignored
+    _write_yaml(
+        tmp_path / "generated_validate_yamls" / "python_packages.yaml",
+        {"foo": {"top_level_imports": ["foo"]}},
+    )
+    root = str(tmp_path)
+    bundle_path = get_default_bundle_path(root=root)
+    assert bundle_path.startswith(rules.RULES_CACHE_DIR)
+    assert bundle_path != get_default_bundle_path(root=str(tmp_path / "other"))
+
+    assert sorted(find_validate_yamls(root=root)) == ["foo", "foo.generated"]
+
+    rule_set = load_rule_set(root=root)
+    assert os.path.exists(bundle_path)
+    assert rule_set.fingerprint == RuleSet(load_validate_yamls(root=root)).fingerprint
+    assert rule_set.keys_for("foo-static") == ["foo"]
+    assert rule_set.to_validate_yamls()["foo.generated"] == {
+        "files": ["share/foo/bar"], "allowed": ["foo", "foo-static"],
+    }
+
+    # the bundle is used if nothing changed
+    mtime = os.path.getmtime(bundle_path)
+    bundled = load_rule_set(root=root, update=False)
+    assert bundled.fingerprint == rule_set.fingerprint
+    assert bundled.match("bar", ["lib/foo/a/b.py"]) == (
+        False, {"foo": ["lib/foo/**/*"]},
+    )
+    assert os.path.getmtime(bundle_path) == mtime
+
+    # and is invalidated if a yaml changes
+    _write_yaml(
+        tmp_path / "validate_yamls" / "foo.yaml",
+        {"files": ["bin/foo"], "allowed": ["foo"]},
+    )
+    new_rule_set = load_rule_set(root=root, update=False)
+    assert new_rule_set.fingerprint != rule_set.fingerprint
+    assert new_rule_set.match("bar", ["lib/foo/a/b.py"]) == (True, {})
+
+    # or a new one is added
+    compile_rules(root=root)
+    _write_yaml(
+        tmp_path / "validate_yamls" / "bar.yaml",
+        {"files": ["bin/bar"], "allowed": ["bar"]},
+    )
+    assert len(load_rule_set(root=root)) == 3
+
+
+def test_load_rule_set_code_changes(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / "validate_yamls")
+    _write_yaml(
+        tmp_path / "validate_yamls" / "foo.yaml",
+        {"files": ["bin/foo"], "allowed": ["foo"]},
+    )
+    root = str(tmp_path)
+    bundle_path = get_default_bundle_path(root=root)
+    compile_rules(root=root)
+
+    # a bundle made by other code is not used
+    with open(bundle_path, "rb") as fp:
+        bundle = pickle.load(fp)
+    bundle["rule_set"] = RuleSet({})
+    bundle["code"] = "blah"
+    with open(bundle_path, "wb") as fp:
+        pickle.dump(bundle, fp)
+    assert len(load_rule_set(root=root, update=False)) == 1
+
+    monkeypatch.setattr(rules, "_hash_code", lambda: "blah")
+    assert len(load_rule_set(root=root, update=False)) == 0
+
+
+def test_load_rule_set_bundle_path(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / "validate_yamls")
+    _write_yaml(
+        tmp_path / "validate_yamls" / "foo.yaml",
+        {"files": ["bin/foo"], "allowed": ["foo"]},
+    )
+    root = str(tmp_path)
+
+    # a pickle in the repo is never loaded
+    with open(tmp_path / ".compiled_rules.pkl", "wb") as fp:
+        pickle.dump({"version": rules.BUNDLE_VERSION, "rule_set": RuleSet({})}, fp)
+    assert len(load_rule_set(root=root)) == 1
+
+    # no bundles without a cache directory
+    monkeypatch.setattr(rules, "RULES_CACHE_DIR", "")
+    assert get_default_bundle_path(root=root) is None
+    assert len(compile_rules(root=root)) == 1
+    assert len(load_rule_set(root=root)) == 1
@@ -0,0 +1,343 @@
+import json
+import os
+from collections import defaultdict
+
+import pytest
+import yaml
+
+from ..rules import compile_rules
+from ..scan import (
+    validate_artifact,
+    get_libcfgraph_artifact_path,
+    is_cacheable,
+    finalize_result,
+    make_executor,
+    load_seen_artifacts,
+    save_seen_artifacts,
+    find_new_artifacts,
+    parse_shard,
+    get_shard_artifacts,
+    update_scan_data,
+    dump_scan_data,
+    dump_finding,
+    load_findings,
+    diff_scan_data,
+    format_scan_data_diff,
+)
+from .. import scan
+from ..cached_repodata import CompactRepodata
+
+
+@pytest.fixture
+def scan_repo(tmp_path):
+    """A repo with some validate yamls and a local libcfgraph checkout."""
+    os.makedirs(tmp_path / "validate_yamls")
+    with open(tmp_path / "validate_yamls" / "numpy.yaml", "w") as fp:
+        yaml.dump(
+            {"files": ["lib/python*/site-packages/numpy/**/*"], "allowed": ["numpy"]},
+            fp,
+        )
+
+    lcfg = tmp_path / "libcfgraph"
+    for name, pkg, files in [
+        (
+            "freud",
+            "freud-0.11.0-py27h3e44d54_0.tar.bz2",
+            ["lib/python2.7/site-packages/numpy/__init__.py"],
+        ),
+        (
+            "numpy",
+            "numpy-1.19.4-py36hcf5569d_1.conda",
+            ["lib/python3.6/site-packages/numpy/__init__.py"],
+        ),
+    ]:
+        pth = lcfg / get_libcfgraph_artifact_path(name, "linux-64", pkg)
+        os.makedirs(pth.parent, exist_ok=True)
+        with open(pth, "w") as fp:
+            json.dump({"files": files}, fp)
+
+    compile_rules(root=str(tmp_path))
+    return tmp_path
+
+
+def test_get_libcfgraph_artifact_path():
+    assert get_libcfgraph_artifact_path(
+        "numpy", "osx-64", "numpy-1.19.4-py36hcf5569d_1.tar.bz2",
+    ) == "artifacts/numpy/conda-forge/osx-64/numpy-1.19.4-py36hcf5569d_1.json"
+    assert get_libcfgraph_artifact_path(
+        "numpy", "osx-64", "numpy-1.19.4-py36hcf5569d_1.conda",
+    ) == "artifacts/numpy/conda-forge/osx-64/numpy-1.19.4-py36hcf5569d_1.json"
+
+
+@pytest.mark.parametrize("backend", ["threading", "processes"])
+def test_validate_artifact_executor(scan_repo, backend):
+    from ..rules import load_rule_set
+
+    rule_set = load_rule_set(root=str(scan_repo))
+    lcfg = str(scan_repo / "libcfgraph")
+    with make_executor(backend, 2, root=str(scan_repo)) as executor:
+        futs = [
+            executor.submit(
+                validate_artifact,
+                pkg,
+                {"name": name, "md5": "abc"},
+                lcfg,
+                "linux-64",
+                rule_set=rule_set if backend == "threading" else None,
+            )
+            for name, pkg in [
+                ("freud", "freud-0.11.0-py27h3e44d54_0.tar.bz2"),
+                ("numpy", "numpy-1.19.4-py36hcf5569d_1.conda"),
+            ]
+        ]
+        res = [fut.result() for fut in futs]
+
+    assert res[0][0] is False
+    assert dict(res[0][1]) == {"numpy": ["lib/python*/site-packages/numpy/**/*"]}
+    assert res[1][0] is True
+    assert dict(res[1][1]) == {}
+
+
+def test_make_executor_bad_backend():
+    with pytest.raises(ValueError):
+        make_executor("blah", 2)
+
+
+@pytest.mark.parametrize("valid,bad_pths,ok", [
+    (True, {}, True),
+    (False, {"numpy": ["bin/f2py"]}, True),
+    (False, {}, False),
+    (False, None, False),
+    (False, {"md5sum": {"valid": False}}, False),
+])
+def test_is_cacheable(valid, bad_pths, ok):
+    assert is_cacheable(valid, bad_pths) is ok
+
+
+@pytest.mark.parametrize("pkg,valid", [
+    ("freud-0.11.0-py27h3e44d54_0.tar.bz2", False),
+    ("freud-0.11.0-py35h3e44d54_0.tar.bz2", True),
+])
+def test_finalize_result(pkg, valid):
+    bad_pths = {"numpy": ["bin/f2py"]}
+    d_valid, d = finalize_result(pkg, "freud", "linux-64", False, bad_pths)
+    assert d_valid is valid
+    assert d == {"freud": {f"linux-64/{pkg}": {"bad_paths": bad_pths}}}
+
+
+def test_seen_artifacts_roundtrip(tmp_path):
+    pth = str(tmp_path / "seen.json.gz")
+    assert load_seen_artifacts(pth) == {}
+
+    seen = {"linux-64": {"a-1-0.tar.bz2": "0" * 32}, "noarch": {}}
+    save_seen_artifacts(pth, seen)
+    assert load_seen_artifacts(pth) == seen
+
+
+@pytest.mark.parametrize("order,new", [
+    ("name", ["b-1-0.tar.bz2", "c-1-0.tar.bz2", "d-1-0.tar.bz2"]),
+    ("timestamp", ["d-1-0.tar.bz2", "c-1-0.tar.bz2", "b-1-0.tar.bz2"]),
+])
+def test_find_new_artifacts(order, new):
+    rd = CompactRepodata({"packages": {
+        "a-1-0.tar.bz2": {"name": "a", "md5": "0" * 32, "timestamp": 1},
+        "b-1-0.tar.bz2": {"name": "b", "md5": "1" * 32, "timestamp": 4},
+        "c-1-0.tar.bz2": {"name": "c", "md5": "2" * 32, "timestamp": 3},
+        "d-1-0.tar.bz2": {"name": "d", "md5": "3" * 32, "timestamp": 2},
+    }})
+    seen = {
+        "a-1-0.tar.bz2": "0" * 32,
+        # the md5 changed
+        "b-1-0.tar.bz2": "f" * 32,
+        # removed from the channel
+        "e-1-0.tar.bz2": "4" * 32,
+    }
+
+    assert find_new_artifacts(rd, seen, order=order) == new
+    assert seen == {"a-1-0.tar.bz2": "0" * 32, "b-1-0.tar.bz2": "f" * 32}
+
+    with pytest.raises(ValueError):
+        find_new_artifacts(rd, seen, order="blah")
+
+
+def test_parse_shard():
+    assert parse_shard("0/1") == (0, 1)
+    assert parse_shard("2/5") == (2, 5)
+    for shard in ["5/5", "-1/5", "0/0", "1", "a/b"]:
+        with pytest.raises(ValueError):
+            parse_shard(shard)
+
+
+def test_get_shard_artifacts():
+    rd = CompactRepodata({"packages": {
+        "a-1.%d-0.tar.bz2" % i: {"name": "a", "md5": "0" * 32, "size": 1 + i % 7}
+        for i in range(1000)
+    }})
+    rd.packages["a-1.0-0.tar.bz2"].size = 0
+
+    n_shards = 4
+    shards = [get_shard_artifacts(rd, i, n_shards) for i in range(n_shards)]
+    assert set().union(*shards) == set(rd.packages)
+    assert sum(len(s) for s in shards) == len(rd.packages)
+
+    total = sum(rec.size for rec in rd.packages.values())
+    for s in shards:
+        size = sum(rd.packages[pkg].size for pkg in s)
+        assert abs(size - total / n_shards) <= 7
+
+    # only depends on the repodata
+    assert get_shard_artifacts(rd, 1, n_shards) == shards[1]
+
+
+def test_update_scan_data(tmp_path, monkeypatch):
+    rd = CompactRepodata({"packages": {
+        "a-1-0.tar.bz2": {"name": "a", "md5": "0" * 32},
+        "b-1-0.tar.bz2": {"name": "b", "md5": "1" * 32},
+    }})
+    monkeypatch.setattr(scan, "COMPACT_REPODATA_CACHE", {"linux-64": rd})
+
+    pth = str(tmp_path / "invalid.yaml")
+    with open(pth, "w") as fp:
+        yaml.dump(
+            {
+                "a": {"linux-64/a-1-0.tar.bz2": {"bad_paths": {"md5sum": {}}}},
+                # no longer on the channel
+                "c": {"linux-64/c-1-0.tar.bz2": {"bad_paths": {"c": ["bin/c"]}}},
+            },
+            fp,
+        )
+
+    diff = update_scan_data(
+        pth, {"b": {"linux-64/b-1-0.tar.bz2": {"bad_paths": {"b": ["bin/b"]}}}},
+    )
+    assert "+b:" in diff
+    assert "c-1-0" not in diff
+
+    with open(pth, "r") as fp:
+        data = yaml.safe_load(fp)
+    assert data == {
+        "a": {"linux-64/a-1-0.tar.bz2": {"bad_paths": {"md5sum": {}}}},
+        "b": {"linux-64/b-1-0.tar.bz2": {"bad_paths": {"b": ["bin/b"]}}},
+    }
+
+    assert "+b:" in update_scan_data(
+        None, {"b": {"linux-64/b-1-0.tar.bz2": {"bad_paths": {"b": ["bin/b"]}}}},
+    )
+
+
+def test_update_scan_data_valid_artifacts(tmp_path):
+    pth = str(tmp_path / "invalid.yaml")
+    with open(pth, "w") as fp:
+        yaml.dump(
+            {
+                "a": {"linux-64/a-1-0.tar.bz2": {"bad_paths": {"a": ["bin/a"]}}},
+                "c": {"linux-64/c-1-0.tar.bz2": {"bad_paths": {"c": ["bin/c"]}}},
+            },
+            fp,
+        )
+
+    # the repodata is not needed without cleaning
+    diff = update_scan_data(
+        pth,
+        {"b": {"linux-64/b-1-0.tar.bz2": {"bad_paths": {"b": ["bin/b"]}}}},
+        valid_artifacts=["linux-64/a-1-0.tar.bz2"],
+        clean=False,
+    )
+    assert "+b:" in diff
+    assert "-a:" in diff
+
+    with open(pth, "r") as fp:
+        data = yaml.safe_load(fp)
+    assert data == {
+        "b": {"linux-64/b-1-0.tar.bz2": {"bad_paths": {"b": ["bin/b"]}}},
+        "c": {"linux-64/c-1-0.tar.bz2": {"bad_paths": {"c": ["bin/c"]}}},
+    }
+
+
+def test_dump_scan_data():
+    data = defaultdict(dict)
+    data["b"]["linux-64/b-1-0.tar.bz2"] = {"bad_paths": {"b": ["bin/b"]}}
+    data["a"]["linux-64/a-1-0.tar.bz2"] = {
+        "bad_paths": defaultdict(list, {"a": ["bin/a", "lib/*"]}),
+    }
+    # the same as the pure Python dumper
+    assert dump_scan_data(data) == yaml.dump(
+        json.loads(json.dumps(data)), default_flow_style=False, indent=2,
+    )
+
+
+def test_load_findings(tmp_path):
+    pth = str(tmp_path / "findings.jsonl")
+    with open(pth, "w") as fp:
+        for name, subdir, bad in [
+            ("a", "linux-64", "bin/a"),
+            ("b", "noarch", "bin/b"),
+            ("a", "linux-64", "lib/a"),
+        ]:
+            pkg = "%s-1-0.tar.bz2" % name
+            fp.write(dump_finding(name, subdir, pkg, {name: [bad]}) + "\n")
+        # a scan killed while writing
+        fp.write('{"name": "c", "arti')
+
+    assert load_findings(pth) == {
+        "a": {"linux-64/a-1-0.tar.bz2": {"bad_paths": {"a": ["lib/a"]}}},
+        "b": {"noarch/b-1-0.tar.bz2": {"bad_paths": {"b": ["bin/b"]}}},
+    }
+
+
+def test_diff_scan_data():
+    old = {
+        "a": {
+            "linux-64/a-1-0.tar.bz2": {"bad_paths": {"x": ["p"], "y": ["q"]}},
+            "linux-64/a-2-0.tar.bz2": {"bad_paths": {"x": ["p"]}},
+        },
+        "c": {"linux-64/c-1-0.tar.bz2": {"bad_paths": {"x": ["p"]}}},
+    }
+    new = {
+        "a": {
+            "linux-64/a-1-0.tar.bz2": {"bad_paths": {"x": ["p", "r"]}},
+            "linux-64/a-2-0.tar.bz2": {"bad_paths": {"x": ["p"]}},
+            "linux-64/a-3-0.tar.bz2": {"bad_paths": {"x": ["p"]}},
+        },
+        "b": {"linux-64/b-1-0.tar.bz2": {"bad_paths": {"x": ["p"]}}},
+    }
+
+    changes = diff_scan_data(old, new)
+    assert changes == [
+        ("a", "linux-64/a-1-0.tar.bz2", "x", ["p"], ["p", "r"]),
+        ("a", "linux-64/a-1-0.tar.bz2", "y", ["q"], None),
+        ("a", "linux-64/a-3-0.tar.bz2", "x", None, ["p"]),
+        ("b", "linux-64/b-1-0.tar.bz2", "x", None, ["p"]),
+        ("c", "linux-64/c-1-0.tar.bz2", "x", ["p"], None),
+    ]
+    assert diff_scan_data(new, new) == []
+
+    assert format_scan_data_diff(old, new, changes).splitlines() == [
+        "--- ",
+        "+++ ",
+        " a:",
+        "   linux-64/a-1-0.tar.bz2:",
+        "     bad_paths:",
+        "-      x:",
+        "-      - p",
+        "+      x:",
+        "+      - p",
+        "+      - r",
+        "-      y:",
+        "-      - q",
+        "+  linux-64/a-3-0.tar.bz2:",
+        "+    bad_paths:",
+        "+      x:",
+        "+      - p",
+        "+b:",
+        "+  linux-64/b-1-0.tar.bz2:",
+        "+    bad_paths:",
+        "+      x:",
+        "+      - p",
+        "-c:",
+        "-  linux-64/c-1-0.tar.bz2:",
+        "-    bad_paths:",
+        "-      x:",
+        "-      - p",
+    ]
+    assert format_scan_data_diff(new, new, []) == ""
@@ -1,10 +1,13 @@
+import hashlib
 import os
 import subprocess
 import tempfile
 
 import pytest
 
+from .. import download
 from ..validate import download_and_validate, validate_file
+from ..synthetic import make_artifact
 
 
 def test_validate_skip():
@@ -149,3 +152,134 @@ def test_validate_file(subdir_pkg, ok):
             "lib/python*/site-packages/numpy",
             "lib/python*/site-packages/numpy-*.dist-info",
         ]
+
+
+@pytest.mark.parametrize(
+    "globstr,ok",
+    [
+        ("lib/python*/site-packages/numpy/**/*", False),
+        ("lib/python*/site-packages/numpy/**", False),
+        ("lib/python*/site-packages/numpy", False),
+        ("lib/python*/site-packages/numpy/", False),
+        ("lib/python*/site-packages/numpy-*.dist-info/**/*", True),
+        ("lib/python2.7/site-packages/numpy", False),
+        ("lib/python2.7/site-packages/numpy/core/__init__.py", False),
+        ("lib/python2.7/site-packages/numpy/core/_foo.py", True),
+        ("bin/*", True),
+    ],
+)
+@pytest.mark.parametrize("ext", [".tar.bz2", ".conda"])
+def test_validate_file_stream(artifact_factory, tmp_path, ext, globstr, ok):
+    validate_yamls = {
+        "numpy": {
+            "allowed": ["numpy"],
+            "files": [globstr],
+        },
+    }
+    path = artifact_factory(
+        "freud-0.11.0-py27h3e44d54_0" + ext,
+        [
+            "lib/python2.7/site-packages/freud/__init__.py",
+            "lib/python2.7/site-packages/numpy/__init__.py",
+            "lib/python2.7/site-packages/numpy/core/__init__.py",
+        ],
+    )
+
+    valid, bad_pths = validate_file(path, validate_yamls, stream=True)
+    assert valid is ok
+    if ok:
+        assert bad_pths == {}
+    else:
+        assert bad_pths == {"numpy": [globstr]}
+
+    # the extraction-based validation should give the same answer
+    updir = tmp_path / "extract"
+    updir.mkdir()
+    assert (valid, bad_pths) == validate_file(path, validate_yamls, tmpdir=str(updir))
+
+
+def test_validate_file_stream_allowed(artifact_factory):
+    validate_yamls = {
+        "numpy": {
+            "allowed": ["numpy"],
+            "files": ["lib/python*/site-packages/numpy/**/*"],
+        },
+    }
+    path = artifact_factory(
+        "numpy-1.19.4-py36hcf5569d_1.tar.bz2",
+        ["lib/python3.6/site-packages/numpy/__init__.py"],
+    )
+    valid, bad_pths = validate_file(path, validate_yamls, stream=True)
+    assert valid
+    assert bad_pths == {}
+
+
+@pytest.mark.parametrize("ranges", [True, False])
+def test_download_and_validate_range_requests(channel_server, ranges):
+    validate_yamls = {
+        "numpy": {
+            "allowed": ["numpy"],
+            "files": ["lib/python*/site-packages/numpy"],
+        },
+    }
+    os.makedirs(os.path.join(channel_server.dir, "linux-64"))
+    path = make_artifact(
+        os.path.join(channel_server.dir, "linux-64"),
+        "freud-0.11.0-py27h3e44d54_0.conda",
+        ["lib/python2.7/site-packages/numpy/__init__.py"],
+        payload_size=5_000_000,
+    )
+    channel_server.ranges = ranges
+
+    valid, bad_pths = download_and_validate(
+        channel_server.url,
+        "linux-64/freud-0.11.0-py27h3e44d54_0.conda",
+        validate_yamls,
+        stream=True,
+        range_requests=True,
+    )
+    assert not valid
+    assert bad_pths == {"numpy": ["lib/python*/site-packages/numpy"]}
+    if ranges:
+        assert channel_server.stats["bytes"] < os.path.getsize(path) / 10
+    else:
+        assert channel_server.stats["bytes"] >= os.path.getsize(path)
+
+
+def test_download_and_validate_local_checksums(channel_server, monkeypatch):
+    monkeypatch.setattr(download, "MAX_WAIT", 0)
+    validate_yamls = {
+        "numpy": {
+            "allowed": ["numpy"],
+            "files": ["lib/python*/site-packages/numpy"],
+        },
+    }
+    os.makedirs(os.path.join(channel_server.dir, "linux-64"))
+    path = make_artifact(
+        os.path.join(channel_server.dir, "linux-64"),
+        "iminuit-1.5.4-py36h47e6fc7_0.tar.bz2",
+        ["lib/python3.6/site-packages/iminuit/__init__.py"],
+    )
+    with open(path, "rb") as fp:
+        data = fp.read()
+
+    valid, bad_pths = download_and_validate(
+        channel_server.url,
+        "linux-64/iminuit-1.5.4-py36h47e6fc7_0.tar.bz2",
+        validate_yamls,
+        md5sum=hashlib.md5(data).hexdigest(),
+        sha256=hashlib.sha256(data).hexdigest(),
+        stream=True,
+    )
+    assert valid
+    assert bad_pths == {}
+
+    valid, bad_pths = download_and_validate(
+        channel_server.url,
+        "linux-64/iminuit-1.5.4-py36h47e6fc7_0.tar.bz2",
+        validate_yamls,
+        sha256="c7",
+        stream=True,
+    )
+    assert not valid
+    assert bad_pths == {"sha256sum": {"valid": False}}
@@ -1,6 +1,6 @@
 import os
+import time
 import tempfile
-import subprocess
 import traceback
 import glob
 import logging
@@ -9,7 +9,15 @@ import shutil
 import github
 import conda_package_handling.api
 
-from .utils import split_pkg, compute_md5sum
+from .utils import split_pkg
+from .download import download_file, get_session, ChecksumError
+from .artifact_paths import (
+    get_artifact_paths,
+    get_remote_conda_paths,
+    add_parent_dirs,
+)
+from .rules import as_rule_set, RuleSet
+from .metrics import METRICS
 
 LOGGER = logging.getLogger(__name__)
 
@@ -38,20 +46,51 @@ def _validate_one(validate_yaml, pkg_dir):
     return valid, bad_paths
 
 
-def validate_file(path, validate_yamls, tmpdir=None, lock=None):
+def validate_paths(output_name, paths, validate_yamls):
+    """Validate the list of paths in an artifact.
+
+    Parameters
+    ----------
+    output_name : str
+        The name of the output (e.g., `numpy`).
+    paths : iterable of str
+        The paths of the files in the artifact. Parent directories are added
+        automatically.
+    validate_yamls : dict or RuleSet
+        A dictionary mapping the filename of the validation yaml to its
+        contents or the compiled rules.
+
+    Returns
+    -------
+    valid : bool
+        True if the package is valid, False otherwise.
+    bad_paths : dict
+        A dictionary mapping the validation YAML name information in the case
+        that the package is not valid.
+    """
+    valid, bad_pths = as_rule_set(validate_yamls).match(
+        output_name, add_parent_dirs(paths),
+    )
+    return valid, {k: sorted(v) for k, v in bad_pths.items()}
+
+
+def validate_file(path, validate_yamls, tmpdir=None, lock=None, stream=False):
     """Validate a file on disk.
 
     Parameters
     ----------
     path : str
         The path to the file.
-    validate_yamls : dict
+    validate_yamls : dict or RuleSet
         A dictionary mapping the filename of the validation yaml to its
-        contents.
+        contents or the compiled rules.
     tmpdir : str, optional
         If not None, copy the data to this location before unpacking it.
     lock : threading.Lock or None, optional
         If not None, use this lock to protect calls to `conda_package_handling`.
+    stream : bool, optional
+        If True, read the list of paths from the artifact without extracting it
+        to disk. The `tmpdir` and `lock` arguments are ignored in this case.
 
     Returns
     -------
@@ -64,6 +103,24 @@ def validate_file(path, validate_yamls, tmpdir=None, lock=None):
     valid = True
     bad_pths = {}
 
+    if stream:
+        _, output_name, _, _ = split_pkg(
+            os.path.join("foo", os.path.basename(path))
+        )
+        try:
+            paths = get_artifact_paths(path)
+        except Exception as e:
+            print(
+                "error reading archive %s: %s" % (os.path.basename(path), repr(e)),
+                flush=True,
+            )
+            return valid, bad_pths
+
+        return validate_paths(output_name, paths, validate_yamls)
+
+    if isinstance(validate_yamls, RuleSet):
+        validate_yamls = validate_yamls.to_validate_yamls()
+
     if tmpdir is not None:
         shutil.copy2(path, tmpdir)
         path = os.path.join(tmpdir, path)
@@ -83,10 +140,14 @@ def validate_file(path, validate_yamls, tmpdir=None, lock=None):
 
     try:
         if lock is not None:
+            t0 = time.perf_counter()
             with lock:
-                conda_package_handling.api.extract(path)
+                METRICS.add_time("extract_lock_wait", time.perf_counter() - t0)
+                with METRICS.time("extract"):
+                    conda_package_handling.api.extract(path)
         else:
-            conda_package_handling.api.extract(path)
+            with METRICS.time("extract"):
+                conda_package_handling.api.extract(path)
     except Exception as e:
         print(
             "error extracting archive %f: %s" % (os.path.basename(path), repr(e)),
@@ -94,23 +155,105 @@ def validate_file(path, validate_yamls, tmpdir=None, lock=None):
         )
         return valid, bad_pths
 
-    for validate_name, validate_yaml in validate_yamls.items():
-        if output_name not in validate_yaml["allowed"]:
-            _valid, _bad_pths = _validate_one(
-                validate_yaml,
-                f"{pkg_dir}/{pkg_nm}",
-            )
-            valid = valid and _valid
-            if not _valid:
-                bad_pths[validate_name] = sorted(_bad_pths)
-        else:
-            LOGGER.debug("skipping %s for %s", pkg_nm, validate_name)
+    with METRICS.time("match"):
+        for validate_name, validate_yaml in validate_yamls.items():
+            if output_name not in validate_yaml["allowed"]:
+                _valid, _bad_pths = _validate_one(
+                    validate_yaml,
+                    f"{pkg_dir}/{pkg_nm}",
+                )
+                valid = valid and _valid
+                if not _valid:
+                    bad_pths[validate_name] = sorted(_bad_pths)
+            else:
+                LOGGER.debug("skipping %s for %s", pkg_nm, validate_name)
 
     return valid, bad_pths
 
 
+def _get_remote_paths(channel_url, subdir_pkg):
+    # reads the paths of a .conda artifact with range requests, returning None
+    # if the artifact has to be downloaded instead
+    if not subdir_pkg.endswith(".conda"):
+        return None
+
+    try:
+        with METRICS.time("range_request"):
+            paths = get_remote_conda_paths(
+                f"{channel_url}/{subdir_pkg}", session=get_session(),
+            )
+    except Exception:
+        traceback.print_exc()
+        paths = None
+
+    if paths is None:
+        LOGGER.info("could not use range requests - downloading the artifact")
+    return paths
+
+
+def download_artifact_paths(
+    channel_url, subdir_pkg, md5sum=None, sha256=None, range_requests=False,
+):
+    """Download a package and read the paths in it without extracting it.
+
+    Parameters
+    ----------
+    channel_url : str
+        The URL for the conda channel.
+    subdir_pkg : str
+        The fully qualified path of the package (e.g. "linux-64/numpy-...").
+    md5sum : str
+        If not None, then checksum the downloaded file with md5.
+    sha256 : str
+        If not None, then also checksum the downloaded file with sha256.
+    range_requests : bool, optional
+        If True and no checksums are given, only fetch the `info/` component
+        of `.conda` artifacts via HTTP range requests. The full artifact is
+        downloaded if the server does not support range requests.
+
+    Returns
+    -------
+    paths : list of str or None
+        The paths in the package or None if the archive could not be read.
+
+    Raises
+    ------
+    ChecksumError
+        If the downloaded file does not match a checksum.
+    """
+    _, pkg = subdir_pkg.split(os.path.sep)
+
+    if range_requests and md5sum is None and sha256 is None:
+        paths = _get_remote_paths(channel_url, subdir_pkg)
+        if paths is not None:
+            return paths
+
+    with tempfile.TemporaryDirectory(
+        dir=os.environ.get("GITHUB_WORKSPACE", None)
+    ) as tmpdir:
+        if md5sum is None and sha256 is None:
+            LOGGER.warning("not checking md5 sum!")
+
+        download_file(
+            f"{channel_url}/{subdir_pkg}",
+            f"{tmpdir}/{pkg}",
+            md5sum=md5sum,
+            sha256=sha256,
+        )
+        if md5sum is not None:
+            LOGGER.info("md5 sum is valid")
+
+        try:
+            with METRICS.time("read_paths"):
+                return get_artifact_paths(f"{tmpdir}/{pkg}")
+        except Exception as e:
+            print("error reading archive %s: %s" % (pkg, repr(e)), flush=True)
+            return None
+
+
 def download_and_validate(
-    channel_url, subdir_pkg, validate_yamls, md5sum=None, lock=None,
+    channel_url, subdir_pkg, validate_yamls, md5sum=None, lock=None, stream=False,
+    range_requests=False, sha256=None,
 ):
     """Download and validate a package.
 
@@ -120,13 +263,22 @@ def download_and_validate(
         The URL for the conda channel.
     subdir_pkg : str
         The fully qualified path of the package (e.g. "linux-64/numpy-...").
-    validate_yamls : dict
+    validate_yamls : dict or RuleSet
         A dictionary mapping the filename of the validation yaml to its
-        contents.
+        contents or the compiled rules.
     md5sum : str
         If not None, then checksum the downloaded file with md5 before we validate.
     lock : threading.Lock or None, optional
         If not None, use this lock to protect calls to `conda_package_handling`.
+    stream : bool, optional
+        If True, validate the artifact without extracting it to disk.
+    range_requests : bool, optional
+        If True and `md5sum` is None, only fetch the `info/` component of `.conda`
+        artifacts via HTTP range requests. The full artifact is downloaded if
+        the server does not support range requests.
+    sha256 : str
+        If not None, then also checksum the downloaded file with sha256 before
+        we validate.
 
     Returns
     -------
@@ -136,38 +288,54 @@ def download_and_validate(
         A dictionary mapping the validation YAML name information in the case
         that the package is not valid.
     """
-
     _, pkg = subdir_pkg.split(os.path.sep)
+    _, output_name, _, _ = split_pkg(subdir_pkg)
+
+    if stream:
+        try:
+            paths = download_artifact_paths(
+                channel_url,
+                subdir_pkg,
+                md5sum=md5sum,
+                sha256=sha256,
+                range_requests=range_requests,
+            )
+        except ChecksumError as e:
+            LOGGER.info("bad %s sum", e.kind)
+            return False, {e.kind + "sum": {"valid": False}}
+        except Exception:
+            traceback.print_exc()
+            return False, {}
+
+        if paths is None:
+            return True, {}
+        return validate_paths(output_name, paths, validate_yamls)
+
+    if range_requests and md5sum is None and sha256 is None:
+        paths = _get_remote_paths(channel_url, subdir_pkg)
+        if paths is not None:
+            return validate_paths(output_name, paths, validate_yamls)
 
     with tempfile.TemporaryDirectory(
         dir=os.environ.get("GITHUB_WORKSPACE", None)
     ) as tmpdir:
         try:
-            max_attempts = 5
-            for attempt in range(max_attempts):
-                # download
-                subprocess.run(
-                    f"cd {tmpdir} && curl -s -L "
-                    f"{channel_url}/{subdir_pkg} --output {pkg}",
-                    shell=True,
-                )
+            if md5sum is None and sha256 is None:
+                LOGGER.warning("not checking md5 sum!")
 
-                # unpack
-                if os.path.exists(f"{tmpdir}/{pkg}"):
-                    if md5sum is not None:
-                        if md5sum != compute_md5sum(f"{tmpdir}/{pkg}"):
-                            if attempt == max_attempts-1:
-                                LOGGER.info("bad md5sum")
-                                return False, {"md5sum": {"valid": False}}
-                            else:
-                                os.remove(f"{tmpdir}/{pkg}")
-                                continue
-                        else:
-                            LOGGER.info("md5 sum is valid")
-                            break
-                    else:
-                        LOGGER.warning("not checking md5 sum!")
-                        break
+            try:
+                download_file(
+                    f"{channel_url}/{subdir_pkg}",
+                    f"{tmpdir}/{pkg}",
+                    md5sum=md5sum,
+                    sha256=sha256,
+                )
+            except ChecksumError as e:
+                LOGGER.info("bad %s sum", e.kind)
+                return False, {e.kind + "sum": {"valid": False}}
+            else:
+                if md5sum is not None:
+                    LOGGER.info("md5 sum is valid")
 
             if os.path.exists(f"{tmpdir}/{pkg}"):
                 valid, bad_pths = validate_file(
@@ -11,6 +11,11 @@ setup(
         "bin/conda-forge-scan-artifacts",
         "bin/conda-forge-bump-on-fail",
         "bin/conda-forge-report-scan-results",
+        "bin/conda-forge-compile-rules",
+        "bin/conda-forge-merge-scan-results",
+        "bin/conda-forge-index-libcfgraph",
+        "bin/conda-forge-rescan-rules",
+        "bin/conda-forge-run-benchmarks",
     ],
     url="https://github.com/conda-forge/artifact-validation",
     packages=find_packages(),